@@ -0,0 +1,252 @@
+"""
+Puzzle score aggregates and protocol tests, as computed in sqlite_to_r.R, on NumPy arrays.
+
+Tables are dicts of column name -> 1-D array, read either from the app's models (load_database)
+or from a `flask export` directory (load_export). puzzle_stats() groups moves per
+(section, puzzle) by sorting one integer key and reducing over the run boundaries, so cost is a
+sort plus a few array passes regardless of how many moves there are. Needs numpy and scipy (and
+pyarrow for Parquet exports), which the web app itself does not.
+
+    python analytics.py                  # the configured database
+    python analytics.py --export export  # a Parquet or .npy dump
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+from scipy import stats
+
+PROTOCOLS = ("none", "placebic", "actionable")
+# Participants before the restart and non-MTurk test accounts are left out, as in the R script
+RESTART_DATE = np.datetime64("2023-10-01")
+MTURK_PREFIX = "A"
+# Filters for puzzle_stats.filtered
+MAX_MOVES = 12
+MAX_SECONDS = 300
+NUM_CORRECT = 2
+
+COLUMNS = {
+    "move": ("section_id", "puzzle_id", "duration", "mistake", "start_time"),
+    "section": ("id", "mturk_id", "section", "protocol", "start_time"),
+    "user": ("mturk_id", "protocol", "experiment_completed", "compensation", "start_time"),
+    "theme_answer": ("mturk_id", "puzzle_id", "correct"),
+}
+STR_COLUMNS = ("mturk_id", "section", "protocol")
+BOOL_COLUMNS = ("mistake", "experiment_completed", "correct")
+FLOAT_COLUMNS = ("compensation",)
+
+def as_array(name, values):
+    if name.endswith("_time"):
+        return np.array(values, dtype="datetime64[us]")
+    if name in STR_COLUMNS:
+        return np.array(["" if v is None else v for v in values], dtype=str)
+    if name in BOOL_COLUMNS:
+        return np.array([bool(v) for v in values], dtype=bool)
+    if name in FLOAT_COLUMNS:
+        return np.array([0.0 if v is None else v for v in values], dtype=np.float64)
+    # Missing ids and durations become -1, which no key or filter matches
+    return np.array([-1 if v is None else v for v in values], dtype=np.int64)
+
+def load_database(session=None):
+    """Read the columns the analysis needs from the app's models, within an app context."""
+    from app import db, Move, Section, ThemeAnswer, User
+    session = session or db.session
+    models = {"move": Move, "section": Section, "user": User, "theme_answer": ThemeAnswer}
+    tables = {}
+    for name, columns in COLUMNS.items():
+        rows = session.execute(db.select(*[getattr(models[name], c) for c in columns])).all()
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        tables[name] = {c: as_array(c, v) for c, v in zip(columns, values)}
+    return tables
+
+def load_export(path):
+    """Read the same columns from a `flask export` directory, Parquet or .npy."""
+    tables = {}
+    for name, columns in COLUMNS.items():
+        parquet = os.path.join(path, name + ".parquet")
+        if os.path.exists(parquet):
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(parquet, columns=list(columns))
+            raw = {c: table.column(c).to_pylist() if table.column(c).null_count else table.column(c).to_numpy() for c in columns}
+        elif glob.glob(os.path.join(path, name, "*.npy")):
+            raw = {c: np.load(os.path.join(path, name, c + ".npy"), mmap_mode="r") for c in columns}
+        else:
+            raise FileNotFoundError("No %s table in %s" % (name, path))
+        tables[name] = {c: normalize(c, v) for c, v in raw.items()}
+    return tables
+
+def normalize(name, values):
+    if isinstance(values, list):
+        return as_array(name, values)
+    values = np.asarray(values)
+    if name in FLOAT_COLUMNS:
+        return np.nan_to_num(values.astype(np.float64))
+    if values.dtype.kind == "f" and not name.endswith("_time"):
+        # .npy exports keep nullable ints and bools as float64 with NaN
+        if name in BOOL_COLUMNS:
+            return np.nan_to_num(values) != 0
+        return np.where(np.isnan(values), -1, values).astype(np.int64)
+    if values.dtype.kind == "O":
+        return as_array(name, values.tolist())
+    if name.endswith("_time"):
+        return values.astype("datetime64[us]")
+    return values
+
+def lookup(keys, sorted_keys, order=None):
+    """Positions of keys in sorted_keys (through order, if it is an argsort), and whether each was found."""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    pos = np.searchsorted(sorted_keys, keys).clip(0, len(sorted_keys) - 1)
+    found = sorted_keys[pos] == keys
+    return (pos if order is None else order[pos]), found
+
+def eligible_users(users, since=RESTART_DATE, prefix=MTURK_PREFIX):
+    """Mask of the users the analysis counts: MTurk participants who started after the restart."""
+    return (users["start_time"] >= since) & np.char.startswith(users["mturk_id"], prefix)
+
+def puzzle_stats(tables, since=RESTART_DATE, prefix=MTURK_PREFIX):
+    """
+    One row per (participant, section, puzzle) with num_moves, num_seconds, num_correct and
+    score = 1/sqrt(num_moves * num_seconds), joined to the user's protocol and the section.
+
+    Moves are matched to users through their section (a move's mturk_id is always its section's).
+    """
+    moves, sections, users = tables["move"], tables["section"], tables["user"]
+
+    # Users and sections are small; select the eligible ones first
+    user_ok = eligible_users(users, since, prefix)
+    user_order = np.argsort(users["mturk_id"], kind="stable")
+    sec_user, sec_user_found = lookup(sections["mturk_id"], users["mturk_id"][user_order], user_order)
+    sec_ok = sec_user_found & user_ok[sec_user] & (sections["start_time"] >= since)
+
+    sec_order = np.argsort(sections["id"], kind="stable")
+    move_sec, move_sec_found = lookup(moves["section_id"], sections["id"][sec_order], sec_order)
+    keep = move_sec_found & sec_ok[move_sec] & (moves["start_time"] >= since)
+
+    section_id = moves["section_id"][keep]
+    puzzle_id = moves["puzzle_id"][keep]
+    duration = moves["duration"][keep]
+    correct = ~moves["mistake"][keep]
+    move_sec = move_sec[keep]
+
+    # Group by one sorted integer key; each run of equal keys is a group
+    span = int(puzzle_id.max()) + 2 if len(puzzle_id) else 1
+    key = section_id * span + (puzzle_id + 1)
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if len(key) else np.array([], dtype=np.int64)
+    num_moves = np.diff(np.r_[starts, len(key)])
+    num_seconds = np.add.reduceat(duration[order], starts) / 1000 if len(starts) else np.array([], dtype=float)
+    num_correct = np.add.reduceat(correct[order].astype(np.int64), starts) if len(starts) else np.array([], dtype=np.int64)
+    with np.errstate(divide="ignore"):
+        score = 1 / np.sqrt(num_moves * num_seconds)
+
+    first = order[starts]
+    sec_row = move_sec[first]
+    user_row = sec_user[sec_row]
+    return {
+        "mturk_id": sections["mturk_id"][sec_row],
+        "section_id": section_id[first],
+        "puzzle_id": puzzle_id[first],
+        "protocol_user": users["protocol"][user_row],
+        "experiment_completed": users["experiment_completed"][user_row],
+        "num_moves": num_moves,
+        "num_seconds": num_seconds,
+        "num_correct": num_correct,
+        "score": score,
+        "section": sections["section"][sec_row],
+        "protocol_section": sections["protocol"][sec_row],
+    }
+
+def select(frame, mask):
+    return {name: column[mask] for name, column in frame.items()}
+
+def filter_stats(frame, max_moves=MAX_MOVES, max_seconds=MAX_SECONDS, num_correct=NUM_CORRECT):
+    return select(frame, (frame["num_moves"] <= max_moves) & (frame["num_seconds"] <= max_seconds) & (frame["num_correct"] == num_correct))
+
+def group_codes(groups, levels):
+    """Integer codes for groups in levels order; values outside levels get -1."""
+    levels = np.asarray(levels)
+    order = np.argsort(levels)
+    pos, found = lookup(groups, levels[order], order)
+    return np.where(found, pos, -1)
+
+def group_means(values, groups, levels):
+    """Values and codes of the rows in levels, with each level's count and mean."""
+    codes = group_codes(groups, levels)
+    values, codes = values[codes >= 0], codes[codes >= 0]
+    n = np.bincount(codes, minlength=len(levels))
+    means = np.bincount(codes, weights=values, minlength=len(levels)) / np.maximum(n, 1)
+    return values, codes, n, means
+
+def anova_oneway(values, groups, levels=PROTOCOLS):
+    """One-way ANOVA table, as summary(aov(values ~ groups)) prints it."""
+    values, codes, n, means = group_means(values, groups, levels)
+    k = int((n > 0).sum())
+    # Absent levels have n = 0 and drop out of the between-groups sum
+    ss_between = float((n * (means - values.mean()) ** 2).sum())
+    ss_within = float(((values - means[codes]) ** 2).sum())
+    df_between, df_within = k - 1, len(values) - k
+    ms_between, ms_within = ss_between / df_between, ss_within / df_within
+    f = ms_between / ms_within
+    return {
+        "df": (df_between, df_within), "sum_sq": (ss_between, ss_within), "mean_sq": (ms_between, ms_within),
+        "F": f, "p": float(stats.f.sf(f, df_between, df_within)),
+    }
+
+def tukey_hsd(values, groups, levels=PROTOCOLS, conf_level=0.95):
+    """Pairwise comparisons as TukeyHSD() reports them: "later-earlier" level, diff, lwr, upr, p adj."""
+    values, codes, n, means = group_means(values, groups, levels)
+    present = [i for i in range(len(levels)) if n[i] > 0]
+    k, df = len(present), len(values) - len(present)
+    mse = float(((values - means[codes]) ** 2).sum()) / df
+    q_crit = stats.studentized_range.ppf(conf_level, k, df)
+    rows = []
+    for a, i in enumerate(present):
+        for j in present[a + 1:]:
+            diff = means[j] - means[i]
+            se = np.sqrt(mse / 2 * (1 / n[i] + 1 / n[j]))
+            rows.append({
+                "comparison": "%s-%s" % (levels[j], levels[i]), "diff": float(diff),
+                "lwr": float(diff - q_crit * se), "upr": float(diff + q_crit * se),
+                "p_adj": float(stats.studentized_range.sf(abs(diff) / se, k, df)),
+            })
+    return rows
+
+def print_anova(title, table):
+    print(title)
+    print("%-14s %6s %10s %10s %8s %10s" % ("", "Df", "Sum Sq", "Mean Sq", "F value", "Pr(>F)"))
+    print("%-14s %6d %10.5f %10.5f %8.3f %10.4g" % ("protocol", table["df"][0], table["sum_sq"][0], table["mean_sq"][0], table["F"], table["p"]))
+    print("%-14s %6d %10.5f %10.5f" % ("Residuals", table["df"][1], table["sum_sq"][1], table["mean_sq"][1]))
+
+def print_tukey(rows):
+    print("%-22s %10s %10s %10s %10s" % ("", "diff", "lwr", "upr", "p adj"))
+    for r in rows:
+        print("%-22s %10.6f %10.6f %10.6f %10.7f" % (r["comparison"], r["diff"], r["lwr"], r["upr"], r["p_adj"]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--export", help="read a `flask export` directory instead of the database")
+    args = parser.parse_args()
+
+    if args.export:
+        tables = load_export(args.export)
+    else:
+        from app import create_app
+        with create_app().app_context():
+            tables = load_database()
+
+    frame = puzzle_stats(tables)
+    filtered = filter_stats(frame)
+    for section in ("practice", "testing"):
+        everything = select(frame, frame["section"] == section)
+        kept = select(filtered, filtered["section"] == section)
+        print("\n%s: %d puzzle rows, %d after filtering (%.4f)" % (
+            section, len(everything["score"]), len(kept["score"]), len(kept["score"]) / max(len(everything["score"]), 1)
+        ))
+        print_anova("score ~ protocol.user", anova_oneway(kept["score"], kept["protocol_user"]))
+        print_tukey(tukey_hsd(kept["score"], kept["protocol_user"]))
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,47 @@
-from flask import Flask, flash, g, render_template, request, session, jsonify, url_for, redirect, current_app
+from flask import Blueprint, Flask, abort, flash, g, has_request_context, render_template, request, session, jsonify, url_for, redirect, current_app
 from flask_login import login_user, logout_user, current_user, login_required, LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_wtf import FlaskForm
 from wtforms  import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired
-from sqlalchemy import JSON
+from werkzeug.wsgi import ClosingIterator
+from sqlalchemy import JSON, event, inspect as sa_inspect
+from sqlalchemy.dialects import postgresql, sqlite
 from random import choice, randint
 from datetime import datetime, timedelta
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
+from bitboard import Position, line_hashes, move_to_uci
+from motifs import classify_rows
+import atexit
+import bz2
+import click
+import collections
+import csv
+import glob
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import lzma
+import operator
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 PROTOCOLS = ["none", "placebic", "actionable"]
+# Dialects with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+BASE_COMP = 2.5
+PUZZLE_BONUS = .2
+MISTAKE_PENALTY = .04
 
 # forms.py
 class LoginForm(FlaskForm):
@@ -23,38 +55,115 @@ class Config(object):
 	"""
 	DEBUG = False
 	TESTING = False
-	SQLALCHEMY_DATABASE_URI = "sqlite:///application.db"
+	SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///application.db")
 	BOOTSTRAP_FONTAWESOME = True
 	SECRET_KEY = "MINHACHAVESECRETA"
 	CSRF_ENABLED = True
 	SQLALCHEMY_TRACK_MODIFICATIONS = True
+	# Seconds between checks of the catalog version row
+	CATALOG_CHECK_INTERVAL = 5
+	# Sections the catalog serves; other sections (such as imported libraries) stay in the database only
+	CATALOG_SECTIONS = ("practice", "testing")
+	# Telemetry (moves, theme answers, section ends) is committed by a background writer
+	WRITE_BEHIND = True
+	WRITE_BEHIND_INTERVAL_MS = 50
+	WRITE_BEHIND_BATCH_ROWS = 200
+	WRITE_BEHIND_MAX_QUEUE = 10000
+	# Seconds the payout waits for a participant's events queued in any worker to be committed
+	WRITE_BEHIND_PAYOUT_TIMEOUT = 10
+	# Per-process spill files live in the instance folder as <name>.<pid>
+	WRITE_BEHIND_SPILL = "write_behind.spill"
+	# A spill file past this many bytes is rewritten with only the events not yet committed
+	WRITE_BEHIND_SPILL_BYTES = 1 << 20
+	# Events that still fail when committed on their own, kept for `flask replay-spills --dead-letters`
+	WRITE_BEHIND_DEAD_LETTER = "write_behind.dead"
+	# Bearer token for /metrics; the endpoint answers 404 while unset
+	METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+	# PRAGMAs run on every new SQLite connection, and the mode each transaction begins in
+	SQLITE_PRAGMAS = {}
+	SQLITE_BEGIN = None
+	# Seconds of writer idleness before the WAL is checkpointed and truncated
+	SQLITE_CHECKPOINT_INTERVAL = 30
 
 	#Get your reCaptche key on: https://www.google.com/recaptcha/admin/create
 	#RECAPTCHA_PUBLIC_KEY = "6LffFNwSAAAAAFcWVy__EnOCsNZcG2fVHFjTBvRP"
 	#RECAPTCHA_PRIVATE_KEY = "6LffFNwSAAAAAO7UURCGI7qQ811SOSZlgU69rvv7"
 
 class ProductionConfig(Config):
-	SQLALCHEMY_DATABASE_URI = "mysql://user@localhost/foo"
 	SQLALCHEMY_TRACK_MODIFICATIONS = False
+	# WAL lets readers run alongside the single writer; NORMAL only fsyncs at checkpoints,
+	# which can lose the last commits on power loss but never corrupts the database
+	SQLITE_PRAGMAS = {
+		"journal_mode": "WAL",
+		"synchronous": "NORMAL",
+		"busy_timeout": 10000,
+		"mmap_size": 256 * 1024 * 1024,
+		"cache_size": -64 * 1024,
+		"wal_autocheckpoint": 1000,
+		"journal_size_limit": 64 * 1024 * 1024,
+	}
+	# Transactions begin deferred, so reads never queue behind the write lock; the ones that read
+	# and then write ask for IMMEDIATE through begin_write()
+	SQLITE_BEGIN = "DEFERRED"
+	# One pooled connection per server thread; each worker process gets its own pool
+	SQLALCHEMY_ENGINE_OPTIONS = {
+		"pool_size": 16,
+		"max_overflow": 16,
+		"pool_timeout": 30,
+		"connect_args": {"check_same_thread": False},
+	}
 
 class DevelopmentConfig(Config):
 	DEBUG = True
 
 class TestingConfig(Config):
 	TESTING = True
+	WRITE_BEHIND = False
 
-app = Flask(__name__)
-#Configuration of application, see configuration.py, choose one and uncomment.
-#app.config.from_object("configuration.ProductionConfig")
-app.config.from_object(DevelopmentConfig)
-#app.config.from_object("configuration.TestingConfig")
-
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-
+db = SQLAlchemy()
+migrate = Migrate()
 lm = LoginManager()
-lm.setup_app(app)
-lm.login_view = "login"
+lm.login_view = "main.login"
+# Routes, hooks and commands; create_app() registers them on each app
+bp = Blueprint("main", __name__, cli_group=None)
+
+# database.py
+def configure_sqlite(engine, pragmas, begin=None):
+    """Apply PRAGMAs to each new connection and, if begin is set, open transactions with BEGIN <begin>."""
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if begin:
+            # Stop pysqlite from issuing its own BEGIN; the "begin" listener below does it
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    if begin:
+        @event.listens_for(engine, "begin")
+        def begin_sqlite_transaction(conn):
+            # A connection can ask for another mode with execution_options(sqlite_begin=...)
+            conn.exec_driver_sql("BEGIN " + conn.get_execution_options().get("sqlite_begin", begin))
+
+def begin_write():
+    """
+    Begin the session's next transaction with the write lock held (BEGIN IMMEDIATE under SQLite), so
+    one that reads before it writes waits on busy_timeout instead of failing with SQLITE_BUSY when
+    another connection commits in between. Call it before the transaction's first statement.
+    """
+    if not db.session().in_transaction():
+        db.session.connection(execution_options={"sqlite_begin": "IMMEDIATE"})
+
+def checkpoint_sqlite(mode="TRUNCATE"):
+    if db.engine.dialect.name == "sqlite" and current_app.config["SQLITE_PRAGMAS"].get("journal_mode") == "WAL":
+        # A checkpoint cannot run inside a transaction, so bypass the "begin" listener with the raw connection
+        conn = db.engine.raw_connection()
+        try:
+            return tuple(conn.cursor().execute("PRAGMA wal_checkpoint(%s)" % mode).fetchone())
+        finally:
+            conn.close()
+
 
 # util_views.py
 class User(db.Model):
@@ -80,6 +189,9 @@ class User(db.Model):
     def get_id(self):
         return str(self.mturk_id)
 
+    def load(self):
+        return self
+
     def __repr__(self):
         return "<User MTURK ID: %r>" % (self.mturk_id)
     
@@ -90,6 +202,8 @@ class Survey(db.Model):
     data = db.Column(JSON)
     timestamp = db.Column(db.DateTime)
 
+    __table_args__ = (db.Index("ix_survey_mturk_id_type", "mturk_id", "type"),)
+
 class Puzzle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     fen = db.Column(db.String(100))
@@ -97,6 +211,31 @@ class Puzzle(db.Model):
     moves = db.Column(db.String(20))
     theme = db.Column(db.String(20))
     section = db.Column(db.String(20))
+    # Zobrist hash of the start position; PuzzlePosition holds the rest of the line
+    zobrist = db.Column(db.BigInteger)
+    # Label from the static motif detector (flask classify-puzzles); theme stays as entered
+    motif = db.Column(db.String(20))
+    motif_confidence = db.Column(db.Float)
+
+    # The catalog loads its sections' puzzles through ix_puzzle_section
+    __table_args__ = (db.Index("ix_puzzle_zobrist", "zobrist"), db.Index("ix_puzzle_section", "section"))
+    # Analysis columns, left out of the catalog and so of the payload the client is served
+    serializer_exclude = ("zobrist", "motif", "motif_confidence")
+
+class PuzzlePosition(db.Model):
+    """
+    Zobrist hash of each position on a puzzle's line: move_num 0 is the start and n the position after n moves.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    puzzle_id = db.Column(db.Integer, db.ForeignKey("puzzle.id"))
+    move_num = db.Column(db.Integer)
+    zobrist = db.Column(db.BigInteger)
+
+    # Covers "which puzzles pass through this position" without touching the table
+    __table_args__ = (
+        db.Index("ix_puzzle_position_zobrist", "zobrist", "puzzle_id", "move_num"),
+        db.Index("ix_puzzle_position_puzzle_id_move_num", "puzzle_id", "move_num", unique=True),
+    )
 
 class Explanation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -106,6 +245,13 @@ class Explanation(db.Model):
     mistake = db.Column(db.Boolean)
     reason = db.Column(db.String(200))
 
+    __table_args__ = (db.Index("ix_explanation_lookup", "puzzle_id", "move_num", "protocol", "mistake"),)
+
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+    updated = db.Column(db.DateTime)
+
 class Section(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     mturk_id = db.Column(db.String(20), db.ForeignKey("user.mturk_id"))
@@ -117,6 +263,8 @@ class Section(db.Model):
     successes = db.Column(db.Integer)
     num_puzzles = db.Column(db.Integer)
 
+    __table_args__ = (db.Index("ix_section_mturk_id_section", "mturk_id", "section"),)
+
 class Move(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     mturk_id = db.Column(db.String(20), db.ForeignKey("user.mturk_id"))
@@ -127,24 +275,938 @@ class Move(db.Model):
     start_time = db.Column(db.DateTime)
     end_time = db.Column(db.DateTime)
     duration = db.Column(db.Integer)
+    # The server's verdict, which the bonus is paid on; client_mistake is what the browser decided
     mistake = db.Column(db.Boolean)
+    client_mistake = db.Column(db.Boolean)
+    # Whether the move is legal in the puzzle position; NULL for moves the catalog could not judge
+    legal = db.Column(db.Boolean)
+    # Client sequence number within the section, used to drop retried batches
+    seq = db.Column(db.Integer)
+
+    # Covers the per-section bonus replay (section_id, puzzle_id, mistake) without touching the table
+    __table_args__ = (
+        db.Index("ix_move_section_id_puzzle_id", "section_id", "puzzle_id", "mistake"),
+        db.Index("ix_move_section_id_seq", "section_id", "seq", unique=True),
+    )
+
+class ThemeAnswer(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mturk_id = db.Column(db.String(20), db.ForeignKey("user.mturk_id"))
+    puzzle_id = db.Column(db.Integer, db.ForeignKey("puzzle.id"))
+    user_answer = db.Column(db.String(20))
+    correct_answer = db.Column(db.String(20))
+    correct = db.Column(db.Boolean)
+    timestamp = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index("ix_theme_answer_mturk_id_puzzle_id", "mturk_id", "puzzle_id", unique=True),)
+
+class PuzzleBonus(db.Model):
+    """
+    Running bonus state for one puzzle within a section, folded in as moves are logged.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    section_id = db.Column(db.Integer, db.ForeignKey("section.id"))
+    puzzle_id = db.Column(db.Integer, db.ForeignKey("puzzle.id"))
+    correct = db.Column(db.Integer, default=0)
+    mistakes = db.Column(db.Integer, default=0)
+    bonus = db.Column(db.Float, default=PUZZLE_BONUS)
+
+    __table_args__ = (db.Index("ix_puzzle_bonus_section_id_puzzle_id", "section_id", "puzzle_id", unique=True),)
+
+    def fold(self, mistake):
+        # Same arithmetic, in the same order, as the original per-move replay
+        self.correct += not mistake
+        self.mistakes += bool(mistake)
+        self.bonus = max(self.bonus - mistake*MISTAKE_PENALTY, 0)
+
+    def payout(self):
+        return self.bonus if self.correct >= 2 else 0.0
+
+class Participant(object):
+    """
+    Request-scoped identity built from the signed session cookie instead of the User row.
+
+    Claims (mturk_id, protocol, consent, expiry) are written to the session at login and consent;
+    the User row is only loaded through load(), by routes that change it.
+    """
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, mturk_id, protocol=None, consent=False, expiry_time=None):
+        self.mturk_id = mturk_id
+        self.consent = consent
+        self.expiry_time = expiry_time
+        self._protocol = protocol
+        self._user = None
+
+    @classmethod
+    def from_session(cls):
+        return cls(
+            session["mturk_id"],
+            protocol = session.get("user_protocol"),
+            consent = bool(session.get("consent")),
+            expiry_time = session.get("expiry_time")
+        )
+
+    @property
+    def protocol(self):
+        if self._protocol is None:
+            # Sessions started before the protocol claim existed
+            return self.load().protocol
+        return self._protocol
+
+    def get_id(self):
+        return str(self.mturk_id)
+
+    def load(self):
+        """The User row, for routes that need to change it."""
+        if self._user is None:
+            self._user = db.session.get(User, self.mturk_id)
+            # The claims did not spare this request its User load after all
+            g.user_load_avoided = False
+        return self._user
+
+    def __repr__(self):
+        return "<Participant MTURK ID: %r>" % (self.mturk_id)
 
 @lm.user_loader
 def load_user(user_id):
+    # Called at most once per request, the first time current_user is used
+    if session.get("mturk_id") == user_id:
+        g.user_load_avoided = True
+        return Participant.from_session()
     return User.query.get(user_id)
 
-def row2dict(r):
-    return {c.name: str(getattr(r, c.name)) for c in r.__table__.columns}
+@bp.after_app_request
+def report_user_loads(response):
+    response.headers["X-User-Loads-Avoided"] = str(int(g.get("user_load_avoided", False)))
+    return response
+
+# serializers.py
+def isoformat(value):
+    return value.isoformat()
+
+class Serializer(object):
+    """
+    Typed dicts and JSON bytes for one model, planned once from its mapper.
+
+    Values keep their column's Python type (ints, floats, bools, JSON), except datetimes, which
+    become ISO 8601 strings. Columns named in the model's serializer_exclude are left out.
+    to_dicts()/to_json() take ORM objects; rows_to_dicts()/rows_to_json() take raw row tuples from
+    select(), so a whole result set is serialized without building any.
+    """
+    def __init__(self, model):
+        exclude = getattr(model, "serializer_exclude", ())
+        attrs = [attr for attr in sa_inspect(model).column_attrs if attr.key not in exclude]
+        self.model = model
+        self.keys = tuple(attr.key for attr in attrs)
+        self.columns = tuple(getattr(model, key) for key in self.keys)
+        self.getter = operator.attrgetter(*self.keys) if len(self.keys) > 1 else lambda obj: (getattr(obj, self.keys[0]),)
+        # (position, converter) for the columns JSON cannot hold as they are
+        self.converters = tuple(
+            (i, isoformat) for i, attr in enumerate(attrs) if isinstance(attr.columns[0].type, (db.DateTime, db.Date, db.Time))
+        )
+
+    def select(self):
+        """SELECT of every column, in the order rows_to_dicts() expects."""
+        return db.select(*self.columns)
+
+    def rows_to_dicts(self, rows):
+        keys, converters = self.keys, self.converters
+        if not converters:
+            return [dict(zip(keys, row)) for row in rows]
+        dicts = []
+        for row in rows:
+            values = list(row)
+            for i, convert in converters:
+                if values[i] is not None:
+                    values[i] = convert(values[i])
+            dicts.append(dict(zip(keys, values)))
+        return dicts
+
+    def rows_to_json(self, rows):
+        # Datetimes are the only values json cannot encode, so let it call back for those
+        # instead of converting every row up front
+        keys = self.keys
+        return json.dumps([dict(zip(keys, row)) for row in rows], default=isoformat, separators=(",", ":")).encode()
+
+    def to_dict(self, obj):
+        return self.rows_to_dicts((self.getter(obj),))[0]
+
+    def to_dicts(self, objs):
+        return self.rows_to_dicts(map(self.getter, objs))
+
+    def to_json(self, objs):
+        return self.rows_to_json(map(self.getter, objs))
+
+serializers = {}
+
+def serializer(model):
+    """The model's Serializer, built on first use."""
+    s = serializers.get(model)
+    if s is None:
+        s = serializers[model] = Serializer(model)
+    return s
+
+# catalog.py
+def frozen_rows(model, *criteria):
+    s = serializer(model)
+    rows = db.session.execute(s.select().where(*criteria).order_by(model.id))
+    return [MappingProxyType(d) for d in s.rows_to_dicts(rows)]
+
+class Catalog(object):
+    """
+    Immutable snapshot of the puzzles in CATALOG_SECTIONS and their explanations.
+
+    Puzzles are keyed by section (ordered by Puzzle.order) and explanations by
+    (puzzle_id, move_num, protocol, mistake), mirroring the queries the routes used to run.
+    Each section's puzzle list is also kept JSON-encoded, with a strong ETag over the bytes,
+    both alone and bundled with the section's explanations for each protocol. Moves are judged
+    against solutions, keyed by (puzzle_id, move_num), holding the right move and the legal
+    moves of the position reached by playing the puzzle's moves up to move_num.
+    """
+    __slots__ = ("version", "puzzles", "sections", "explanations", "payloads", "solutions")
+
+    def __init__(self, version, puzzles, explanations):
+        self.version = version
+        self.puzzles = MappingProxyType({p["id"]: p for p in puzzles})
+        sections = {}
+        for p in sorted(puzzles, key=lambda p: (p["order"] is not None, p["order"] or 0)):
+            sections.setdefault(p["section"], []).append(p)
+        self.sections = MappingProxyType({k: tuple(v) for k, v in sections.items()})
+        keyed = {}
+        for e in explanations:
+            # Keep the first row for a key, as .first() did
+            keyed.setdefault((e["puzzle_id"], e["move_num"], e["protocol"], bool(e["mistake"])), e)
+        self.explanations = MappingProxyType(keyed)
+
+        payloads = {}
+        for section, rows in self.sections.items():
+            puzzle_dicts = [dict(p) for p in rows]
+            payloads[section, None] = encode_payload(puzzle_dicts)
+            ids = {p["id"] for p in rows}
+            for protocol in PROTOCOLS:
+                section_explanations = [
+                    dict(e) for (puzzle_id, _, e_protocol, _), e in keyed.items()
+                    if puzzle_id in ids and e_protocol == protocol
+                ]
+                payloads[section, protocol] = encode_payload({"puzzles": puzzle_dicts, "explanations": section_explanations})
+        self.payloads = MappingProxyType(payloads)
+        self.solutions = MappingProxyType(build_solutions(puzzles))
+
+    def section_puzzles(self, section):
+        return self.sections.get(section, ())
+
+    def section_payload(self, section, protocol=None):
+        """
+        (JSON bytes, ETag) for a section's puzzles, or for {"puzzles", "explanations"} when a
+        protocol is given. None for an unknown section.
+        """
+        return self.payloads.get((section, protocol))
+
+    def explanation(self, puzzle_id, move_num, protocol, mistake):
+        """The explanation row for a move, or None, as for ids that are not numbers."""
+        ids = int_ids(puzzle_id, move_num)
+        return self.explanations.get(ids + (protocol, bool(mistake))) if ids else None
+
+    def judge(self, puzzle_id, move_num, move):
+        """(mistake, legal) for a move played at a puzzle's move_num, or None if there is no such position."""
+        solution = self.solutions.get(int_ids(puzzle_id, move_num))
+        if solution is None:
+            return None
+        right, legal = solution
+        # The client sends from + to only and always promotes to a queen
+        move = move[:4]
+        return move != right, move in legal
+
+def int_ids(*ids):
+    """ids as a tuple of ints, or None if one is not a number. Ids may come from JSON payloads as strings."""
+    try:
+        return tuple(int(i) for i in ids)
+    except (TypeError, ValueError):
+        return None
+
+def build_solutions(puzzles):
+    """{(puzzle_id, move_num): (right move, frozenset of legal moves)}, moves as from + to squares."""
+    solutions = {}
+    for p in puzzles:
+        try:
+            pos = Position.from_fen(p["fen"])
+        except (ValueError, TypeError):
+            continue
+        for move_num, uci in enumerate((p["moves"] or "").split()):
+            legal = {move_to_uci(m): m for m in pos.legal_moves()}
+            solutions[p["id"], move_num] = (uci[:4], frozenset(u[:4] for u in legal))
+            # A solution move that is not legal leaves the rest of the line unreachable
+            if uci not in legal:
+                break
+            pos.make(legal[uci])
+    return solutions
+
+def encode_payload(obj):
+    body = json.dumps(obj, separators=(",", ":")).encode()
+    return body, hashlib.sha1(body).hexdigest()
+
+def current_catalog_version():
+    row = db.session.get(CatalogVersion, 1)
+    return row.version if row else 0
+
+def catalog_puzzle_ids():
+    """Subquery of the ids of the puzzles in CATALOG_SECTIONS, the only ones moves earn a bonus at."""
+    return db.select(Puzzle.id).where(Puzzle.section.in_(current_app.config["CATALOG_SECTIONS"]))
+
+def load_catalog(version=None):
+    if version is None:
+        version = current_catalog_version()
+    in_catalog = Puzzle.section.in_(current_app.config["CATALOG_SECTIONS"])
+    return Catalog(version, frozen_rows(Puzzle, in_catalog), frozen_rows(Explanation, Explanation.puzzle_id.in_(catalog_puzzle_ids())))
+
+class CatalogCache(object):
+    """
+    Holds the current Catalog and swaps in a rebuilt one when the version row changes.
+
+    Readers never see a partially built catalog: a new snapshot is built in full and then
+    replaces the old reference in a single assignment.
+    """
+    def __init__(self):
+        self.catalog = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def get(self):
+        catalog = self.catalog
+        interval = current_app.config["CATALOG_CHECK_INTERVAL"]
+        if catalog is not None and time.monotonic() - self.checked_at < interval:
+            return catalog
+        # Only one thread checks the version; the others keep serving the current snapshot meanwhile
+        if not self.lock.acquire(blocking=catalog is None):
+            return catalog
+        try:
+            if self.catalog is None or time.monotonic() - self.checked_at >= interval:
+                version = current_catalog_version()
+                if self.catalog is None or self.catalog.version != version:
+                    self.catalog = load_catalog(version)
+                self.checked_at = time.monotonic()
+            return self.catalog
+        finally:
+            self.lock.release()
+
+    def reload(self):
+        with self.lock:
+            self.catalog = load_catalog()
+            self.checked_at = time.monotonic()
+            return self.catalog
+
+catalog_cache = CatalogCache()
+
+def get_catalog():
+    return catalog_cache.get()
+
+def bump_catalog_version():
+    """Bump the catalog version so every worker rebuilds its puzzle catalog."""
+    begin_write()
+    row = db.session.get(CatalogVersion, 1)
+    if row is None:
+        row = CatalogVersion(id=1, version=0)
+        db.session.add(row)
+    row.version += 1
+    row.updated = datetime.now()
+    db.session.commit()
+    return catalog_cache.reload()
+
+@bp.cli.command("reload-catalog")
+def reload_catalog_command():
+    """Bump the catalog version so every worker rebuilds its puzzle catalog."""
+    catalog = bump_catalog_version()
+    print("Catalog version %d: %d puzzles, %d explanations" % (catalog.version, len(catalog.puzzles), len(catalog.explanations)))
+
+# telemetry.py
+def move_values(data, mturk_id, section_id, catalog):
+    client_mistake = data["mistake"]
+    verdict = catalog.judge(data["puzzle_id"], data["move_num"], data["move"])
+    mistake, legal = verdict if verdict is not None else (client_mistake, None)
+    if bool(mistake) != bool(client_mistake):
+        current_app.logger.warning(
+            "Move %s at puzzle %s move %s by %s judged mistake=%s, client said %s",
+            data["move"], data["puzzle_id"], data["move_num"], mturk_id, mistake, client_mistake
+        )
+    return dict(
+        mturk_id = mturk_id,
+        section_id = section_id,
+        puzzle_id = data["puzzle_id"],
+        move_num = data["move_num"],
+        move = data["move"],
+        start_time = datetime.fromtimestamp(data["move_start"]/1000),
+        end_time = datetime.fromtimestamp(data["move_end"]/1000),
+        duration = data["move_duration"],
+        mistake = mistake,
+        client_mistake = client_mistake,
+        legal = legal,
+        seq = data.get("seq")
+    )
+
+def record_moves(payload):
+    """
+    Insert a section's moves in one statement and copy the newest counters onto the Section.
+
+    Moves carrying a client seq that is already logged for the section are skipped, so a
+    retried batch (or a replayed spill file) is applied once. Each move is judged against the
+    catalog, and the bonus follows that verdict rather than the client's. Returns (accepted, duplicates).
+    """
+    section_id = payload["section_id"]
+    moves = payload["moves"]
+    seqs = [m["seq"] for m in moves if m.get("seq") is not None]
+    logged = set()
+    if seqs:
+        # One indexed read finds retried moves and whether a later batch already landed
+        logged = {seq for (seq,) in db.session.execute(
+            db.select(Move.seq).where(Move.section_id == section_id, Move.seq >= min(seqs))
+        )}
+    new_moves, accepted, duplicates = [], [], []
+    for m in moves:
+        seq = m.get("seq")
+        if seq is not None:
+            if seq in logged:
+                duplicates.append(seq)
+                continue
+            logged.add(seq)
+            accepted.append(seq)
+        new_moves.append(m)
+
+    if new_moves:
+        catalog = get_catalog()
+        values = [move_values(m, payload["mturk_id"], section_id, catalog) for m in new_moves]
+        db.session.execute(db.insert(Move), values)
+        update_bonuses(section_id, values, catalog)
+        last = new_moves[-1]
+        if last.get("seq") is None or last["seq"] == max(logged):
+            db.session.execute(
+                db.update(Section).where(Section.id == section_id)
+                .values(successes=last["successes"], num_puzzles=last["puzzles"])
+            )
+    return accepted, duplicates
+
+def update_bonuses(section_id, moves, catalog):
+    """Fold moves into their PuzzleBonus rows; moves at puzzles with no catalog entry earn no bonus."""
+    folds = []
+    for m in moves:
+        ids = int_ids(m["puzzle_id"])
+        if ids and ids[0] in catalog.puzzles:
+            folds.append((ids[0], m["mistake"]))
+    if not folds:
+        return
+    bonuses = {b.puzzle_id: b for b in PuzzleBonus.query.filter(
+        PuzzleBonus.section_id == section_id, PuzzleBonus.puzzle_id.in_({puzzle_id for puzzle_id, _ in folds})
+    )}
+    for puzzle_id, mistake in folds:
+        if puzzle_id not in bonuses:
+            bonuses[puzzle_id] = PuzzleBonus(section_id=section_id, puzzle_id=puzzle_id, correct=0, mistakes=0, bonus=PUZZLE_BONUS)
+            db.session.add(bonuses[puzzle_id])
+        bonuses[puzzle_id].fold(mistake)
+
+def record_theme_answer(payload):
+    data = payload["data"]
+    values = dict(
+        mturk_id = payload["mturk_id"],
+        puzzle_id = int(data["puzzle_id"]),
+        user_answer = data["user_answer"],
+        correct_answer = data["correct_answer"],
+        correct = bool(data["correct"]),
+        timestamp = datetime.fromtimestamp(payload["timestamp"])
+    )
+    # Changing an answer overwrites the participant's row for the puzzle
+    stmt = UPSERT_INSERTS[db.engine.dialect.name](ThemeAnswer).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["mturk_id", "puzzle_id"],
+        set_={k: stmt.excluded[k] for k in ("user_answer", "correct_answer", "correct", "timestamp")}
+    )
+    db.session.execute(stmt)
+    return "Logged successfully"
+
+def record_section_end(payload):
+    db.session.execute(
+        db.update(Section).where(Section.id == payload["section_id"])
+        .values(end_time=datetime.fromtimestamp(payload["end_time"]/1000), duration=payload["duration"])
+    )
+
+TELEMETRY_HANDLERS = {
+    "moves": record_moves,
+    "theme_answer": record_theme_answer,
+    "section_end": record_section_end,
+}
+
+class WriteBehind(object):
+    """
+    Bounded in-process queue of telemetry writes drained by a single writer thread.
+
+    The writer group-commits whatever arrived within WRITE_BEHIND_INTERVAL_MS, or as soon as
+    WRITE_BEHIND_BATCH_ROWS events are waiting. Every event is appended to a per-process spill
+    file before it is queued and a commit marker listing its id is appended once it is in the
+    database, so events from a crashed process are replayed by the next one to start, by the
+    server's master at startup, or by `flask replay-spills`. Once everything in it is committed, or
+    it grows past WRITE_BEHIND_SPILL_BYTES, the spill file is replaced by one holding only the events
+    still queued. Replay is at-least-once; sequenced moves are de-duplicated by (section_id, seq).
+    An event that cannot be committed is moved to the dead-letter file before it is acknowledged.
+    """
+    def __init__(self):
+        self.app = None
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.spill = None
+        self.spill_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.next_id = 0
+        # Queued events by id, and their count per mturk_id, until their commit is acknowledged
+        self.unacked = {}
+        self.unacked_counts = collections.Counter()
+        # SpillTail of each other process's spill file, read by uncommitted()
+        self.tails = {}
+        self.tails_lock = threading.Lock()
+
+    def submit(self, kind, payload):
+        """Queue a write, or apply and commit it here when write-behind is off."""
+        if not current_app.config["WRITE_BEHIND"]:
+            begin_write()
+            result = TELEMETRY_HANDLERS[kind](payload)
+            db.session.commit()
+            return result
+        self.start()
+        with self.spill_lock:
+            self.next_id += 1
+            event_id = self.next_id
+            self.unacked[event_id] = [event_id, kind, payload]
+            self.unacked_counts[payload.get("mturk_id")] += 1
+            self.spill.write(json.dumps([event_id, kind, payload]) + "\n")
+            self.spill.flush()
+        # Blocks while the queue is full, pushing back on request threads
+        self.queue.put((event_id, kind, payload))
+        return None
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is committed."""
+        if self.thread is None or self.pid != os.getpid():
+            return True
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def wait_committed(self, mturk_id, timeout):
+        """
+        Wait until no process, this one or another worker, holds uncommitted events for mturk_id,
+        replaying the spill files of processes that died meanwhile. False on timeout.
+        """
+        if not current_app.config["WRITE_BEHIND"]:
+            return True
+        self.start()
+        deadline = time.monotonic() + timeout
+        self.flush(timeout)
+        while True:
+            self.replay_spills()
+            if not self.uncommitted(mturk_id):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+
+    def uncommitted(self, mturk_id):
+        """
+        Number of events for mturk_id queued here or listed without a commit marker in another
+        process's spill file. Those files are read incrementally, from where the last call stopped.
+        """
+        own = None
+        count = 0
+        if self.thread is not None and self.pid == os.getpid():
+            own = self.spill_path(self.pid)
+            with self.spill_lock:
+                count = self.unacked_counts[mturk_id]
+        with self.tails_lock:
+            tails = {}
+            for path in glob.glob(self.spill_base() + ".*"):
+                if path == own or path.endswith(".tmp"):
+                    continue
+                tail = self.tails.get(path) or SpillTail()
+                try:
+                    tail.refresh(path)
+                except FileNotFoundError:
+                    continue # committed and removed, or claimed for replay, since the glob
+                tails[path] = tail
+                count += tail.counts[mturk_id]
+            self.tails = tails
+        return count
+
+    def start(self):
+        # Threads do not survive fork, so each worker process starts its own writer
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.app = current_app._get_current_object()
+            self.pid = os.getpid()
+            self.queue = queue.Queue(maxsize=self.app.config["WRITE_BEHIND_MAX_QUEUE"])
+            self.next_id = 0
+            self.unacked = {}
+            self.unacked_counts = collections.Counter()
+            self.replay_spills()
+            self.spill = open(self.spill_path(self.pid), "a")
+            self.spill.write(json.dumps(["spill", time.time_ns()]) + "\n")
+            self.spill.flush()
+            self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.spill.close()
+        if not self.unacked:
+            os.remove(self.spill_path(self.pid))
+
+    def spill_base(self):
+        return os.path.join(self.app.instance_path, self.app.config["WRITE_BEHIND_SPILL"])
+
+    def spill_path(self, pid):
+        return "%s.%d" % (self.spill_base(), pid)
+
+    def dead_letter_path(self):
+        return os.path.join(self.app.instance_path, self.app.config["WRITE_BEHIND_DEAD_LETTER"])
+
+    def recover(self, dead_letters=False):
+        """
+        Replay the spill files of dead processes without starting a writer, and with dead_letters
+        retry the dead-lettered events too. (replayed, dead-lettered) event counts.
+        """
+        if self.app is None:
+            self.app = current_app._get_current_object()
+        replayed = self.replay_spills()
+        if dead_letters:
+            claimed = "%s.retry-%d" % (self.dead_letter_path(), os.getpid())
+            try:
+                os.rename(self.dead_letter_path(), claimed)
+            except FileNotFoundError:
+                pass
+            else:
+                with open(claimed) as f:
+                    events = [json.loads(line)[:3] for line in f if line.strip()]
+                with self.app.app_context():
+                    self.apply(events)
+                os.remove(claimed)
+                replayed += len(events)
+        try:
+            with open(self.dead_letter_path()) as f:
+                dead = sum(1 for line in f if line.strip())
+        except FileNotFoundError:
+            dead = 0
+        return replayed, dead
+
+    def replay_spills(self):
+        """Commit the unacknowledged events of processes that died with a non-empty spill file."""
+        os.makedirs(self.app.instance_path, exist_ok=True)
+        replayed = 0
+        for path in glob.glob(self.spill_base() + ".*"):
+            # <base>.<pid> while live, <base>.<pid>.replay-<pid> while being replayed
+            pid = path.rsplit(".", 1)[-1].replace("replay-", "", 1)
+            if pid == "tmp":
+                # <base>.<pid>.tmp of a process that died while rotating; its spill file is still whole
+                pid = path.rsplit(".", 2)[-2]
+                if pid.isdigit() and not pid_alive(int(pid)):
+                    os.remove(path)
+                continue
+            if not pid.isdigit():
+                continue
+            # Another live process's file, or this process's own once its writer runs
+            if (int(pid) != self.pid and pid_alive(int(pid))) or (int(pid) == self.pid and self.thread is not None):
+                continue
+            claimed = "%s.replay-%d" % (path.split(".replay-")[0], os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            events, committed = read_spill(claimed)
+            events = [e for i, e in sorted(events.items()) if i not in committed]
+            with self.app.app_context():
+                self.apply(events)
+            os.remove(claimed)
+            replayed += len(events)
+        return replayed
+
+    def run(self):
+        interval = self.app.config["WRITE_BEHIND_INTERVAL_MS"] / 1000
+        batch_rows = self.app.config["WRITE_BEHIND_BATCH_ROWS"]
+        idle = self.app.config["SQLITE_CHECKPOINT_INTERVAL"]
+        stopping = False
+        while not stopping:
+            events, waiters = [], []
+            try:
+                item = self.queue.get(timeout=idle)
+            except queue.Empty:
+                # Quiet period: fold the WAL back into the database and reset it
+                with self.app.app_context():
+                    checkpoint_sqlite()
+                continue
+            deadline = time.monotonic() + interval
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    events.append(item)
+                if stopping or waiters or len(events) >= batch_rows:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if events:
+                with self.app.app_context():
+                    self.apply(events)
+                self.acknowledge([e[0] for e in events])
+            for w in waiters:
+                w.set()
+
+    def apply(self, events):
+        try:
+            begin_write()
+            for event_id, kind, payload in events:
+                TELEMETRY_HANDLERS[kind](payload)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Fall back to one commit per event so one bad event cannot sink the batch
+            for event_id, kind, payload in events:
+                try:
+                    begin_write()
+                    TELEMETRY_HANDLERS[kind](payload)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.exception("Dead-lettering %s event %s: %r", kind, event_id, payload)
+                    self.dead_letter(event_id, kind, payload, e)
+
+    def dead_letter(self, event_id, kind, payload, error):
+        # One write per line, so appends from several processes do not interleave
+        with open(self.dead_letter_path(), "a") as f:
+            f.write(json.dumps([event_id, kind, payload, repr(error), time.time()]) + "\n")
+
+    def acknowledge(self, event_ids):
+        with self.spill_lock:
+            for event_id in event_ids:
+                self.unacked_counts[self.unacked.pop(event_id)[2].get("mturk_id")] -= 1
+            if not self.unacked or self.spill.tell() >= self.app.config["WRITE_BEHIND_SPILL_BYTES"]:
+                self.rotate_spill()
+            else:
+                self.spill.write(json.dumps(["commit", event_ids]) + "\n")
+                self.spill.flush()
+
+    def rotate_spill(self):
+        """
+        Replace the spill file with one holding only the unacknowledged events; spill_lock must be held.
+        Each file opens with a ["spill", token] line, by which SpillTail tells a replaced file from the one it read.
+        """
+        path = self.spill_path(self.pid)
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps(["spill", time.time_ns()]) + "\n")
+            f.writelines(json.dumps(e) + "\n" for _, e in sorted(self.unacked.items()))
+        # Atomic, so a reader or a replay sees either the old file or the new one, whole
+        os.replace(path + ".tmp", path)
+        self.spill.close()
+        self.spill = open(path, "a")
+
+def read_spill(path):
+    """({event id: [id, kind, payload]}, committed ids) from a spill file."""
+    events, committed = {}, set()
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # torn final line
+            if record[0] == "commit":
+                committed.update(record[1])
+            elif record[0] != "spill":
+                events[record[0]] = record
+    return events, committed
+
+class SpillTail(object):
+    """
+    Uncommitted events per mturk_id in another process's spill file, brought up to date by reading
+    only the lines appended since the last refresh. A file whose first line changed was replaced by
+    a rotation and is read again from the start.
+    """
+    def __init__(self):
+        self.head = None
+        self.offset = 0
+        self.owners = {}
+        self.counts = collections.Counter()
+
+    def refresh(self, path):
+        with open(path, "rb") as f:
+            head = f.readline()
+            if head != self.head or os.fstat(f.fileno()).st_size < self.offset:
+                self.__init__()
+                self.head = head
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break # still being written; read again next time
+                self.offset += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record[0] == "commit":
+                    for event_id in record[1]:
+                        if event_id in self.owners:
+                            self.counts[self.owners.pop(event_id)] -= 1
+                elif record[0] != "spill":
+                    self.owners[record[0]] = record[2].get("mturk_id")
+                    self.counts[record[2].get("mturk_id")] += 1
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+write_behind = WriteBehind()
+atexit.register(write_behind.stop)
+
+# metrics.py
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Metrics(object):
+    """
+    Per-process request and SQL counters, rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latency = {} # endpoint -> [bucket counts..., sum, count]
+        self.statuses = {} # (endpoint, status) -> count
+        self.sql = {} # endpoint -> [statements, seconds]
+
+    def observe(self, endpoint, status, seconds, statements, sql_seconds):
+        with self.lock:
+            hist = self.latency.get(endpoint)
+            if hist is None:
+                hist = self.latency[endpoint] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+            self.statuses[endpoint, status] = self.statuses.get((endpoint, status), 0) + 1
+            sql = self.sql.setdefault(endpoint, [0, 0.0])
+            sql[0] += statements
+            sql[1] += sql_seconds
+
+    # SQLAlchemy engine events; statements outside a request (the write-behind writer,
+    # CLI commands) are booked under a "background" endpoint
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = getattr(self.local, "sql", None)
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+        else:
+            with self.lock:
+                sql = self.sql.setdefault("background", [0, 0.0])
+                sql[0] += 1
+                sql[1] += elapsed
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append("# HELP http_request_duration_seconds Request latency by endpoint.")
+            lines.append("# TYPE http_request_duration_seconds histogram")
+            for endpoint, hist in sorted(self.latency.items()):
+                for bound, count in zip(LATENCY_BUCKETS, hist):
+                    lines.append('http_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, bound, count))
+                lines.append('http_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d' % (endpoint, hist[-1]))
+                lines.append('http_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, hist[-2]))
+                lines.append('http_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, hist[-1]))
+            lines.append("# HELP http_requests_total Responses by endpoint and status code.")
+            lines.append("# TYPE http_requests_total counter")
+            for (endpoint, status), count in sorted(self.statuses.items()):
+                lines.append('http_requests_total{endpoint="%s",status="%s"} %d' % (endpoint, status, count))
+            lines.append("# HELP sql_statements_total SQL statements executed, by endpoint.")
+            lines.append("# TYPE sql_statements_total counter")
+            for endpoint, (statements, seconds) in sorted(self.sql.items()):
+                lines.append('sql_statements_total{endpoint="%s"} %d' % (endpoint, statements))
+            lines.append("# HELP sql_duration_seconds_total Time spent executing SQL, by endpoint.")
+            lines.append("# TYPE sql_duration_seconds_total counter")
+            for endpoint, (statements, seconds) in sorted(self.sql.items()):
+                lines.append('sql_duration_seconds_total{endpoint="%s"} %f' % (endpoint, seconds))
+        return "\n".join(lines) + "\n"
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware timing each request, from the call until the response body is closed.
+    """
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        stats = self.metrics.local.sql = [0, 0.0]
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(" ", 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            self.metrics.local.sql = None
+            self.metrics.observe(
+                environ.get("metrics.endpoint") or "unmatched", status[0] if status else "500",
+                time.perf_counter() - start, stats[0], stats[1]
+            )
+
+        try:
+            body = self.wsgi_app(environ, _start_response)
+        except Exception:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+metrics = Metrics()
+
+@bp.before_app_request
+def label_metrics_endpoint():
+    request.environ["metrics.endpoint"] = request.endpoint
+
+@bp.route("/metrics")
+def metrics_view():
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        abort(404)
+    given = request.headers.get("Authorization", "").replace("Bearer ", "", 1) or request.args.get("token", "")
+    # compare_digest refuses str with non-ASCII characters, so compare the UTF-8 bytes
+    if not hmac.compare_digest(given.encode(), token.encode()):
+        abort(403)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
 
 # vvv   APP ROUTES   vvv
 
 # Utility function to clear session data and logout
-@app.route("/clear_session_and_logout/")
+@bp.route("/clear_session_and_logout/")
 def clear_session_and_logout():
     logout_user()
     session.clear()
     flash("You have either run out of time or have violated the terms of the experiment.")
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
 
 def is_session_expired():
     expiry_time = session.get("expiry_time")
@@ -154,34 +1216,36 @@ def is_session_expired():
             return True
     return False
 
-@app.before_request
+@bp.before_app_request
 def check_session_expiry():
     if current_user.is_authenticated and is_session_expired():
         clear_session_and_logout()
     if session.get("failed_attention_checks") is not None and session.get("failed_attention_checks") >= 2:
         # Add to user model
-        user = User.query.filter_by(mturk_id=session["mturk_id"]).first()
+        begin_write()
+        user = db.session.get(User, session["mturk_id"])
         user.failed_attention_checks = True
         db.session.commit()
         clear_session_and_logout()
 
 # Index page
-@app.route("/")
+@bp.route("/")
 def index():
     if not current_user.is_authenticated or not session.get("login_completed"):
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     else:
-        return redirect(url_for("consent"))
+        return redirect(url_for("main.consent"))
 
 #Login page
-@app.route("/login/", methods=["GET", "POST"])
+@bp.route("/login/", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for("consent"))
+        return redirect(url_for("main.consent"))
 
     form = LoginForm()
     if form.validate_on_submit():
         mturk_id = form.mturk_id.data
+        begin_write()
         user = User.query.filter_by(mturk_id=mturk_id).first()
 
         if not user:
@@ -198,67 +1262,70 @@ def login():
             session["expiry_time"] = (datetime.now() + timedelta(minutes=45)).strftime("%Y-%m-%d %H:%M:%S")
             session["experiment_completed"] = False
 
-            return redirect(url_for("consent"))
+            return redirect(url_for("main.consent"))
         else:
             if user.experiment_completed:
                 flash("Error! You have already completed the experiment.")
             else:
                 flash("Error! MTurk ID already used. Contact the researchers if you believe this to be in error.")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
 
     return render_template("login.html", title="Sign In", form=form)
 
-@app.route("/consent/", methods=["GET", "POST"])
+@bp.route("/consent/", methods=["GET", "POST"])
 def consent():
     if not current_user.is_authenticated or session.get("consent") == True:
         clear_session_and_logout()
 
     return render_template("consent.html")
 
-@app.route("/consent/submit/", methods=["POST"])
+@bp.route("/consent/submit/", methods=["POST"])
 def consent_submit():
     if not current_user.is_authenticated or session.get("consent") == True:
         print("Not authenticated or consent already given")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     if request.method == "POST":
         if request.form.get("consent") == "True":
-            current_user.consent = True
+            begin_write()
+            user = current_user.load()
+            user.consent = True
             session["consent"] = True
-            db.session.commit()
             
             # Assign a random intervention condition
             session["protocol"] = choice(PROTOCOLS)
+            # The testing section resets session["protocol"], so keep the assigned one as a claim
+            session["user_protocol"] = session["protocol"]
             # Add to user model
-            user = User.query.filter_by(mturk_id=session["mturk_id"]).first()
             user.protocol = session["protocol"]
             db.session.commit()
             
             print("Protocol: " + str(session["protocol"]))
 
-            return redirect(url_for("demographics_survey"))
+            return redirect(url_for("main.demographics_survey"))
         else:
             print("Consent not given")
             return clear_session_and_logout()
 
-@app.route("/demographics_survey/", methods=["GET", "POST"])
+@bp.route("/demographics_survey/", methods=["GET", "POST"])
 def demographics_survey():
     if not current_user.is_authenticated or not session.get("consent"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     elif Survey.query.filter_by(mturk_id=session["mturk_id"], type="demographics").first():
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     else:
         session["demo_survey_loaded"] = True
         return render_template("demographics_survey.html")
 
-@app.route("/demographics_survey/submit/", methods=["POST"])
+@bp.route("/demographics_survey/submit/", methods=["POST"])
 def demographics_survey_submit():
     if not current_user.is_authenticated or not session.get("consent"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     # Check if the form was already submitted
+    begin_write()
     if Survey.query.filter_by(mturk_id=session["mturk_id"], type="demographics").first():
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     if request.method == "POST":
         
@@ -287,43 +1354,43 @@ def demographics_survey_submit():
         db.session.add(survey)
         db.session.commit()
         
-        return redirect(url_for("key_info"))
+        return redirect(url_for("main.key_info"))
 
-@app.route("/key_info/")
+@bp.route("/key_info/")
 @login_required
 def key_info():
     if not current_user.is_authenticated or not session.get("consent") == True:
         print("User not authenticated or consented.")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     return render_template("key_info.html")
 
-@app.route("/practice/")
+@bp.route("/practice/")
 @login_required
 def practice():
     if not current_user.is_authenticated or not session.get("consent") == True:
         print("User not authenticated or consented.")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     if session.get("practice_page_loaded"):
         print("User is reloading practice page.")
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
 
     session["practice_page_loaded"] = True
 
     session["section"] = "practice"
     return render_template("chess.html", section=session["section"], protocol=session["protocol"])
 
-@app.route("/testing/")
+@bp.route("/testing/")
 @login_required
 def testing():
     if not current_user.is_authenticated or not session.get("consent") == True:
         print("User not authenticated or consented.")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     if session.get("testing_page_loaded"):
         print("User is reloading testing page.")
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
 
     session["testing_page_loaded"] = True
 
@@ -331,8 +1398,8 @@ def testing():
     session["protocol"] = "none"
     return render_template("chess.html", section=session["section"], protocol=session["protocol"])
 
-@app.route("/get_puzzles/", methods=["POST"])
-def get_puzzles():
+@bp.route("/start_section/", methods=["POST"])
+def start_section():
     # Create section for the user
     sect = Section(
         mturk_id = session["mturk_id"],
@@ -345,89 +1412,108 @@ def get_puzzles():
     db.session.add(sect)
     db.session.commit()
     session["section_id"] = sect.id
+    return "", 204
 
-    puzzle_rows = Puzzle.query.filter_by(section=session["section"]).order_by(Puzzle.order).all()
-    puzzle_dicts = [row2dict(p) for p in puzzle_rows]
-    return jsonify(puzzle_dicts)
+@bp.route("/get_puzzles/<section>/")
+@login_required
+def get_puzzles(section):
+    # ?explanations=1 bundles the explanation rows for the protocol of the section being served
+    # (the testing section runs under "none" whatever the assigned one), so the client can explain
+    # moves without waiting on /log_move/
+    protocol = None
+    if request.args.get("explanations"):
+        protocol = session["protocol"] if "protocol" in session else current_user.protocol
+    payload = get_catalog().section_payload(section, protocol)
+    if payload is None:
+        abort(404)
+    body, etag = payload
+    response = current_app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    # Cache per participant, but revalidate every time so a catalog reload shows up
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+# Fields of a logged move that move_values reads
+MOVE_FIELDS = ("puzzle_id", "move_num", "move", "move_start", "move_end", "move_duration", "mistake", "successes", "puzzles")
+
+def is_move(m):
+    """Whether m is a move the writer can record, so a bad one is refused here rather than dead-lettered there."""
+    return (
+        isinstance(m, dict) and all(k in m for k in MOVE_FIELDS) and isinstance(m["move"], str)
+        and isinstance(m["puzzle_id"], int) and isinstance(m["move_num"], int)
+    )
 
-@app.route("/log_move/", methods=["POST"])
+@bp.route("/log_move/", methods=["POST"])
 def log_move():
-    data = request.get_json()
-    exp_row = Explanation.query.filter_by(
-        puzzle_id=data["puzzle_id"], move_num=data["move_num"],
-        protocol=session["protocol"], mistake=data["mistake"]
-    ).first()
-    exp_dict = row2dict(exp_row) if exp_row else None
-
-    sect = Section.query.get(session["section_id"])
-    sect.successes = data["successes"]
-    sect.num_puzzles = data["puzzles"]
-
-    move = Move(
-        mturk_id = session["mturk_id"],
-        section_id = session["section_id"],
-        puzzle_id = data["puzzle_id"],
-        move_num = data["move_num"],
-        move = data["move"],
-        start_time = datetime.fromtimestamp(data["move_start"]/1000),
-        end_time = datetime.fromtimestamp(data["move_end"]/1000),
-        duration = data["move_duration"],
-        mistake = data["mistake"]
+    # Explanations come with the section's puzzles, so there is nothing to send back
+    data = request.get_json(silent=True)
+    if "section_id" not in session:
+        abort(400, "No section started")
+    if not is_move(data) or not isinstance(data.get("seq"), (int, type(None))):
+        abort(400, "Expected a move with " + ", ".join(MOVE_FIELDS))
+    write_behind.submit("moves", {"mturk_id": session["mturk_id"], "section_id": session["section_id"], "moves": [data]})
+    return "", 204
+
+@bp.route("/log_moves/", methods=["POST"])
+def log_moves():
+    # Ordered batch of moves, each carrying the client's sequence number for the section
+    data = request.get_json(silent=True)
+    moves = data.get("moves") if isinstance(data, dict) else None
+    if "section_id" not in session:
+        abort(400, "No section started")
+    if not isinstance(moves, list) or not all(is_move(m) and isinstance(m.get("seq"), int) for m in moves):
+        abort(400, "Expected {\"moves\": [...]}, each move with a seq and " + ", ".join(MOVE_FIELDS))
+    moves = sorted(moves, key=lambda m: m["seq"])
+    result = write_behind.submit("moves", {"mturk_id": session["mturk_id"], "section_id": session["section_id"], "moves": moves})
+    if result is None:
+        # Queued: duplicates are dropped by the writer
+        return jsonify(queued=[m["seq"] for m in moves]), 202
+    accepted, duplicates = result
+    return jsonify(accepted=accepted, duplicates=duplicates)
+
+def is_theme_answer(a):
+    """Whether a is a theme answer record_theme_answer can store."""
+    return (
+        isinstance(a, dict) and isinstance(a.get("puzzle_id"), int) and isinstance(a.get("correct"), bool)
+        and isinstance(a.get("user_answer"), str) and isinstance(a.get("correct_answer"), str)
     )
-    db.session.add(move)
-    
-    db.session.commit()
-    return jsonify(exp_dict)
 
-@app.route("/log_theme_answer/", methods=["POST"])
+@bp.route("/log_theme_answer/", methods=["POST"])
 def log_theme_answer():
-    data = request.get_json()
-    surveys = Survey.query.filter_by(mturk_id=session["mturk_id"], type="theme_question").all()
-    for s in surveys:
-        if s.data["puzzle_id"] == data["puzzle_id"]:
-            s.data = data
-            s.timestamp = datetime.now()
-            db.session.commit()
-            return "Updated successfully"
-    survey = Survey(
-        mturk_id = session["mturk_id"],
-        type = "theme_question",
-        data = data,
-        timestamp = datetime.now()
-    )
-    db.session.add(survey)
-    db.session.commit()
-    return "Added successfully"
+    data = request.get_json(silent=True)
+    if not is_theme_answer(data):
+        abort(400, "Expected puzzle_id, user_answer, correct_answer and correct")
+    result = write_behind.submit("theme_answer", {"mturk_id": session["mturk_id"], "data": data, "timestamp": time.time()})
+    return result or "Logged successfully"
 
-@app.route("/log_section/", methods=["POST"])
+@bp.route("/log_section/", methods=["POST"])
 def log_section():
     data = request.get_json()
-    sect = Section.query.get(session["section_id"])
-    sect.end_time = datetime.fromtimestamp(data["end_time"]/1000)
-    sect.duration = data["duration"]
-    db.session.commit()
+    write_behind.submit("section_end", {"section_id": session["section_id"], "end_time": data["end_time"], "duration": data["duration"]})
     if session.get("section") == "testing":
-        return url_for("final_survey")
-    return url_for("testing")
+        return url_for("main.final_survey")
+    return url_for("main.testing")
 
-@app.route("/final_survey/", methods=["GET", "POST"])
+@bp.route("/final_survey/", methods=["GET", "POST"])
 def final_survey():
     if not current_user.is_authenticated or not session.get("consent"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     elif Survey.query.filter_by(mturk_id=session["mturk_id"], type="final_survey").first():
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     else:
         session["final_survey_loaded"] = True
-        return render_template("final_survey.html", protocol=User.query.filter_by(mturk_id=session["mturk_id"]).first().protocol)
+        return render_template("final_survey.html", protocol=current_user.protocol)
 
-@app.route("/final_survey/submit/", methods=["POST"])
+@bp.route("/final_survey/submit/", methods=["POST"])
 def final_survey_submit():
     if not current_user.is_authenticated or not session.get("consent"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     # Check if the form was already submitted
+    begin_write()
     if Survey.query.filter_by(mturk_id=session["mturk_id"], type="final_survey").first():
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     if request.method == "POST":
         
@@ -463,38 +1549,99 @@ def final_survey_submit():
 
         session["experiment_completed"] = True
         
-        return redirect(url_for("post_survey"))
+        return redirect(url_for("main.post_survey"))
 
 def calculate_bonus_comp(mturker):
     test_section = Section.query.filter_by(mturk_id=mturker, section="testing").first()
     if test_section:
-        user_moves = Move.query.filter_by(section_id=test_section.id).all()
-        if user_moves:
-            correct_moves = {}
-            bonuses = {}
-            for move in user_moves:
-                if move.puzzle_id not in correct_moves.keys():
-                    correct_moves[move.puzzle_id] = 0
-                if move.puzzle_id not in bonuses.keys():
-                    bonuses[move.puzzle_id] = .2
-                correct_moves[move.puzzle_id] += not move.mistake
-                bonuses[move.puzzle_id] = max(bonuses[move.puzzle_id] - move.mistake*.04, 0)
-            for k in correct_moves:
-                if correct_moves[k] < 2:
-                    bonuses[k] = 0.0
-            return sum(bonuses.values())
+        # Rows come back in the order each puzzle was first played, which fixes the summation order
+        bonuses = PuzzleBonus.query.filter_by(section_id=test_section.id).order_by(PuzzleBonus.id).all()
+        if bonuses:
+            return sum(b.payout() for b in bonuses)
     return 0.0
 
-@app.route("/post_survey/", methods=["GET", "POST"])
+def bonus_steps():
+    """Bonus left on a puzzle after 0, 1, 2, ... mistakes, down to 0, folded exactly as PuzzleBonus.fold does."""
+    steps = [PUZZLE_BONUS]
+    while steps[-1] > 0:
+        steps.append(max(steps[-1] - MISTAKE_PENALTY, 0))
+    return tuple(steps)
+
+BONUS_STEPS = bonus_steps()
+
+def bonus_after(mistakes):
+    """Bonus left on a puzzle after the given number of mistakes."""
+    return BONUS_STEPS[min(mistakes, len(BONUS_STEPS) - 1)]
+
+def payout_rows():
+    """
+    Yield (mturk_id, completion_code, protocol, base_comp, bonus_comp) for every completed User.
+
+    One grouped query over Move joined with each user's testing Section produces per-puzzle
+    counts of the moves at catalog puzzles; bonuses are then summed per user in first-played
+    order, as calculate_bonus_comp does.
+    Every join is an index lookup per user: the section through ix_section_mturk_id_section
+    (the first testing section only, like calculate_bonus_comp) and its moves through
+    ix_move_section_id_puzzle_id.
+    """
+    earlier = db.aliased(Section)
+    test_section = db.and_(
+        Section.mturk_id == User.mturk_id, Section.section == "testing",
+        ~db.select(earlier.id).where(
+            earlier.mturk_id == Section.mturk_id, earlier.section == "testing", earlier.id < Section.id
+        ).exists()
+    )
+    first_move = db.func.min(Move.id).label("first_move")
+    stmt = (
+        db.select(
+            User.mturk_id, User.completion_code, User.protocol, Move.puzzle_id,
+            db.func.sum(db.case((Move.mistake, 0), else_=1)).label("correct"),
+            db.func.sum(db.case((Move.mistake, 1), else_=0)).label("mistakes"),
+            first_move
+        )
+        .select_from(User)
+        .join(Section, test_section, isouter=True)
+        .join(Move, db.and_(Move.section_id == Section.id, Move.puzzle_id.in_(catalog_puzzle_ids())), isouter=True)
+        .where(User.experiment_completed)
+        .group_by(User.mturk_id, Move.puzzle_id)
+        .order_by(User.mturk_id, first_move)
+        .execution_options(yield_per=10000)
+    )
+    rows = db.session.execute(stmt)
+    for mturk_id, puzzles in itertools.groupby(rows, key=lambda r: r.mturk_id):
+        puzzles = list(puzzles)
+        bonus_comp = 0.0
+        if puzzles[0].puzzle_id is not None:
+            bonus_comp = sum(bonus_after(p.mistakes) if p.correct >= 2 else 0.0 for p in puzzles)
+        yield mturk_id, puzzles[0].completion_code, puzzles[0].protocol, BASE_COMP, bonus_comp
+
+def replay_bonuses(moves):
+    """Fold (section_id, puzzle_id, mistake) rows, ordered by move id, into fresh PuzzleBonus objects."""
+    bonuses = {}
+    for section_id, puzzle_id, mistake in moves:
+        key = (section_id, puzzle_id)
+        if key not in bonuses:
+            bonuses[key] = PuzzleBonus(section_id=section_id, puzzle_id=puzzle_id, correct=0, mistakes=0, bonus=PUZZLE_BONUS)
+        bonuses[key].fold(mistake)
+    return bonuses
+
+@bp.route("/post_survey/", methods=["GET", "POST"])
 def post_survey():
     if not current_user.is_authenticated or not session.get("consent") or not session.get("experiment_completed"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     else:
         session["post_survey_loaded"] = True
 
-        user = User.query.filter_by(mturk_id=session["mturk_id"]).first()
+        # The bonus is computed from moves, so wait for the participant's queued ones to land, in whichever
+        # worker took them. This has to happen before the request touches the database, so that it holds
+        # no lock the writers are waiting for. Paying before then would underpay for good, since the bonus
+        # is not recomputed once experiment_completed is set.
+        if not write_behind.wait_committed(session["mturk_id"], current_app.config["WRITE_BEHIND_PAYOUT_TIMEOUT"]):
+            return "Your answers are still being saved. Please reload this page in a few seconds.", 503, {"Retry-After": "2"}
+        begin_write()
+        user = current_user.load()
         if not user.experiment_completed:
-            base_comp = 2.5
+            base_comp = BASE_COMP
             session["base_comp"] = base_comp
             bonus_comp = calculate_bonus_comp(session["mturk_id"])
             session["bonus_comp"] = bonus_comp
@@ -511,14 +1658,15 @@ def post_survey():
 
         return render_template("post_survey.html", completion_code=session["completion_code"], base_comp=session["base_comp"], bonus_comp=session["bonus_comp"])
 
-@app.route("/post_survey/submit/", methods=["POST"])
+@bp.route("/post_survey/submit/", methods=["POST"])
 def post_survey_submit():
     if not current_user.is_authenticated or not session.get("consent"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     # Check if the form was already submitted
+    begin_write()
     if Survey.query.filter_by(mturk_id=session["mturk_id"], type="feedback").first():
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     
     if request.method == "POST":
         feedback = request.form.get("feedback")
@@ -531,13 +1679,754 @@ def post_survey_submit():
         db.session.add(survey)
         db.session.commit()
 
-        return redirect(url_for("thanks"))
+        return redirect(url_for("main.thanks"))
 
-@app.route("/thanks/")
+@bp.route("/thanks/")
 def thanks():
     if not current_user.is_authenticated or not session.get("consent") or not session.get("experiment_completed"):
-        return redirect(url_for("clear_session_and_logout"))
+        return redirect(url_for("main.clear_session_and_logout"))
     return render_template("thanks.html", completion_code=session["completion_code"], base_comp=session["base_comp"], bonus_comp=session["bonus_comp"])
 
+# export.py
+# Column kinds, from the SQLAlchemy type or from the JSON types seen in a survey field
+JSON_KINDS = {"integer": "int", "real": "float", "true": "bool", "false": "bool", "text": "str", "object": "json", "array": "json"}
+
+def column_kind(sqltype):
+    if isinstance(sqltype, db.Boolean):
+        return "bool"
+    if isinstance(sqltype, db.Integer):
+        return "int"
+    if isinstance(sqltype, (db.Float, db.Numeric)):
+        return "float"
+    if isinstance(sqltype, (db.DateTime, db.Date)):
+        return "datetime"
+    if isinstance(sqltype, JSON):
+        return "json"
+    return "str"
+
+def merge_kinds(kinds):
+    kinds = set(kinds) - {None}
+    if not kinds:
+        return "str"
+    if len(kinds) == 1:
+        return kinds.pop()
+    if kinds <= {"int", "float"}:
+        return "float"
+    return "str"
+
+class ExportColumn(object):
+    def __init__(self, name, kind, nullable=True):
+        self.name = name
+        self.kind = kind
+        self.nullable = nullable
+
+def table_columns(conn, table):
+    """Row count and ExportColumns for a table, from one aggregate query."""
+    columns = [ExportColumn(c.name, column_kind(c.type)) for c in table.columns]
+    # Row count, then the non-null count of each column
+    row = conn.execute(db.select(db.func.count(), *(db.func.count(c) for c in table.columns)).select_from(table)).one()
+    rows = row[0]
+    for column, present in zip(columns, row[1:]):
+        column.nullable = present < rows
+    return rows, columns
+
+SURVEY_FIELDS = db.text("""
+    SELECT s.type, j.key, j.type, COUNT(*)
+    FROM survey s, json_each(CASE json_type(s.data) WHEN 'array' THEN json_extract(s.data, '$[0]') ELSE s.data END) j
+    GROUP BY s.type, j.key, j.type
+""")
+
+def survey_columns(conn):
+    """{type: (row count, ExportColumns)} with the survey's own columns followed by its flattened data fields."""
+    counts = dict(conn.execute(db.select(Survey.type, db.func.count()).group_by(Survey.type)).all())
+    fields = {}
+    for survey_type, key, json_type, present in conn.execute(SURVEY_FIELDS):
+        # A bare JSON value (feedback text) becomes a single "data" column
+        field = fields.setdefault(survey_type, {}).setdefault(key or "data", {"kinds": [], "present": 0})
+        field["kinds"].append(JSON_KINDS.get(json_type))
+        field["present"] += present if json_type != "null" else 0
+    surveys = {}
+    for survey_type, rows in counts.items():
+        columns = [ExportColumn("id", "int", False), ExportColumn("mturk_id", "str", True), ExportColumn("timestamp", "datetime")]
+        for key, field in fields.get(survey_type, {}).items():
+            columns.append(ExportColumn(key, merge_kinds(field["kinds"]), field["present"] < rows))
+        surveys[survey_type] = (rows, columns)
+    return surveys
+
+def flatten_survey(data, keys):
+    """One survey payload as values for keys; legacy payloads were wrapped in a list."""
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if not isinstance(data, dict):
+        data = {"data": data}
+    return [data.get(key) for key in keys]
+
+class ParquetSink(object):
+    """Appends chunks to one Parquet file, a row group per chunk."""
+    def __init__(self, path, columns, rows):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        types = {"int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(),
+                 "datetime": pyarrow.timestamp("us"), "str": pyarrow.string(), "json": pyarrow.string()}
+        self.columns = columns
+        self.schema = pyarrow.schema([(c.name, types[c.kind]) for c in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path + ".parquet", self.schema)
+
+    def write(self, values):
+        arrays = [self.pa.array(coerce_column(c, v), type=t) for c, v, t in zip(self.columns, values, self.schema.types)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+class NpySink(object):
+    """
+    Writes one .npy file per column: the header, sized from the row count taken up front,
+    then each chunk appended as raw array data. String columns are fixed-width arrays as wide
+    as their longest value once coerced, which is only known at the end, so their values are
+    spooled to a temporary file, a JSON list per chunk, and written out on close().
+
+    Nullable ints and bools are stored as float64 with NaN, missing datetimes as NaT and
+    missing strings as "".
+    """
+    def __init__(self, path, columns, rows):
+        import numpy
+        from numpy.lib import format as npy_format
+        self.np = numpy
+        self.npy_format = npy_format
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.columns = columns
+        self.rows = rows
+        self.written = 0
+        # None for strings, whose width is not known yet
+        self.dtypes = [self.dtype(c) for c in columns]
+        self.widths = [1] * len(columns)
+        self.files = []
+        for column, dtype in zip(columns, self.dtypes):
+            self.files.append(tempfile.TemporaryFile("w+", encoding="utf-8") if dtype is None else self.open_column(column, dtype))
+
+    def dtype(self, column):
+        if column.kind in ("int", "bool"):
+            return self.np.dtype("float64" if column.nullable else ("int64" if column.kind == "int" else "bool"))
+        if column.kind == "float":
+            return self.np.dtype("float64")
+        if column.kind == "datetime":
+            return self.np.dtype("datetime64[us]")
+        return None
+
+    def open_column(self, column, dtype):
+        f = open(os.path.join(self.path, column.name + ".npy"), "wb")
+        self.npy_format.write_array_header_1_0(f, {"descr": self.npy_format.dtype_to_descr(dtype), "fortran_order": False, "shape": (self.rows,)})
+        return f
+
+    def write(self, values):
+        self.written += len(values[0])
+        if self.written > self.rows:
+            raise click.ClickException("More rows than counted; was the database written to mid-export?")
+        for i, (column, dtype, f, column_values) in enumerate(zip(self.columns, self.dtypes, self.files, values)):
+            column_values = coerce_column(column, column_values)
+            if dtype is None:
+                column_values = ["" if v is None else v for v in column_values]
+                self.widths[i] = max(self.widths[i], max(map(len, column_values), default=0))
+                f.write(json.dumps(column_values) + "\n")
+            else:
+                self.np.asarray(column_values, dtype=dtype).tofile(f)
+
+    def close(self):
+        for column, dtype, f, width in zip(self.columns, self.dtypes, self.files, self.widths):
+            if dtype is None:
+                f.seek(0)
+                dtype = self.np.dtype("U%d" % width)
+                with self.open_column(column, dtype) as out:
+                    for line in f:
+                        self.np.asarray(json.loads(line), dtype=dtype).tofile(out)
+            f.close()
+        self.files = []
+
+EXPORT_SINKS = {"parquet": ParquetSink, "npy": NpySink}
+
+def coerce_column(column, values):
+    if column.kind == "json":
+        return [None if v is None else json.dumps(v) for v in values]
+    if column.kind == "str":
+        return [v if v is None or isinstance(v, str) else json.dumps(v) for v in values]
+    if column.kind == "float":
+        return [None if v is None else float(v) for v in values]
+    return values
+
+def export_format(fmt):
+    if fmt != "auto":
+        return fmt
+    try:
+        import pyarrow.parquet
+        return "parquet"
+    except ImportError:
+        return "npy"
+
+def export_database(output, fmt="auto", chunk_rows=10000):
+    """
+    Stream every table into output as columnar files, survey rows split by type with their JSON
+    data flattened into columns. Memory is bounded by chunk_rows, not by table size.
+    """
+    sink_class = EXPORT_SINKS[export_format(fmt)]
+    os.makedirs(output, exist_ok=True)
+    # One read transaction, so counts and rows come from the same snapshot
+    with db.engine.connect() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name == "survey":
+                continue
+            rows, columns = table_columns(conn, table)
+            sink = sink_class(os.path.join(output, table.name), columns, rows)
+            result = conn.execute(db.select(table).order_by(*table.primary_key.columns).execution_options(yield_per=chunk_rows))
+            for chunk in result.partitions():
+                sink.write(list(zip(*chunk)))
+            sink.close()
+            yield table.name, rows
+
+        surveys = survey_columns(conn)
+        sinks = {t: sink_class(os.path.join(output, "survey_" + t), columns, rows) for t, (rows, columns) in surveys.items()}
+        keys = {t: [c.name for c in columns[3:]] for t, (rows, columns) in surveys.items()}
+        buffers = {t: [] for t in surveys}
+        result = conn.execute(
+            db.select(Survey.id, Survey.mturk_id, Survey.timestamp, Survey.type, Survey.data).order_by(Survey.id)
+            .execution_options(yield_per=chunk_rows)
+        )
+        for survey_id, mturk_id, timestamp, survey_type, data in result:
+            buffer = buffers[survey_type]
+            buffer.append([survey_id, mturk_id, timestamp] + flatten_survey(data, keys[survey_type]))
+            if len(buffer) >= chunk_rows:
+                sinks[survey_type].write(list(zip(*buffer)))
+                buffer.clear()
+        for survey_type, buffer in buffers.items():
+            if buffer:
+                sinks[survey_type].write(list(zip(*buffer)))
+            sinks[survey_type].close()
+            yield "survey_" + survey_type, surveys[survey_type][0]
+
+# importer.py
+# Columns of the Lichess puzzle database, for files older than the header row it now starts with
+LICHESS_COLUMNS = ["PuzzleId", "FEN", "Moves", "Rating", "RatingDeviation", "Popularity", "NbPlays", "Themes", "GameUrl", "OpeningTags"]
+DECOMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+def open_puzzle_csv(path):
+    """Text stream over a CSV file, decompressed on the fly by extension (.gz, .bz2, .xz, or .zst with zstandard)."""
+    if path.endswith(".zst"):
+        import zstandard
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    opener = DECOMPRESSORS.get(os.path.splitext(path)[1], open)
+    return opener(path, "rt", encoding="utf-8", newline="")
+
+def puzzle_hashes(puzzle):
+    """Zobrist hashes along a puzzle's line (see line_hashes), or None if its FEN or a move is bad."""
+    try:
+        return line_hashes(puzzle.fen, (puzzle.moves or "").split())
+    except (ValueError, AttributeError):
+        return None
+
+def position_rows(puzzle_id, hashes):
+    return [{"puzzle_id": puzzle_id, "move_num": n, "zobrist": h} for n, h in enumerate(hashes)]
+
+def puzzles_at_position(zobrist, sections=None):
+    """(puzzle_id, section, move_num) for every puzzle whose line passes through the position, by index."""
+    stmt = (
+        db.select(PuzzlePosition.puzzle_id, Puzzle.section, PuzzlePosition.move_num)
+        .join(Puzzle, Puzzle.id == PuzzlePosition.puzzle_id)
+        .where(PuzzlePosition.zobrist == zobrist)
+        .order_by(PuzzlePosition.puzzle_id, PuzzlePosition.move_num)
+    )
+    if sections:
+        stmt = stmt.where(Puzzle.section.in_(sections))
+    return db.session.execute(stmt).all()
+
+def lichess_rows(f, themes, min_rating=None, max_rating=None, solution_moves=3, counts=None):
+    """
+    (fen, moves, theme) for each CSV row that passes the cheap filters: rating, a theme in themes
+    (the first listed wins) and solution_moves moves after the opponent's opening one. Player moves
+    that underpromote are skipped too, since the client always promotes to a queen. Rows too short to
+    hold those columns, or with a non-numeric rating to filter on, are counted as malformed and skipped.
+    counts, if given, is updated with the rows read, malformed and matched.
+    """
+    if counts is None:
+        counts = collections.Counter()
+    reader = csv.reader(f)
+    first = next(reader, None)
+    if first is None:
+        return
+    if first and first[0] == "PuzzleId":
+        columns = first
+    else:
+        columns, reader = LICHESS_COLUMNS, itertools.chain([first], reader)
+    i_fen, i_moves, i_rating, i_themes = (columns.index(c) for c in ("FEN", "Moves", "Rating", "Themes"))
+    width = max(i_fen, i_moves, i_rating, i_themes) + 1
+    wanted = set(themes)
+    for row in reader:
+        counts["read"] += 1
+        if len(row) < width:
+            counts["malformed"] += 1
+            continue
+        if min_rating is not None or max_rating is not None:
+            try:
+                rating = int(row[i_rating])
+            except ValueError:
+                counts["malformed"] += 1
+                continue
+            if (min_rating is not None and rating < min_rating) or (max_rating is not None and rating > max_rating):
+                continue
+        moves = row[i_moves]
+        if moves.count(" ") != solution_moves:
+            continue
+        row_themes = wanted.intersection(row[i_themes].split())
+        if not row_themes:
+            continue
+        if any(len(uci) == 5 and uci[4] != "q" for uci in moves.split()[1::2]):
+            continue
+        counts["matched"] += 1
+        yield row[i_fen], moves, next(t for t in themes if t in row_themes)
+
+def convert_lichess_rows(rows):
+    """
+    (hashes, fen, moves, theme) for each (fen, moves, theme), or None where the FEN or a move is
+    not legal, hashes being the Zobrist hashes along the line. Lichess FENs are the position before
+    the opponent's move that sets the puzzle up, and that move comes first in Moves, so it is
+    played here and dropped.
+    """
+    converted = []
+    for fen, moves, theme in rows:
+        try:
+            pos = Position.from_fen(fen)
+        except ValueError:
+            converted.append(None)
+            continue
+        line = moves.split()
+        start, hashes = None, []
+        for uci in line:
+            move = pos.parse_uci(uci)
+            if move is None:
+                break
+            pos.make(move)
+            if start is None:
+                start = pos.fen()
+            hashes.append(pos.zobrist())
+        else:
+            converted.append((hashes, start, " ".join(line[1:]), theme))
+            continue
+        converted.append(None)
+    return converted
+
+def pool_map(executor, fn, chunks, window):
+    """fn(chunk) for each chunk on executor, in order, with at most window chunks in flight."""
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(executor.submit(fn, chunk))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def import_puzzles(path, section="library", themes=("fork", "pin"), min_rating=None, max_rating=None,
+                   solution_moves=3, batch_rows=20000, chunk_rows=5000, workers=None):
+    """
+    Stream a Lichess-format puzzle CSV into Puzzle rows of section, yielding running counts as
+    each chunk of rows is handled.
+
+    Rows are filtered as they are read, and the survivors are replayed for legality in chunks on a
+    process pool, with at most two chunks per worker in flight. Puzzles whose start position is
+    already in the table, or earlier in the file, are dropped by Zobrist hash; the hashes held for
+    that are the only state that grows with the file. Puzzles go in batch_rows to a transaction,
+    together with their PuzzlePosition rows.
+    """
+    counts = {"read": 0, "malformed": 0, "matched": 0, "illegal": 0, "duplicate": 0, "imported": 0}
+    seen = set()
+    for puzzle in db.session.execute(db.select(Puzzle.zobrist, Puzzle.fen, Puzzle.moves).execution_options(yield_per=batch_rows)):
+        # Puzzles entered by hand may not be hashed yet
+        hashes = [puzzle.zobrist] if puzzle.zobrist is not None else puzzle_hashes(puzzle)
+        if hashes:
+            seen.add(hashes[0])
+    order = db.session.scalar(db.select(db.func.max(Puzzle.order)).filter_by(section=section)) or 0
+    batch, lines = [], []
+
+    def flush():
+        if batch:
+            ids = db.session.scalars(db.insert(Puzzle).returning(Puzzle.id, sort_by_parameter_order=True), batch).all()
+            db.session.execute(db.insert(PuzzlePosition), [row for i, hashes in zip(ids, lines) for row in position_rows(i, hashes)])
+            db.session.commit()
+            counts["imported"] += len(batch)
+            batch.clear()
+            lines.clear()
+
+    with open_puzzle_csv(path) as f, ProcessPoolExecutor(workers) as executor:
+        rows = lichess_rows(f, themes, min_rating, max_rating, solution_moves, counts)
+        chunks = iter(lambda: list(itertools.islice(rows, chunk_rows)), [])
+        for converted in pool_map(executor, convert_lichess_rows, chunks, 2 * (workers or os.cpu_count() or 1)):
+            for puzzle in converted:
+                if puzzle is None:
+                    counts["illegal"] += 1
+                    continue
+                hashes, fen, moves, theme = puzzle
+                if hashes[0] in seen:
+                    counts["duplicate"] += 1
+                    continue
+                seen.add(hashes[0])
+                order += 1
+                batch.append({"fen": fen, "order": order, "moves": moves, "theme": theme, "section": section, "zobrist": hashes[0]})
+                lines.append(hashes)
+            if len(batch) >= batch_rows:
+                flush()
+            yield counts
+    flush()
+    yield counts
+
+# classifier.py
+def puzzle_chunks(stmt, chunk_rows):
+    """Lists of stmt's rows as tuples, chunk_rows at a time, paged by puzzle id so no cursor stays open between pages."""
+    last = 0
+    while True:
+        rows = db.session.execute(stmt.where(Puzzle.id > last).order_by(Puzzle.id).limit(chunk_rows)).all()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [tuple(row) for row in rows]
+
+def classify_puzzles(sections=None, relabel=False, batch_rows=20000, chunk_rows=5000, workers=None):
+    """
+    Label puzzles with the static motif detector of motifs.py on a process pool, writing
+    Puzzle.motif and motif_confidence batch_rows to a transaction and yielding running counts.
+    Only unlabelled puzzles are read unless relabel is set.
+    """
+    stmt = db.select(Puzzle.id, Puzzle.fen, Puzzle.moves)
+    if sections:
+        stmt = stmt.where(Puzzle.section.in_(sections))
+    if not relabel:
+        stmt = stmt.where(Puzzle.motif.is_(None))
+    counts = {"labelled": 0, "bad": 0}
+    batch = []
+
+    def flush():
+        if batch:
+            db.session.execute(db.update(Puzzle), batch)
+            db.session.commit()
+            batch.clear()
+
+    with ProcessPoolExecutor(workers) as executor:
+        chunks = puzzle_chunks(stmt, chunk_rows)
+        for labelled in pool_map(executor, classify_rows, chunks, 2 * (workers or os.cpu_count() or 1)):
+            for puzzle_id, motif, confidence in labelled:
+                if motif is None:
+                    counts["bad"] += 1
+                    continue
+                batch.append({"id": puzzle_id, "motif": motif, "motif_confidence": confidence})
+                counts["labelled"] += 1
+            if len(batch) >= batch_rows:
+                flush()
+            yield counts
+    flush()
+    yield counts
+
+# commands.py
+def route_statements():
+    """
+    [(endpoint, SQL, parameters)] for every statement the routes issue while one participant goes
+    through both sections, captured by capture_route_statements in a child process, against a scratch
+    database holding a copy of the catalog. The routes share the module's catalog cache, writer and
+    metrics, so running them here would leave this process's state changed.
+    """
+    catalog = get_catalog()
+    with tempfile.TemporaryDirectory() as scratch:
+        with open(os.path.join(scratch, "catalog.json"), "w") as f:
+            json.dump({
+                "version": catalog.version,
+                "puzzles": [dict(p) for p in catalog.puzzles.values()],
+                "explanations": [dict(e) for e in catalog.explanations.values()],
+            }, f)
+        # The routes print to stdout, which is the command's report
+        subprocess.run(
+            [sys.executable, "-c", "import app; app.capture_route_statements(%r)" % scratch],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, check=True
+        )
+        with open(os.path.join(scratch, "statements.json")) as f:
+            return [(endpoint, statement, tuple(parameters)) for endpoint, statement, parameters in json.load(f)]
+
+def capture_route_statements(scratch):
+    """
+    Walk one participant through both sections under the test client of an app on scratch/routes.db,
+    seeded from scratch/catalog.json, and write the statements to scratch/statements.json. Telemetry
+    is written inline, so the writer's statements are included, and the catalog is checked on every
+    request and reloaded by the first, so its queries are too.
+    """
+    with open(os.path.join(scratch, "catalog.json")) as f:
+        catalog = json.load(f)
+    statements = []
+    class ScratchConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(scratch, "routes.db")
+        WTF_CSRF_ENABLED = False
+        CATALOG_CHECK_INTERVAL = 0
+    app = create_app(ScratchConfig)
+    app.instance_path = scratch
+    with app.app_context():
+        db.create_all()
+        if catalog["puzzles"]:
+            db.session.execute(db.insert(Puzzle), catalog["puzzles"])
+        if catalog["explanations"]:
+            db.session.execute(db.insert(Explanation), catalog["explanations"])
+        db.session.add(CatalogVersion(id=1, version=catalog["version"] + 1, updated=datetime.now()))
+        db.session.commit()
+
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if has_request_context():
+                statements.append((request.endpoint, statement, parameters[0] if executemany else parameters))
+
+    client = app.test_client()
+    client.get("/login/")
+    client.post("/login/", data={"mturk_id": "QUERYPLANS"})
+    client.get("/consent/")
+    client.post("/consent/submit/", data={"consent": "True"})
+    client.get("/demographics_survey/")
+    client.post("/demographics_survey/submit/", data={"q1": "30", "q5": "4", "q6": "Beginner"})
+    client.get("/key_info/")
+    for section in ("practice", "testing"):
+        client.get("/%s/" % section)
+        client.post("/start_section/")
+        client.get("/get_puzzles/%s/" % section)
+        response = client.get("/get_puzzles/%s/?explanations=1" % section)
+        # A section without puzzles is a 404
+        puzzles = response.get_json()["puzzles"] if response.status_code == 200 else []
+        now = time.time() * 1000
+        for seq, p in enumerate(puzzles[:2]):
+            m = {"puzzle_id": p["id"], "move_num": 0, "move": (p["moves"] or "a1a2").split()[0], "move_start": now,
+                 "move_end": now, "move_duration": 0, "mistake": False, "successes": seq, "puzzles": seq}
+            client.post("/log_move/", json=dict(m, move="a1a2", mistake=True))
+            client.post("/log_moves/", json={"moves": [dict(m, seq=seq)]})
+            client.post("/log_theme_answer/", json={"puzzle_id": p["id"], "user_answer": p["theme"] or "", "correct_answer": p["theme"] or "", "correct": True})
+        client.post("/log_section/", json={"end_time": now, "duration": 0})
+    client.get("/final_survey/")
+    client.post("/final_survey/submit/", data={"q41": "7", "q42": "1"})
+    client.get("/post_survey/")
+    client.post("/post_survey/submit/", data={"feedback": "none"})
+    client.get("/thanks/")
+    with app.app_context():
+        db.engine.dispose()
+    with open(os.path.join(scratch, "statements.json"), "w") as f:
+        json.dump(statements, f)
+
+def query_plan(statement, parameters):
+    rows = db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+    return [r[-1] for r in rows]
+
+@bp.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Fail if a statement a route issues needs a full table scan in this database."""
+    failed, seen = [], set()
+    for endpoint, statement, parameters in route_statements():
+        if (endpoint, statement) in seen or statement.split(None, 1)[0].upper() not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            continue
+        seen.add((endpoint, statement))
+        plan = query_plan(statement, parameters)
+        if not plan:
+            continue # plain INSERTs have no plan
+        print("%-28s %s" % (endpoint, "; ".join(plan)))
+        if any(step.startswith("SCAN") for step in plan):
+            failed.append("%s: %s" % (endpoint, " ".join(statement.split())))
+    if failed:
+        raise click.ClickException("Full table scans in:\n" + "\n".join(failed))
+
+@bp.cli.command("replay-spills")
+@click.option("--dead-letters", is_flag=True, help="Also retry the events in the dead-letter file.")
+def replay_spills_command(dead_letters):
+    """Commit the telemetry left in the spill files of crashed or stopped workers."""
+    replayed, dead = write_behind.recover(dead_letters)
+    print("Replayed %d events; %d in the dead-letter file %s" % (replayed, dead, write_behind.dead_letter_path()))
+
+@bp.cli.command("checkpoint")
+def checkpoint_command():
+    """Checkpoint and truncate the SQLite write-ahead log."""
+    result = checkpoint_sqlite()
+    if result is None:
+        print("Not a WAL-mode SQLite database")
+    else:
+        print("busy=%d log=%d checkpointed=%d" % tuple(result))
+
+@bp.cli.command("payouts")
+@click.option("--output", "-o", default="-", help="CSV file to write, stdout by default.")
+def payouts_command(output):
+    """Write base and bonus compensation for every completed participant as CSV."""
+    with click.open_file(output, "w") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["mturk_id", "completion_code", "protocol", "base_comp", "bonus_comp", "compensation"])
+        for mturk_id, completion_code, protocol, base_comp, bonus_comp in payout_rows():
+            writer.writerow([mturk_id, completion_code, protocol, base_comp, bonus_comp, base_comp + bonus_comp])
+
+@bp.cli.command("reconcile-bonuses")
+@click.option("--fix", is_flag=True, help="Rewrite the puzzle_bonus table from the move table.")
+def reconcile_bonuses_command(fix):
+    """Recompute per-puzzle bonus aggregates from Move and report drift."""
+    if fix:
+        # Nothing may land between reading the moves and rewriting the aggregates
+        begin_write()
+    moves = db.session.execute(
+        db.select(Move.section_id, Move.puzzle_id, Move.mistake).where(Move.puzzle_id.in_(catalog_puzzle_ids()))
+        .order_by(Move.section_id, Move.id).execution_options(yield_per=10000)
+    )
+    expected = replay_bonuses(moves)
+    stored = {(b.section_id, b.puzzle_id): b for b in PuzzleBonus.query}
+
+    drift = 0
+    for key in sorted(set(expected) | set(stored), key=lambda k: (k[0] or 0, k[1] or 0)):
+        e, s = expected.get(key), stored.get(key)
+        want = (e.correct, e.mistakes, e.bonus) if e else None
+        have = (s.correct, s.mistakes, s.bonus) if s else None
+        if want != have:
+            drift += 1
+            if drift <= 20:
+                print("section %s puzzle %s: stored %s, moves give %s" % (key[0], key[1], have, want))
+    print("%d of %d puzzle aggregates drifted" % (drift, len(expected)))
+
+    if fix and drift:
+        # Recreate in move order so ids keep first-played order per section
+        db.session.execute(db.delete(PuzzleBonus))
+        db.session.add_all(expected.values())
+        db.session.commit()
+        print("Rewrote %d puzzle aggregates" % len(expected))
+
+@bp.cli.command("export")
+@click.option("--output", "-o", default="export", help="Directory to write into.")
+@click.option("--format", "fmt", type=click.Choice(["auto", "parquet", "npy"]), default="auto",
+              help="Parquet needs pyarrow; npy (one file per column) needs numpy. auto prefers Parquet.")
+@click.option("--chunk-rows", default=10000, help="Rows read and written at a time.")
+def export_command(output, fmt, chunk_rows):
+    """Stream every table to columnar files for analysis, with survey JSON flattened by type."""
+    try:
+        for name, rows in export_database(output, fmt, chunk_rows):
+            print("%-24s %8d rows" % (name, rows))
+    except ImportError as e:
+        raise click.ClickException("%s (install pyarrow for Parquet or numpy for .npy)" % e)
+
+@bp.cli.command("import-puzzles")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--section", default="library", help="Section the puzzles are filed under; outside CATALOG_SECTIONS they are not served.")
+@click.option("--themes", default="fork,pin", help="Comma-separated Lichess themes to keep, in order of preference.")
+@click.option("--min-rating", type=int, default=None)
+@click.option("--max-rating", type=int, default=None)
+@click.option("--solution-moves", default=3, help="Moves after the opponent's opening one; the study's puzzles have 3.")
+@click.option("--batch-rows", default=20000, help="Puzzles inserted per transaction.")
+@click.option("--workers", type=int, default=None, help="Processes checking moves, one per core by default.")
+def import_puzzles_command(path, section, themes, min_rating, max_rating, solution_moves, batch_rows, workers):
+    """Stream a Lichess puzzle CSV (optionally .gz, .bz2, .xz or .zst) into the puzzle table."""
+    start = last = time.monotonic()
+    line = "%(read)d read, %(malformed)d malformed, %(matched)d matched, %(illegal)d illegal, %(duplicate)d duplicate, %(imported)d imported"
+    try:
+        for counts in import_puzzles(path, section, themes.split(","), min_rating, max_rating, solution_moves, batch_rows, workers=workers):
+            if time.monotonic() - last >= 1:
+                last = time.monotonic()
+                print(line % counts + " (%.0f rows/s)" % (counts["read"] / (last - start)))
+    except ImportError as e:
+        raise click.ClickException("%s (install zstandard or decompress the file first)" % e)
+    print(line % counts + " in %.1fs" % (time.monotonic() - start))
+    if counts["imported"] and section in current_app.config["CATALOG_SECTIONS"]:
+        catalog = bump_catalog_version()
+        print("Catalog version %d: %d puzzles" % (catalog.version, len(catalog.puzzles)))
+
+@bp.cli.command("index-positions")
+@click.option("--all", "rehash", is_flag=True, help="Rehash every puzzle, not only those without a hash.")
+@click.option("--batch-rows", default=10000, help="Puzzles hashed per transaction.")
+def index_positions_command(rehash, batch_rows):
+    """Store Zobrist hashes for puzzles added without them, such as puzzles entered by hand."""
+    stmt = db.select(Puzzle.id, Puzzle.fen, Puzzle.moves).order_by(Puzzle.id)
+    if not rehash:
+        stmt = stmt.where(Puzzle.zobrist.is_(None))
+    # Ids first, so the updates below do not disturb the rows still being read
+    puzzles = db.session.execute(stmt).all()
+    hashed = 0
+    for start in range(0, len(puzzles), batch_rows):
+        chunk = puzzles[start:start + batch_rows]
+        ids = [p.id for p in chunk]
+        db.session.execute(db.delete(PuzzlePosition).where(PuzzlePosition.puzzle_id.in_(ids)))
+        updates, positions = [], []
+        for p in chunk:
+            hashes = puzzle_hashes(p)
+            if hashes is None:
+                print("puzzle %d: bad FEN or illegal move in %r" % (p.id, p.moves))
+            updates.append({"id": p.id, "zobrist": hashes[0] if hashes else None})
+            positions += position_rows(p.id, hashes or [])
+            hashed += hashes is not None
+        db.session.execute(db.update(Puzzle), updates)
+        if positions:
+            db.session.execute(db.insert(PuzzlePosition), positions)
+        db.session.commit()
+    print("Hashed %d of %d puzzles" % (hashed, len(puzzles)))
+
+@bp.cli.command("find-position")
+@click.argument("fen")
+@click.option("--section", "sections", multiple=True, help="Only puzzles in this section; repeatable.")
+def find_position_command(fen, sections):
+    """List the puzzles whose line passes through FEN's position, move counters aside."""
+    try:
+        zobrist = Position.from_fen(fen).zobrist()
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="FEN")
+    matches = puzzles_at_position(zobrist, sections)
+    for puzzle_id, section, move_num in matches:
+        print("puzzle %d (%s) at move %d" % (puzzle_id, section, move_num))
+    print("%d matches for position %d" % (len(matches), zobrist))
+
+@bp.cli.command("classify-puzzles")
+@click.option("--section", "sections", multiple=True, help="Only puzzles in this section; repeatable.")
+@click.option("--relabel", is_flag=True, help="Label every puzzle again, not only unlabelled ones.")
+@click.option("--batch-rows", default=20000, help="Labels written per transaction.")
+@click.option("--workers", type=int, default=None, help="Processes labelling puzzles, one per core by default.")
+def classify_puzzles_command(sections, relabel, batch_rows, workers):
+    """Label puzzles fork, pin, skewer or other with a confidence, and compare with their themes."""
+    start = last = time.monotonic()
+    line = "%(labelled)d labelled, %(bad)d with a bad FEN or line"
+    for counts in classify_puzzles(sections, relabel, batch_rows, workers=workers):
+        if time.monotonic() - last >= 1:
+            last = time.monotonic()
+            print(line % counts + " (%.0f puzzles/s)" % (counts["labelled"] / (last - start)))
+    elapsed = time.monotonic() - start
+    print(line % counts + " in %.1fs (%.0f puzzles/s)" % (elapsed, counts["labelled"] / elapsed if elapsed else 0))
+
+    scope = Puzzle.section.in_(sections) if sections else db.true()
+    print("\n%-8s %-8s %8s" % ("theme", "motif", "puzzles"))
+    for theme, motif, n in db.session.execute(
+        db.select(Puzzle.theme, Puzzle.motif, db.func.count()).where(scope).group_by(Puzzle.theme, Puzzle.motif)
+    ):
+        print("%-8s %-8s %8d" % (theme, motif, n))
+    # The testing section asks participants for the theme, so a mislabelled study puzzle matters most
+    for p in db.session.scalars(
+        db.select(Puzzle).where(Puzzle.section.in_(current_app.config["CATALOG_SECTIONS"]), Puzzle.motif != Puzzle.theme).order_by(Puzzle.id)
+    ):
+        print("puzzle %d (%s): theme %s, detector says %s (%.2f)" % (p.id, p.section, p.theme, p.motif, p.motif_confidence))
+
+# __init__.py
+def create_app(config=None):
+    """
+    Build the application. config is a config class or its name in this module, APP_CONFIG
+    (default DevelopmentConfig) when omitted.
+    """
+    if config is None:
+        config = os.environ.get("APP_CONFIG", "DevelopmentConfig")
+    if isinstance(config, str):
+        config = globals()[config]
+
+    app = Flask(__name__)
+    #Configuration of application, see configuration.py
+    app.config.from_object(config)
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    lm.init_app(app)
+    app.register_blueprint(bp)
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            configure_sqlite(db.engine, app.config["SQLITE_PRAGMAS"], app.config["SQLITE_BEGIN"])
+        event.listen(db.engine, "before_cursor_execute", metrics.before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", metrics.after_cursor_execute)
+    return app
+
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
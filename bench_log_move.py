@@ -0,0 +1,109 @@
+"""
+Concurrent /log_move/ throughput under each database profile.
+
+Every run starts from a fresh SQLite file seeded with the puzzle catalog, then --processes worker
+processes with --threads participants each post --moves synchronous /log_move/ requests
+(write-behind off, so every request commits). Runs once per config and prints a comparison.
+
+    python bench_log_move.py --processes 4 --threads 8 --moves 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONFIGS = ["DevelopmentConfig", "ProductionConfig"]
+
+def worker(args):
+    from app import create_app
+    app = create_app()
+    app.config["WRITE_BEHIND"] = args.write_behind
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+
+    clients = []
+    for t in range(args.threads):
+        client = app.test_client()
+        client.post("/login/", data={"mturk_id": "B%d-%d" % (os.getpid(), t)})
+        client.post("/consent/submit/", data={"consent": "True"})
+        client.get("/practice/")
+        client.post("/start_section/")
+        puzzles = client.get("/get_puzzles/practice/").get_json()
+        clients.append((client, puzzles))
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads + 1)
+
+    def participant(client, puzzles):
+        mine, failed = [], 0
+        barrier.wait()
+        for n in range(args.moves):
+            puzzle = puzzles[n % len(puzzles)] if puzzles else {"id": 1}
+            now = time.time() * 1000
+            start = time.perf_counter()
+            response = client.post("/log_move/", json={
+                "puzzle_id": puzzle["id"], "move_num": 0, "move": "a1a2", "move_start": now - 500, "move_end": now,
+                "move_duration": 500, "mistake": n % 3 == 0, "successes": 0, "puzzles": n // 3
+            })
+            response.close()
+            mine.append(time.perf_counter() - start)
+            failed += response.status_code >= 400
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=participant, args=c) for c in clients]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    from app import write_behind
+    write_behind.flush()
+    print(json.dumps({"seconds": time.perf_counter() - start, "latencies": latencies, "errors": sum(errors)}))
+
+def run_config(config, args, workdir):
+    path = os.path.join(workdir, "%s.db" % config)
+    env = dict(os.environ, APP_CONFIG=config, DATABASE_URL="sqlite:///" + path)
+    subprocess.run([sys.executable, "-c", (
+        "import loadtest, app\n"
+        "with app.create_app().app_context(): app.db.create_all()\n"
+        "loadtest.seed_database(%r, %r)" % (args.source, path)
+    )], env=env, check=True, stdout=subprocess.DEVNULL)
+    command = [sys.executable, __file__, "--worker", "--threads", str(args.threads), "--moves", str(args.moves)]
+    if args.write_behind:
+        command.append("--write-behind")
+    procs = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) for _ in range(args.processes)]
+    results = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+    latencies = sorted(l for r in results for l in r["latencies"])
+    seconds = max(r["seconds"] for r in results)
+    pct = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000
+    return len(latencies) / seconds, pct(.5), pct(.99), sum(r["errors"] for r in results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", default=os.path.join("instance", "application.db"), help="database to copy the puzzle catalog from")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="participants per process")
+    parser.add_argument("--moves", type=int, default=200, help="moves per participant")
+    parser.add_argument("--write-behind", action="store_true", help="queue moves instead of committing in the request")
+    parser.add_argument("--config", action="append", help="config class to run (repeatable); defaults to %s" % ", ".join(CONFIGS))
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return worker(args)
+
+    print("%d processes x %d threads x %d moves, write-behind %s" % (args.processes, args.threads, args.moves, "on" if args.write_behind else "off"))
+    print("%-20s %10s %9s %9s %7s" % ("config", "moves/s", "p50 ms", "p99 ms", "errors"))
+    with tempfile.TemporaryDirectory() as workdir:
+        for config in args.config or CONFIGS:
+            print("%-20s %10.1f %9.2f %9.2f %7d" % ((config,) + run_config(config, args, workdir)))
+
+if __name__ == "__main__":
+    main()
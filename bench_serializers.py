@@ -0,0 +1,70 @@
+"""
+Microbenchmarks for the model serializers against the old row2dict.
+
+Copies the puzzle, explanation and move tables from --source into a scratch database, then times
+each way of turning a full result set into dicts and into JSON bytes:
+
+    row2dict         ORM objects through the old str()-everything helper (the baseline)
+    to_dicts         ORM objects through the model's Serializer
+    rows_to_dicts    raw row tuples from Serializer.select(), no ORM objects built
+    rows_to_json     raw row tuples straight to JSON bytes
+
+Query time is included for every path, since skipping ORM hydration is part of the win.
+
+    python bench_serializers.py --repeat 5
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import timeit
+
+def row2dict(r):
+    return {c.name: str(getattr(r, c.name)) for c in r.__table__.columns}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", default=os.path.join("instance", "application.db"), help="database to copy rows from")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case; the best is reported")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-serializers-")
+    path = os.path.join(workdir, "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    from app import create_app, db, serializer, Puzzle, Explanation, Move
+    from loadtest import seed_database
+    app = create_app()
+    try:
+        with app.app_context():
+            db.create_all()
+            seed_database(args.source, path, ("puzzle", "explanation", "move"))
+
+            cases = [
+                ("row2dict", lambda model: [row2dict(r) for r in db.session.scalars(db.select(model))]),
+                ("to_dicts", lambda model: serializer(model).to_dicts(db.session.scalars(db.select(model)))),
+                ("rows_to_dicts", lambda model: serializer(model).rows_to_dicts(db.session.execute(serializer(model).select()))),
+                ("row2dict + json", lambda model: json.dumps([row2dict(r) for r in db.session.scalars(db.select(model))]).encode()),
+                ("rows_to_json", lambda model: serializer(model).rows_to_json(db.session.execute(serializer(model).select()))),
+            ]
+            print("%-12s %7s  %-16s %10s %10s %8s" % ("model", "rows", "path", "ms", "us/row", "speedup"))
+            for model in (Puzzle, Explanation, Move):
+                rows = db.session.scalar(db.select(db.func.count()).select_from(model))
+                baseline = {}
+                for name, run in cases:
+                    def once():
+                        run(model)
+                        # Drop the identity map so every run hydrates from scratch
+                        db.session.expunge_all()
+                    best = min(timeit.repeat(once, number=1, repeat=args.repeat))
+                    base = baseline.setdefault("json" if "json" in name else "dicts", best)
+                    print("%-12s %7d  %-16s %10.2f %10.2f %7.1fx" % (
+                        model.__name__, rows, name, best * 1000, best / max(rows, 1) * 1e6, base / best
+                    ))
+    finally:
+        from app import write_behind
+        write_behind.stop()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
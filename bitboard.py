@@ -0,0 +1,473 @@
+"""
+Chess positions and legal move generation on bitboards.
+
+Squares run from 0 (a1) to 63 (h8), and a bitboard is an int with bit n set for square n. A move is
+an int that packs the from-square, to-square, promotion piece and a flag for the special moves.
+Knight, king and pawn attacks come from tables built at import. Sliding attacks are classical ray
+lookups cut at the first blocker. Position.make() and unmake() change the position in place and
+keep what unmake needs on a stack, so a search never copies a position. Position.zobrist() hashes a
+position to 64 bits, move counters aside, so the same position always gets the same key.
+
+    pos = Position.from_fen(puzzle.fen)
+    move = pos.parse_uci("e2e4")   # None unless the move is legal here
+    pos.make(move)
+    pos.unmake()
+"""
+import hashlib
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+PIECE_SYMBOLS = "pnbrqk"
+EMPTY = -1
+# Move flags, stored above the promotion piece
+NORMAL, DOUBLE_PUSH, EN_PASSANT, CASTLING = range(4)
+
+FULL = (1 << 64) - 1
+RANK_1, RANK_3, RANK_6, RANK_8 = 0xFF, 0xFF << 16, 0xFF << 40, 0xFF << 56
+SQUARE_NAMES = [f + r for r in "12345678" for f in "abcdefgh"]
+SQUARES = {name: sq for sq, name in enumerate(SQUARE_NAMES)}
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+CASTLING_SYMBOLS = (("K", WHITE_KINGSIDE), ("Q", WHITE_QUEENSIDE), ("k", BLACK_KINGSIDE), ("q", BLACK_QUEENSIDE))
+# Rights kept when a move touches a square: moving a king or rook, or capturing a rook, loses them
+CASTLING_MASK = [15] * 64
+for square, lost in (("a1", WHITE_QUEENSIDE), ("e1", WHITE_KINGSIDE | WHITE_QUEENSIDE), ("h1", WHITE_KINGSIDE),
+                     ("a8", BLACK_QUEENSIDE), ("e8", BLACK_KINGSIDE | BLACK_QUEENSIDE), ("h8", BLACK_KINGSIDE)):
+    CASTLING_MASK[SQUARES[square]] &= ~lost
+# King destination -> (right, rook from, rook to, squares that must be empty, squares that must not be attacked)
+CASTLES = {
+    SQUARES["g1"]: (WHITE_KINGSIDE, SQUARES["h1"], SQUARES["f1"], ("f1", "g1"), ("e1", "f1", "g1")),
+    SQUARES["c1"]: (WHITE_QUEENSIDE, SQUARES["a1"], SQUARES["d1"], ("b1", "c1", "d1"), ("e1", "d1", "c1")),
+    SQUARES["g8"]: (BLACK_KINGSIDE, SQUARES["h8"], SQUARES["f8"], ("f8", "g8"), ("e8", "f8", "g8")),
+    SQUARES["c8"]: (BLACK_QUEENSIDE, SQUARES["a8"], SQUARES["d8"], ("b8", "c8", "d8"), ("e8", "d8", "c8")),
+}
+CASTLES = {
+    to: (right, rook_from, rook_to, sum(1 << SQUARES[s] for s in empty), [SQUARES[s] for s in safe])
+    for to, (right, rook_from, rook_to, empty, safe) in CASTLES.items()
+}
+KING_START = (SQUARES["e1"], SQUARES["e8"])
+
+def _leaper(offsets):
+    table = []
+    for sq in range(64):
+        file, rank = sq & 7, sq >> 3
+        bb = 0
+        for df, dr in offsets:
+            if 0 <= file + df < 8 and 0 <= rank + dr < 8:
+                bb |= 1 << ((rank + dr) * 8 + file + df)
+        table.append(bb)
+    return table
+
+def _ray(df, dr):
+    table = []
+    for sq in range(64):
+        file, rank = (sq & 7) + df, (sq >> 3) + dr
+        bb = 0
+        while 0 <= file < 8 and 0 <= rank < 8:
+            bb |= 1 << (rank * 8 + file)
+            file, rank = file + df, rank + dr
+        table.append(bb)
+    return table
+
+KNIGHT_ATTACKS = _leaper([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = _leaper([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+# Squares a pawn of each color on a square attacks
+PAWN_ATTACKS = (_leaper([(-1, 1), (1, 1)]), _leaper([(-1, -1), (1, -1)]))
+# Rays toward higher squares are cut at their lowest blocker, rays toward lower squares at their highest
+NORTH, EAST, NORTH_EAST, NORTH_WEST = _ray(0, 1), _ray(1, 0), _ray(1, 1), _ray(-1, 1)
+SOUTH, WEST, SOUTH_EAST, SOUTH_WEST = _ray(0, -1), _ray(-1, 0), _ray(1, -1), _ray(-1, -1)
+
+def _zobrist_keys(name, count):
+    # Derived from a hash rather than a seeded PRNG so the keys, and every stored hash, never change
+    return [int.from_bytes(hashlib.blake2b(b"%s %d" % (name, i), digest_size=8).digest(), "big") for i in range(count)]
+
+# Zobrist keys: one per (piece, square), castling right and en passant file, and one for black to move
+ZOBRIST_PIECES = [_zobrist_keys(b"piece %d" % piece, 64) for piece in range(12)]
+ZOBRIST_CASTLING = dict(zip((right for _, right in CASTLING_SYMBOLS), _zobrist_keys(b"castling", 4)))
+ZOBRIST_EP_FILE = _zobrist_keys(b"en passant", 8)
+ZOBRIST_BLACK = _zobrist_keys(b"black", 1)[0]
+
+def bishop_attacks(sq, occupied):
+    attacks = 0
+    for rays in (NORTH_EAST, NORTH_WEST):
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in (SOUTH_EAST, SOUTH_WEST):
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+def rook_attacks(sq, occupied):
+    attacks = 0
+    for rays in (NORTH, EAST):
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in (SOUTH, WEST):
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+def squares(bb):
+    """Square numbers of the set bits, lowest first."""
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+def make_move(frm, to, promotion=0, flag=NORMAL):
+    return frm | to << 6 | promotion << 12 | flag << 15
+
+def move_to_uci(move):
+    promotion = (move >> 12) & 7
+    return SQUARE_NAMES[move & 63] + SQUARE_NAMES[(move >> 6) & 63] + (PIECE_SYMBOLS[promotion] if promotion else "")
+
+class Position(object):
+    """
+    A position, with pieces[color * 6 + piece type] bitboards, occupied[color] bitboards and a board
+    of 64 piece codes (EMPTY where there is none) for finding what stands on a square.
+    """
+    __slots__ = ("pieces", "occupied", "board", "turn", "castling", "ep_square", "halfmove", "fullmove", "stack")
+
+    def __init__(self):
+        self.pieces = [0] * 12
+        self.occupied = [0, 0]
+        self.board = [EMPTY] * 64
+        self.turn = WHITE
+        self.castling = 0
+        self.ep_square = EMPTY
+        self.halfmove = 0
+        self.fullmove = 1
+        self.stack = []
+
+    @classmethod
+    def from_fen(cls, fen):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError("Incomplete FEN: %r" % fen)
+        pos = cls()
+        ranks = fields[0].split("/")
+        if len(ranks) != 8:
+            raise ValueError("FEN board needs 8 ranks: %r" % fen)
+        for r, text in enumerate(ranks):
+            file = 0
+            for ch in text:
+                if ch.isdigit():
+                    file += int(ch)
+                elif ch.lower() in PIECE_SYMBOLS and file < 8:
+                    pos.put((7 - r) * 8 + file, (WHITE if ch.isupper() else BLACK) * 6 + PIECE_SYMBOLS.index(ch.lower()))
+                    file += 1
+                else:
+                    raise ValueError("Bad FEN board: %r" % fen)
+            if file != 8:
+                raise ValueError("FEN rank %d does not cover 8 files: %r" % (8 - r, fen))
+        if fields[1] not in ("w", "b"):
+            raise ValueError("Bad FEN side to move: %r" % fen)
+        pos.turn = WHITE if fields[1] == "w" else BLACK
+        for symbol, right in CASTLING_SYMBOLS:
+            if symbol in fields[2]:
+                pos.castling |= right
+        if fields[3] != "-":
+            if fields[3] not in SQUARES:
+                raise ValueError("Bad FEN en passant square: %r" % fen)
+            pos.ep_square = SQUARES[fields[3]]
+        if len(fields) > 4:
+            pos.halfmove = int(fields[4])
+        if len(fields) > 5:
+            pos.fullmove = int(fields[5])
+        for color in (WHITE, BLACK):
+            if bin(pos.pieces[color * 6 + KING]).count("1") != 1:
+                raise ValueError("FEN needs one king per side: %r" % fen)
+        return pos
+
+    def fen(self):
+        ranks = []
+        for rank in range(7, -1, -1):
+            text, gap = "", 0
+            for file in range(8):
+                piece = self.board[rank * 8 + file]
+                if piece == EMPTY:
+                    gap += 1
+                    continue
+                if gap:
+                    text, gap = text + str(gap), 0
+                symbol = PIECE_SYMBOLS[piece % 6]
+                text += symbol.upper() if piece < 6 else symbol
+            ranks.append(text + (str(gap) if gap else ""))
+        castling = "".join(symbol for symbol, right in CASTLING_SYMBOLS if self.castling & right) or "-"
+        ep = SQUARE_NAMES[self.ep_square] if self.ep_square != EMPTY else "-"
+        return "%s %s %s %s %d %d" % ("/".join(ranks), "wb"[self.turn], castling, ep, self.halfmove, self.fullmove)
+
+    def zobrist(self):
+        """
+        64-bit Zobrist hash of the placement, side to move, castling rights and en passant file, the
+        last only when a pawn could capture there. Signed, to fit a 64-bit integer column.
+        """
+        key = 0
+        for piece, bb in enumerate(self.pieces):
+            keys = ZOBRIST_PIECES[piece]
+            for sq in squares(bb):
+                key ^= keys[sq]
+        for right, right_key in ZOBRIST_CASTLING.items():
+            if self.castling & right:
+                key ^= right_key
+        us = self.turn
+        if self.ep_square != EMPTY and PAWN_ATTACKS[us ^ 1][self.ep_square] & self.pieces[us * 6 + PAWN]:
+            key ^= ZOBRIST_EP_FILE[self.ep_square & 7]
+        if us == BLACK:
+            key ^= ZOBRIST_BLACK
+        return key - (1 << 64) if key >> 63 else key
+
+    def put(self, sq, piece):
+        bit = 1 << sq
+        self.pieces[piece] |= bit
+        self.occupied[piece // 6] |= bit
+        self.board[sq] = piece
+
+    def piece_at(self, sq):
+        """(color, piece type) on sq, or None."""
+        piece = self.board[sq]
+        return None if piece == EMPTY else divmod(piece, 6)
+
+    def king_square(self, color):
+        return self.pieces[color * 6 + KING].bit_length() - 1
+
+    def is_attacked(self, sq, by):
+        pieces = self.pieces
+        base = by * 6
+        if KNIGHT_ATTACKS[sq] & pieces[base + KNIGHT] or PAWN_ATTACKS[by ^ 1][sq] & pieces[base + PAWN] or KING_ATTACKS[sq] & pieces[base + KING]:
+            return True
+        occupied = self.occupied[0] | self.occupied[1]
+        diagonal = pieces[base + BISHOP] | pieces[base + QUEEN]
+        if diagonal and bishop_attacks(sq, occupied) & diagonal:
+            return True
+        straight = pieces[base + ROOK] | pieces[base + QUEEN]
+        return bool(straight and rook_attacks(sq, occupied) & straight)
+
+    def in_check(self):
+        return self.is_attacked(self.king_square(self.turn), self.turn ^ 1)
+
+    def pseudo_legal_moves(self):
+        """Moves that follow the piece rules but may leave the mover's king attacked."""
+        us = self.turn
+        them = us ^ 1
+        base = us * 6
+        pieces = self.pieces
+        own = self.occupied[us]
+        occupied = own | self.occupied[them]
+        targets = ~own & FULL
+        moves = []
+        append = moves.append
+
+        pawns = pieces[base + PAWN]
+        empty = ~occupied & FULL
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            step, last_rank = 8, RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            step, last_rank = -8, RANK_1
+        for to in squares(single):
+            if (1 << to) & last_rank:
+                for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                    append((to - step) | to << 6 | promotion << 12)
+            else:
+                append((to - step) | to << 6)
+        for to in squares(double):
+            append((to - 2 * step) | to << 6 | DOUBLE_PUSH << 15)
+        other = self.occupied[them]
+        attacks = PAWN_ATTACKS[us]
+        for frm in squares(pawns):
+            for to in squares(attacks[frm] & other):
+                if (1 << to) & last_rank:
+                    for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        append(frm | to << 6 | promotion << 12)
+                else:
+                    append(frm | to << 6)
+        if self.ep_square != EMPTY:
+            for frm in squares(PAWN_ATTACKS[them][self.ep_square] & pawns):
+                append(frm | self.ep_square << 6 | EN_PASSANT << 15)
+
+        for frm in squares(pieces[base + KNIGHT]):
+            for to in squares(KNIGHT_ATTACKS[frm] & targets):
+                append(frm | to << 6)
+        for frm in squares(pieces[base + BISHOP] | pieces[base + QUEEN]):
+            for to in squares(bishop_attacks(frm, occupied) & targets):
+                append(frm | to << 6)
+        for frm in squares(pieces[base + ROOK] | pieces[base + QUEEN]):
+            for to in squares(rook_attacks(frm, occupied) & targets):
+                append(frm | to << 6)
+        king = self.king_square(us)
+        for to in squares(KING_ATTACKS[king] & targets):
+            append(king | to << 6)
+
+        if self.castling and king == KING_START[us]:
+            for to, (right, rook_from, _, between, safe) in CASTLES.items():
+                if (
+                    self.castling & right and right & (3 if us == WHITE else 12) and not occupied & between
+                    and pieces[base + ROOK] >> rook_from & 1 and not any(self.is_attacked(sq, them) for sq in safe)
+                ):
+                    append(king | to << 6 | CASTLING << 15)
+        return moves
+
+    def legal_moves(self):
+        us = self.turn
+        legal = []
+        for move in self.pseudo_legal_moves():
+            self.make(move)
+            if not self.is_attacked(self.pieces[us * 6 + KING].bit_length() - 1, us ^ 1):
+                legal.append(move)
+            self.unmake()
+        return legal
+
+    def make(self, move):
+        frm, to, promotion, flag = move & 63, (move >> 6) & 63, (move >> 12) & 7, move >> 15
+        board, pieces, occupied = self.board, self.pieces, self.occupied
+        us = self.turn
+        them = us ^ 1
+        piece, captured = board[frm], board[to]
+        self.stack.append((move, captured, self.castling, self.ep_square, self.halfmove))
+
+        span = (1 << frm) | (1 << to)
+        pieces[piece] ^= span
+        occupied[us] ^= span
+        board[frm], board[to] = EMPTY, piece
+        if captured != EMPTY:
+            pieces[captured] ^= 1 << to
+            occupied[them] ^= 1 << to
+        if flag == EN_PASSANT:
+            sq = to - 8 if us == WHITE else to + 8
+            pieces[them * 6 + PAWN] ^= 1 << sq
+            occupied[them] ^= 1 << sq
+            board[sq] = EMPTY
+        elif flag == CASTLING:
+            _, rook_from, rook_to, _, _ = CASTLES[to]
+            rook_span = (1 << rook_from) | (1 << rook_to)
+            pieces[us * 6 + ROOK] ^= rook_span
+            occupied[us] ^= rook_span
+            board[rook_to], board[rook_from] = board[rook_from], EMPTY
+        if promotion:
+            pieces[piece] ^= 1 << to
+            pieces[us * 6 + promotion] |= 1 << to
+            board[to] = us * 6 + promotion
+
+        self.castling &= CASTLING_MASK[frm] & CASTLING_MASK[to]
+        self.ep_square = (frm + to) >> 1 if flag == DOUBLE_PUSH else EMPTY
+        self.halfmove = 0 if piece % 6 == PAWN or captured != EMPTY else self.halfmove + 1
+        if us == BLACK:
+            self.fullmove += 1
+        self.turn = them
+
+    def unmake(self):
+        move, captured, self.castling, self.ep_square, self.halfmove = self.stack.pop()
+        frm, to, promotion, flag = move & 63, (move >> 6) & 63, (move >> 12) & 7, move >> 15
+        board, pieces, occupied = self.board, self.pieces, self.occupied
+        them = self.turn
+        us = them ^ 1
+        self.turn = us
+        if us == BLACK:
+            self.fullmove -= 1
+
+        piece = board[to]
+        if promotion:
+            pieces[piece] ^= 1 << to
+            piece = us * 6 + PAWN
+            pieces[piece] |= 1 << to
+        span = (1 << frm) | (1 << to)
+        pieces[piece] ^= span
+        occupied[us] ^= span
+        board[frm], board[to] = piece, captured
+        if captured != EMPTY:
+            pieces[captured] |= 1 << to
+            occupied[them] |= 1 << to
+        if flag == EN_PASSANT:
+            sq = to - 8 if us == WHITE else to + 8
+            pieces[them * 6 + PAWN] |= 1 << sq
+            occupied[them] |= 1 << sq
+            board[sq] = them * 6 + PAWN
+        elif flag == CASTLING:
+            _, rook_from, rook_to, _, _ = CASTLES[to]
+            rook_span = (1 << rook_from) | (1 << rook_to)
+            pieces[us * 6 + ROOK] ^= rook_span
+            occupied[us] ^= rook_span
+            board[rook_from], board[rook_to] = board[rook_to], EMPTY
+
+    def move_from_uci(self, uci):
+        """
+        The move uci (e2e4, e7e8q) stands for here, flagged from the piece that moves, without
+        checking that it is legal. For replaying lines already checked with parse_uci.
+        """
+        frm, to = SQUARES[uci[:2]], SQUARES[uci[2:4]]
+        piece = self.board[frm]
+        if piece == EMPTY:
+            raise ValueError("No piece on %s" % uci[:2])
+        promotion = PIECE_SYMBOLS.index(uci[4]) if len(uci) == 5 else 0
+        flag = NORMAL
+        if piece % 6 == PAWN:
+            if abs(to - frm) == 16:
+                flag = DOUBLE_PUSH
+            elif to == self.ep_square and (to - frm) % 8:
+                flag = EN_PASSANT
+        elif piece % 6 == KING and abs(to - frm) == 2:
+            flag = CASTLING
+        return frm | to << 6 | promotion << 12 | flag << 15
+
+    def parse_uci(self, uci):
+        """The legal move written as uci (e2e4, e7e8q), or None."""
+        frm, to = SQUARES.get(uci[:2]), SQUARES.get(uci[2:4])
+        promotion = PIECE_SYMBOLS.find(uci[4:]) if len(uci) == 5 else 0
+        if frm is None or to is None or promotion < 0 or len(uci) > 5:
+            return None
+        key = frm | to << 6 | promotion << 12
+        # Only the one pseudo-legal move that matches needs the legality check
+        for move in self.pseudo_legal_moves():
+            if move & 0x7FFF == key:
+                us = self.turn
+                self.make(move)
+                legal = not self.is_attacked(self.pieces[us * 6 + KING].bit_length() - 1, us ^ 1)
+                self.unmake()
+                return move if legal else None
+        return None
+
+    def perft(self, depth):
+        """Leaf nodes of the legal move tree depth plies deep."""
+        if depth == 0:
+            return 1
+        moves = self.legal_moves()
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            self.make(move)
+            nodes += self.perft(depth - 1)
+            self.unmake()
+        return nodes
+
+def line_hashes(fen, ucis):
+    """
+    Zobrist hashes of the FEN's position and of each position reached by playing ucis in turn, or
+    None if a move is illegal. Raises ValueError for a bad FEN.
+    """
+    pos = Position.from_fen(fen)
+    hashes = [pos.zobrist()]
+    for uci in ucis:
+        move = pos.parse_uci(uci)
+        if move is None:
+            return None
+        pos.make(move)
+        hashes.append(pos.zobrist())
+    return hashes
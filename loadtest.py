@@ -0,0 +1,284 @@
+"""
+Trace-driven load replay against the WSGI app.
+
+Each recorded participant in a study database (instance/application.db by default) becomes a
+virtual participant that walks the whole flow -- login, consent, demographics, practice puzzles,
+testing puzzles, final survey, post survey -- replaying its own moves, move durations and the
+pauses between pages, at original speed or scaled by --speed. Requests go through Flask's test
+client, so no server or external tool is needed. The app runs against a scratch database that is
+seeded with the source's puzzle catalog, under ProductionConfig unless APP_CONFIG names another,
+with its spill and dead-letter files in the same scratch directory. Per-route throughput and
+latency percentiles are printed at the end.
+
+    python loadtest.py --participants 200 --concurrency 50 --speed 20
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+def parse_time(value):
+    if value is None:
+        return None
+    return datetime.fromisoformat(value)
+
+def seconds_between(start, end, default=0.0):
+    if start is None or end is None:
+        return default
+    return max((end - start).total_seconds(), 0.0)
+
+class Trace(object):
+    """One recorded participant: page pauses plus the moves of each section."""
+    __slots__ = ("mturk_id", "start", "pauses", "sections", "themes")
+
+    def __init__(self, mturk_id, start):
+        self.mturk_id = mturk_id
+        self.start = start
+        self.pauses = {}
+        self.sections = {}
+        self.themes = {}
+
+def load_traces(path, limit=None):
+    con = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    users = con.execute("""
+        SELECT u.mturk_id, u.start_time, u.end_time,
+            (SELECT timestamp FROM survey s WHERE s.mturk_id = u.mturk_id AND s.type = 'demographics'),
+            (SELECT timestamp FROM survey s WHERE s.mturk_id = u.mturk_id AND s.type = 'final_survey')
+        FROM user u
+        WHERE u.experiment_completed AND u.start_time IS NOT NULL
+        ORDER BY u.start_time
+    """).fetchall()
+    traces = {}
+    for mturk_id, start, end, demographics, final in users:
+        trace = Trace(mturk_id, parse_time(start))
+        trace.pauses["demographics"] = seconds_between(trace.start, parse_time(demographics))
+        trace.pauses["final_survey"] = parse_time(final)
+        trace.pauses["post_survey"] = seconds_between(parse_time(final), parse_time(end))
+        traces[mturk_id] = trace
+
+    sections = con.execute("""
+        SELECT id, mturk_id, section, start_time, end_time, duration FROM section
+        WHERE section IN ('practice', 'testing') ORDER BY id
+    """).fetchall()
+    section_ids = {}
+    for id, mturk_id, section, start, end, duration in sections:
+        trace = traces.get(mturk_id)
+        if trace is None or section in trace.sections:
+            continue
+        trace.sections[section] = {"start": parse_time(start), "end": parse_time(end), "duration": duration or 0, "moves": []}
+        section_ids[id] = trace.sections[section]
+
+    for section_id, puzzle_id, move_num, move, duration, mistake in con.execute(
+        "SELECT section_id, puzzle_id, move_num, move, duration, mistake FROM move ORDER BY id"
+    ):
+        if section_id in section_ids:
+            section_ids[section_id]["moves"].append((puzzle_id, move_num, move, duration or 0, bool(mistake)))
+
+    for mturk_id, data in con.execute("SELECT mturk_id, data FROM survey WHERE type = 'theme_question'"):
+        if mturk_id in traces:
+            answer = json.loads(data)
+            # Some early rows hold the answer wrapped in a one-element list
+            if isinstance(answer, list) and len(answer) == 1:
+                answer = answer[0]
+            if isinstance(answer, dict):
+                traces[mturk_id].themes[int(answer["puzzle_id"])] = answer["user_answer"]
+
+    puzzles = {id: moves.split(" ") for id, moves in con.execute("SELECT id, moves FROM puzzle")}
+    con.close()
+
+    complete = [t for t in traces.values() if "practice" in t.sections and "testing" in t.sections]
+    for t in complete:
+        demographics_done = t.start.timestamp() + t.pauses["demographics"]
+        practice, testing = t.sections["practice"], t.sections["testing"]
+        t.pauses["practice"] = max(practice["start"].timestamp() - demographics_done, 0.0) if practice["start"] else 0.0
+        t.pauses["testing"] = seconds_between(practice["end"], testing["start"])
+        t.pauses["final_survey"] = seconds_between(testing["end"], t.pauses["final_survey"])
+    return complete[:limit] if limit else complete, puzzles
+
+def seed_database(source, target, tables=("puzzle", "explanation")):
+    """Fill the empty schema at target with the source's rows of tables, the puzzle catalog by default."""
+    src = sqlite3.connect("file:%s?mode=ro" % source, uri=True)
+    dst = sqlite3.connect(target)
+    for table in tables:
+        columns = [row[1] for row in dst.execute("PRAGMA table_info(%s)" % table)]
+        have = [row[1] for row in src.execute("PRAGMA table_info(%s)" % table)]
+        shared = [c for c in columns if c in have]
+        rows = src.execute("SELECT %s FROM %s" % (", ".join('"%s"' % c for c in shared), table)).fetchall()
+        dst.executemany(
+            "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join('"%s"' % c for c in shared), ", ".join("?" * len(shared))), rows
+        )
+    dst.commit()
+    src.close()
+    dst.close()
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def call(self, route, method, *args, **kwargs):
+        start = time.perf_counter()
+        response = method(*args, **kwargs)
+        data = response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            if response.status_code >= 400:
+                self.errors[route] += 1
+        return response, data
+
+    def report(self, wall):
+        print("%-20s %8s %9s %9s %9s %9s %9s %7s" % ("route", "requests", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "errors"))
+        total = 0
+        for route in sorted(self.latencies):
+            samples = sorted(self.latencies[route])
+            total += len(samples)
+            pct = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1000
+            print("%-20s %8d %9.1f %9.2f %9.2f %9.2f %9.2f %7d" % (
+                route, len(samples), len(samples) / wall, pct(.5), pct(.9), pct(.99), samples[-1] * 1000, self.errors[route]
+            ))
+        print("%d requests in %.1fs (%.1f req/s)" % (total, wall, total / wall))
+
+class VirtualParticipant(object):
+    def __init__(self, app, trace, puzzles, recorder, speed, mturk_id):
+        self.client = app.test_client()
+        self.trace = trace
+        self.puzzles = puzzles
+        self.recorder = recorder
+        self.speed = speed
+        self.mturk_id = mturk_id
+
+    def pause(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def get(self, route, url):
+        return self.recorder.call(route, self.client.get, url)
+
+    def post(self, route, url, **kwargs):
+        return self.recorder.call(route, self.client.post, url, **kwargs)
+
+    def run(self):
+        response, page = self.get("login", "/login/")
+        token = CSRF_TOKEN.search(page.decode())
+        self.post("login", "/login/", data={"mturk_id": self.mturk_id, "csrf_token": token.group(1) if token else ""})
+        self.get("consent", "/consent/")
+        self.post("consent_submit", "/consent/submit/", data={"consent": "True"})
+        self.get("demographics_survey", "/demographics_survey/")
+        self.pause(self.trace.pauses["demographics"])
+        self.post("demographics_submit", "/demographics_survey/submit/", data={
+            "q1": "25-34", "q2": "Male", "q3": "White", "q4": "Bachelor", "q5": "4", "q6": "Beginner"
+        })
+        self.get("key_info", "/key_info/")
+        self.pause(self.trace.pauses["practice"])
+        self.play("practice")
+        self.pause(self.trace.pauses["testing"])
+        self.play("testing")
+        self.pause(self.trace.pauses["final_survey"])
+        self.get("final_survey", "/final_survey/")
+        answers = {"q%d%d" % (i, j): "4" for i in (1, 2, 3) for j in (1, 2, 3)}
+        answers.update({"q41": "7", "q42": "1"})
+        self.post("final_survey_submit", "/final_survey/submit/", data=answers)
+        self.pause(self.trace.pauses["post_survey"])
+        self.get("post_survey", "/post_survey/")
+
+    def play(self, section):
+        recorded = self.trace.sections[section]
+        self.get(section, "/%s/" % section)
+        self.post("start_section", "/start_section/")
+        self.get("get_puzzles", "/get_puzzles/%s/?explanations=1" % section)
+        clock = time.time() * 1000
+        section_start = clock
+        successes = completed = 0
+        correct, mistakes = defaultdict(int), defaultdict(int)
+        for seq, (puzzle_id, move_num, move, duration, mistake) in enumerate(recorded["moves"]):
+            self.pause(duration / 1000)
+            clock += duration
+            solution = self.puzzles.get(puzzle_id, [])
+            if mistake:
+                mistakes[puzzle_id] += 1
+            else:
+                correct[puzzle_id] += 1
+            done = not mistake and move_num + 1 >= len(solution)
+            if done:
+                completed += 1
+                successes += mistakes[puzzle_id] == 0
+            self.post("log_moves", "/log_moves/", json={"moves": [{
+                "seq": seq, "puzzle_id": puzzle_id, "move_num": move_num, "move": move,
+                "move_start": clock - duration, "move_end": clock, "move_duration": duration, "mistake": mistake,
+                "section_start": section_start, "section_end": clock, "section_duration": clock - section_start,
+                "num_moves": sum(correct.values()) + sum(mistakes.values()), "successes": successes, "puzzles": completed
+            }]})
+            if done and section == "testing":
+                answer = self.trace.themes.get(puzzle_id, random.choice(["fork", "pin"]))
+                self.post("log_theme_answer", "/log_theme_answer/", json={
+                    "puzzle_id": puzzle_id, "user_answer": answer, "correct_answer": answer, "correct": True
+                })
+        self.post("log_section", "/log_section/", json={"end_time": clock, "duration": recorded["duration"]})
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--source", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "application.db"), help="study database to read traces from")
+    parser.add_argument("--participants", type=int, default=None, help="replay only the first N participants")
+    parser.add_argument("--repeat", type=int, default=1, help="replay every trace this many times")
+    parser.add_argument("--concurrency", type=int, default=32, help="virtual participants running at once")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale for pauses and arrivals; 0 replays without waiting")
+    parser.add_argument("--burst", action="store_true", help="start every participant at once instead of at recorded arrival times")
+    args = parser.parse_args()
+
+    traces, puzzles = load_traces(args.source, args.participants)
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "loadtest.db")
+    from app import create_app, db, write_behind
+    # DevelopmentConfig has no WAL or busy timeout, so concurrent writers fail with "database is locked"
+    app = create_app(os.environ.get("APP_CONFIG", "ProductionConfig"))
+    # Spill and dead-letter files
+    app.instance_path = workdir
+    # Count server errors as 500s instead of raising them in the participant's thread
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+    with app.app_context():
+        db.create_all()
+    seed_database(args.source, os.path.join(workdir, "loadtest.db"))
+
+    recorder = Recorder()
+    first_arrival = traces[0].start if traces else None
+    runs = []
+    for r in range(args.repeat):
+        for n, trace in enumerate(traces):
+            offset = 0.0 if args.burst or args.speed == 0 else (trace.start - first_arrival).total_seconds() / args.speed
+            runs.append((offset, VirtualParticipant(app, trace, puzzles, recorder, args.speed, "LT%d-%d" % (r, n))))
+
+    print("Replaying %d participants (%d traces) with concurrency %d at speed %s" % (len(runs), len(traces), args.concurrency, args.speed))
+    started = time.perf_counter()
+
+    def run(offset, participant):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            participant.run()
+        except Exception as e:
+            print("%s aborted: %r" % (participant.mturk_id, e))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(run, *r) for r in runs]:
+            future.result()
+    write_behind.stop()
+    recorder.report(time.perf_counter() - started)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
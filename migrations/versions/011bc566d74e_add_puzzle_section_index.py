@@ -0,0 +1,26 @@
+"""Index puzzles by section, which the catalog loads by
+
+Revision ID: 011bc566d74e
+Revises: e2727dba6178
+Create Date: 2026-10-18 23:12:40.519307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011bc566d74e'
+down_revision = 'e2727dba6178'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.create_index('ix_puzzle_section', ['section'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.drop_index('ix_puzzle_section')
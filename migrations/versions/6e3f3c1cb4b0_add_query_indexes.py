@@ -0,0 +1,30 @@
+"""Add composite indexes for route queries
+
+Revision ID: 6e3f3c1cb4b0
+Revises: 1d355fa27487
+Create Date: 2026-10-18 10:04:17.228461
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e3f3c1cb4b0'
+down_revision = '1d355fa27487'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_move_section_id_puzzle_id', 'move', ['section_id', 'puzzle_id', 'mistake'], unique=False)
+    op.create_index('ix_survey_mturk_id_type', 'survey', ['mturk_id', 'type'], unique=False)
+    op.create_index('ix_section_mturk_id_section', 'section', ['mturk_id', 'section'], unique=False)
+    op.create_index('ix_explanation_lookup', 'explanation', ['puzzle_id', 'move_num', 'protocol', 'mistake'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_explanation_lookup', table_name='explanation')
+    op.drop_index('ix_section_mturk_id_section', table_name='section')
+    op.drop_index('ix_survey_mturk_id_type', table_name='survey')
+    op.drop_index('ix_move_section_id_puzzle_id', table_name='move')
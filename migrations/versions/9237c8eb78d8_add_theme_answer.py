@@ -0,0 +1,88 @@
+"""Add theme answers and backfill them from surveys
+
+Revision ID: 9237c8eb78d8
+Revises: e4402bf533db
+Create Date: 2026-10-18 15:08:32.640192
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9237c8eb78d8'
+down_revision = 'e4402bf533db'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.env')
+ANSWER_FIELDS = ('puzzle_id', 'user_answer', 'correct_answer', 'correct')
+
+survey = sa.table('survey',
+    sa.column('id', sa.Integer),
+    sa.column('mturk_id', sa.String),
+    sa.column('type', sa.String),
+    sa.column('data', sa.JSON),
+    sa.column('timestamp', sa.DateTime)
+)
+
+theme_answer = sa.table('theme_answer',
+    sa.column('mturk_id', sa.String),
+    sa.column('puzzle_id', sa.Integer),
+    sa.column('user_answer', sa.String),
+    sa.column('correct_answer', sa.String),
+    sa.column('correct', sa.Boolean),
+    sa.column('timestamp', sa.DateTime)
+)
+
+
+def upgrade():
+    op.create_table('theme_answer',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('mturk_id', sa.String(length=20), nullable=True),
+    sa.Column('puzzle_id', sa.Integer(), nullable=True),
+    sa.Column('user_answer', sa.String(length=20), nullable=True),
+    sa.Column('correct_answer', sa.String(length=20), nullable=True),
+    sa.Column('correct', sa.Boolean(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['mturk_id'], ['user.mturk_id'], ),
+    sa.ForeignKeyConstraint(['puzzle_id'], ['puzzle.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_theme_answer_mturk_id_puzzle_id', 'theme_answer', ['mturk_id', 'puzzle_id'], unique=True)
+
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.select(survey.c.id, survey.c.mturk_id, survey.c.data, survey.c.timestamp)
+        .where(survey.c.type == 'theme_question').order_by(survey.c.timestamp, survey.c.id)
+    ).all()
+    answers, skipped = {}, 0
+    for id, mturk_id, data, timestamp in rows:
+        # Some early rows hold the answer wrapped in a one-element list
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+            if isinstance(data, dict):
+                conn.execute(survey.update().where(survey.c.id == id).values(data=data))
+        if not isinstance(data, dict) or not all(k in data for k in ANSWER_FIELDS) or not str(data['puzzle_id']).isdigit():
+            skipped += 1
+            continue
+        # Later answers for the same puzzle replace earlier ones, as the route did
+        answers[(mturk_id, int(data['puzzle_id']))] = dict(
+            mturk_id=mturk_id,
+            puzzle_id=int(data['puzzle_id']),
+            user_answer=data['user_answer'],
+            correct_answer=data['correct_answer'],
+            correct=bool(data['correct']),
+            timestamp=timestamp
+        )
+    if skipped:
+        logger.warning('Skipped %d theme_question surveys that hold no answer', skipped)
+    if answers:
+        op.bulk_insert(theme_answer, list(answers.values()))
+
+
+def downgrade():
+    op.drop_index('ix_theme_answer_mturk_id_puzzle_id', table_name='theme_answer')
+    op.drop_table('theme_answer')
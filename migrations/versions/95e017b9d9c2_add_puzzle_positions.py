@@ -0,0 +1,72 @@
+"""Add Zobrist hashes of puzzle positions and backfill them
+
+Revision ID: 95e017b9d9c2
+Revises: ce1e8350f531
+Create Date: 2026-10-18 19:05:47.221836
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from bitboard import line_hashes
+
+
+# revision identifiers, used by Alembic.
+revision = '95e017b9d9c2'
+down_revision = 'ce1e8350f531'
+branch_labels = None
+depends_on = None
+
+puzzle = sa.table('puzzle',
+    sa.column('id', sa.Integer),
+    sa.column('fen', sa.String),
+    sa.column('moves', sa.String),
+    sa.column('zobrist', sa.BigInteger)
+)
+
+puzzle_position = sa.table('puzzle_position',
+    sa.column('puzzle_id', sa.Integer),
+    sa.column('move_num', sa.Integer),
+    sa.column('zobrist', sa.BigInteger)
+)
+
+
+def upgrade():
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('zobrist', sa.BigInteger(), nullable=True))
+        batch_op.create_index('ix_puzzle_zobrist', ['zobrist'], unique=False)
+
+    op.create_table('puzzle_position',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('puzzle_id', sa.Integer(), nullable=True),
+    sa.Column('move_num', sa.Integer(), nullable=True),
+    sa.Column('zobrist', sa.BigInteger(), nullable=True),
+    sa.ForeignKeyConstraint(['puzzle_id'], ['puzzle.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_puzzle_position_zobrist', 'puzzle_position', ['zobrist', 'puzzle_id', 'move_num'], unique=False)
+    op.create_index('ix_puzzle_position_puzzle_id_move_num', 'puzzle_position', ['puzzle_id', 'move_num'], unique=True)
+
+    conn = op.get_bind()
+    positions = []
+    for id, fen, moves in conn.execute(sa.select(puzzle.c.id, puzzle.c.fen, puzzle.c.moves)).all():
+        try:
+            hashes = line_hashes(fen, (moves or '').split())
+        except (ValueError, AttributeError):
+            hashes = None
+        # Puzzles with a bad FEN or an illegal move stay unhashed; `flask index-positions` reports them
+        if not hashes:
+            continue
+        conn.execute(puzzle.update().where(puzzle.c.id == id).values(zobrist=hashes[0]))
+        positions += [dict(puzzle_id=id, move_num=n, zobrist=h) for n, h in enumerate(hashes)]
+    if positions:
+        op.bulk_insert(puzzle_position, positions)
+
+
+def downgrade():
+    op.drop_index('ix_puzzle_position_puzzle_id_move_num', table_name='puzzle_position')
+    op.drop_index('ix_puzzle_position_zobrist', table_name='puzzle_position')
+    op.drop_table('puzzle_position')
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.drop_index('ix_puzzle_zobrist')
+        batch_op.drop_column('zobrist')
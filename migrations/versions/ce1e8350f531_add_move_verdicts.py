@@ -0,0 +1,28 @@
+"""Add the client's verdict and legality to moves
+
+Revision ID: ce1e8350f531
+Revises: 9237c8eb78d8
+Create Date: 2026-10-18 17:42:10.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ce1e8350f531'
+down_revision = '9237c8eb78d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('move', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('client_mistake', sa.Boolean(), nullable=True))
+        batch_op.add_column(sa.Column('legal', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('move', schema=None) as batch_op:
+        batch_op.drop_column('legal')
+        batch_op.drop_column('client_mistake')
@@ -0,0 +1,28 @@
+"""Add detected motifs and their confidence to puzzles
+
+Revision ID: e2727dba6178
+Revises: 95e017b9d9c2
+Create Date: 2026-10-18 20:31:12.804519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2727dba6178'
+down_revision = '95e017b9d9c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('motif', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('motif_confidence', sa.Float(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('puzzle', schema=None) as batch_op:
+        batch_op.drop_column('motif_confidence')
+        batch_op.drop_column('motif')
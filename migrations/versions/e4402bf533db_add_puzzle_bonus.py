@@ -0,0 +1,83 @@
+"""Add per-puzzle bonus aggregates
+
+Revision ID: e4402bf533db
+Revises: fa94acc3098a
+Create Date: 2026-10-18 13:41:55.071336
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4402bf533db'
+down_revision = 'fa94acc3098a'
+branch_labels = None
+depends_on = None
+
+# As in app.py when this revision was written
+PUZZLE_BONUS = .2
+MISTAKE_PENALTY = .04
+CATALOG_SECTIONS = ('practice', 'testing')
+
+move = sa.table('move',
+    sa.column('id', sa.Integer),
+    sa.column('section_id', sa.Integer),
+    sa.column('puzzle_id', sa.Integer),
+    sa.column('mistake', sa.Boolean)
+)
+
+puzzle = sa.table('puzzle',
+    sa.column('id', sa.Integer),
+    sa.column('section', sa.String)
+)
+
+puzzle_bonus = sa.table('puzzle_bonus',
+    sa.column('section_id', sa.Integer),
+    sa.column('puzzle_id', sa.Integer),
+    sa.column('correct', sa.Integer),
+    sa.column('mistakes', sa.Integer),
+    sa.column('bonus', sa.Float)
+)
+
+
+def bonus_after(mistakes):
+    """CASE giving the bonus left after a number of mistakes, folded one at a time as PuzzleBonus.fold does."""
+    bonuses = [PUZZLE_BONUS]
+    while bonuses[-1] > 0:
+        bonuses.append(max(bonuses[-1] - MISTAKE_PENALTY, 0))
+    return sa.case(dict(enumerate(bonuses)), value=mistakes, else_=0.0)
+
+def upgrade():
+    op.create_table('puzzle_bonus',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('section_id', sa.Integer(), nullable=True),
+    sa.Column('puzzle_id', sa.Integer(), nullable=True),
+    sa.Column('correct', sa.Integer(), nullable=True),
+    sa.Column('mistakes', sa.Integer(), nullable=True),
+    sa.Column('bonus', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['puzzle_id'], ['puzzle.id'], ),
+    sa.ForeignKeyConstraint(['section_id'], ['section.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_puzzle_bonus_section_id_puzzle_id', 'puzzle_bonus', ['section_id', 'puzzle_id'], unique=True)
+
+    # Backfill from the moves already logged, the aggregate `flask reconcile-bonuses` computes,
+    # inserted in first-played order so ids keep that order within a section. Only moves at
+    # catalog puzzles earn a bonus
+    mistakes = sa.func.sum(sa.case((move.c.mistake, 1), else_=0))
+    op.execute(puzzle_bonus.insert().from_select(
+        ['section_id', 'puzzle_id', 'correct', 'mistakes', 'bonus'],
+        sa.select(
+            move.c.section_id, move.c.puzzle_id, sa.func.sum(sa.case((move.c.mistake, 0), else_=1)),
+            mistakes, bonus_after(mistakes)
+        )
+        .where(move.c.puzzle_id.in_(sa.select(puzzle.c.id).where(puzzle.c.section.in_(CATALOG_SECTIONS))))
+        .group_by(move.c.section_id, move.c.puzzle_id)
+        .order_by(sa.func.min(move.c.id))
+    ))
+
+
+def downgrade():
+    op.drop_index('ix_puzzle_bonus_section_id_puzzle_id', table_name='puzzle_bonus')
+    op.drop_table('puzzle_bonus')
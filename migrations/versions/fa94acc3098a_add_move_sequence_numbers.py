@@ -0,0 +1,28 @@
+"""Add move sequence numbers
+
+Revision ID: fa94acc3098a
+Revises: 6e3f3c1cb4b0
+Create Date: 2026-10-18 11:26:03.914772
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fa94acc3098a'
+down_revision = '6e3f3c1cb4b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('move', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_move_section_id_seq', ['section_id', 'seq'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('move', schema=None) as batch_op:
+        batch_op.drop_index('ix_move_section_id_seq')
+        batch_op.drop_column('seq')
@@ -0,0 +1,116 @@
+"""
+Static detection of the tactical motif behind a puzzle: fork, pin, skewer or other.
+
+After each of the player's moves (every other move of the line, from the first) the attack map of
+the piece that moved is read off the bitboards:
+
+    fork    it attacks two or more targets: the king, pieces worth more than it, or undefended pieces
+    pin     a bishop, rook or queen attacks a piece with the king, or a piece worth more than both,
+            behind it on the same line
+    skewer  the same line with the king or the more valuable piece in front
+
+A motif scores BASE, plus EXTRA for a forking check, an absolute pin or a skewered king, plus
+REALIZED if a later player move captures a piece of the kind the motif targets. Motifs seen after a
+later player move count at LATER_WEIGHT, since the last move of a line is usually the capture that
+cashes in. The label is the best-scoring motif, and its confidence is its score less half the
+runner-up's, so a puzzle that shows two motifs at once gets a lower confidence. Puzzles showing none
+are "other" at OTHER_CONFIDENCE.
+
+Nothing here generates moves or searches. Solution lines are replayed with move_from_uci, trusting
+that the importer and the catalog have checked them.
+
+    label, confidence = classify("8/r1k2pp1/B7/PP6/8/5KP1/8/8 w - - 0 1", "b5b6 c7b8 b6a7")
+"""
+from bitboard import (
+    BISHOP, EMPTY, KING, KING_ATTACKS, KNIGHT, KNIGHT_ATTACKS, PAWN, PAWN_ATTACKS, QUEEN, ROOK,
+    Position, bishop_attacks, rook_attacks, squares,
+)
+
+MOTIFS = ("fork", "pin", "skewer", "other")
+# Material values by piece type; the king outweighs everything
+VALUES = (1, 3, 3, 5, 9, 100)
+BASE, EXTRA, REALIZED = 0.5, 0.1, 0.3
+LATER_WEIGHT = 0.7
+OTHER_CONFIDENCE = 0.5
+
+def attacks_from(piece, color, sq, occupied):
+    if piece == PAWN:
+        return PAWN_ATTACKS[color][sq]
+    if piece == KNIGHT:
+        return KNIGHT_ATTACKS[sq]
+    if piece == BISHOP:
+        return bishop_attacks(sq, occupied)
+    if piece == ROOK:
+        return rook_attacks(sq, occupied)
+    if piece == QUEEN:
+        return bishop_attacks(sq, occupied) | rook_attacks(sq, occupied)
+    return KING_ATTACKS[sq]
+
+def motifs_after(pos, sq):
+    """[(motif, score, targeted piece types)] shown by the piece that just moved to sq."""
+    board = pos.board
+    them = pos.turn
+    us = them ^ 1
+    piece = board[sq] % 6
+    value = VALUES[piece]
+    occupied = pos.occupied[0] | pos.occupied[1]
+    enemy = pos.occupied[them]
+    attacked = attacks_from(piece, us, sq, occupied) & enemy
+    found = []
+
+    targets = []
+    for target in squares(attacked):
+        victim = board[target] % 6
+        if victim == KING or VALUES[victim] > value or not pos.is_attacked(target, them):
+            targets.append(victim)
+    if len(targets) > 1:
+        found.append(("fork", BASE + EXTRA * (KING in targets), targets))
+
+    if piece in (BISHOP, ROOK, QUEEN):
+        for front in squares(attacked):
+            # Lifting the front piece extends only the line through it, up to the next piece
+            behind = attacks_from(piece, us, sq, occupied ^ (1 << front)) & enemy & ~attacked
+            if not behind:
+                continue
+            first, second = board[front] % 6, board[behind.bit_length() - 1] % 6
+            if second == KING or (first != KING and VALUES[second] > max(VALUES[first], value)):
+                found.append(("pin", BASE + EXTRA * (second == KING), [first]))
+            elif first == KING or VALUES[first] > VALUES[second]:
+                found.append(("skewer", BASE + EXTRA * (first == KING), [second]))
+    return found
+
+def classify(fen, moves):
+    """(motif, confidence) for the puzzle; raises ValueError for a bad FEN or a move with no piece to make it."""
+    pos = Position.from_fen(fen)
+    found, captures = [], []
+    for ply, uci in enumerate(moves.split()):
+        move = pos.move_from_uci(uci)
+        to = (move >> 6) & 63
+        if ply % 2:
+            pos.make(move)
+            continue
+        if pos.board[to] != EMPTY:
+            captures.append((ply, pos.board[to] % 6))
+        pos.make(move)
+        weight = 1.0 if ply == 0 else LATER_WEIGHT
+        found.extend((ply, motif, score * weight, targets) for motif, score, targets in motifs_after(pos, to))
+
+    scores = dict.fromkeys(MOTIFS[:-1], 0.0)
+    for ply, motif, score, targets in found:
+        if any(later > ply and victim in targets for later, victim in captures):
+            score += REALIZED
+        scores[motif] = max(scores[motif], score)
+    (best, top), (_, runner_up) = sorted(scores.items(), key=lambda item: -item[1])[:2]
+    if not top:
+        return "other", OTHER_CONFIDENCE
+    return best, round(min(1.0, top - runner_up / 2), 3)
+
+def classify_rows(rows):
+    """[(puzzle_id, motif, confidence)] for (puzzle_id, fen, moves) rows; None and None where the line cannot be replayed."""
+    labelled = []
+    for puzzle_id, fen, moves in rows:
+        try:
+            labelled.append((puzzle_id,) + classify(fen, moves or ""))
+        except (ValueError, KeyError, IndexError):
+            labelled.append((puzzle_id, None, None))
+    return labelled
@@ -0,0 +1,197 @@
+"""
+Monte Carlo power analysis for the protocol comparison, driven by the logged moves.
+
+The fit is the empirical joint distribution of (num_moves, num_seconds, num_correct) for every
+(protocol, section, puzzle) cell of puzzle_stats. Drawing whole rows keeps the correlation
+between the three, and drawing per puzzle keeps the differences in difficulty. A virtual
+participant plays every puzzle of the section once. A virtual study gives each protocol the same
+number of participants, applies the usual filters and runs the one-way ANOVA of analytics.py.
+Power is the share of studies with p < --alpha.
+
+Fits are cached in --cache under a fingerprint of the source (row counts and newest ids, or export
+file sizes and times). Repeated runs against unchanged data skip loading the tables.
+Simulations for each participant count are split into batches over a process pool. Each batch is
+seeded from (--seed, participants, batch).
+
+By default each protocol draws from its own logged rows, so the simulated effect is the observed
+one. --pool draws every protocol from the pooled rows instead (no effect; power is then the false
+positive rate), and --shift posits an effect: --shift actionable=0.8 makes actionable participants
+take 80% of the logged time on every puzzle.
+
+    python power.py --participants 20,40,80,160 --sims 4000
+    python power.py --section practice --pool --shift actionable=0.8 --shift placebic=0.9
+"""
+import argparse
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+
+import analytics
+from app import create_app, db, Move, Section, ThemeAnswer, User
+
+# Next to the study database, wherever the script is run from
+CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance", "power_fit.npz")
+FIT_COLUMNS = ("num_moves", "num_seconds", "num_correct")
+
+def fingerprint(export=None):
+    """Changes whenever the data the fit is built from could have."""
+    if export:
+        parts = [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in sorted(glob.glob(os.path.join(export, "*")))]
+    else:
+        parts = [str(db.engine.url)]
+        for model in (Move, Section, User, ThemeAnswer):
+            key = model.__mapper__.primary_key[0]
+            parts.append(tuple(db.session.execute(db.select(db.func.count(), db.func.max(key))).one()))
+    parts += [str(analytics.RESTART_DATE), analytics.MTURK_PREFIX]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def fit(tables):
+    """Flat arrays of puzzle_stats rows sorted by (protocol, section, puzzle), with the cell each run of rows belongs to."""
+    frame = analytics.puzzle_stats(tables)
+    frame = analytics.select(frame, analytics.group_codes(frame["protocol_user"], analytics.PROTOCOLS) >= 0)
+    order = np.lexsort((frame["puzzle_id"], frame["section"], frame["protocol_user"]))
+    frame = analytics.select(frame, order)
+    cells = np.stack([frame["protocol_user"], frame["section"], frame["puzzle_id"].astype(str)], axis=1)
+    starts = np.flatnonzero(np.r_[True, (cells[1:] != cells[:-1]).any(axis=1)]) if len(cells) else np.array([], dtype=np.int64)
+    fitted = {c: frame[c] for c in FIT_COLUMNS}
+    fitted.update(
+        protocol=frame["protocol_user"][starts], section=frame["section"][starts], puzzle_id=frame["puzzle_id"][starts],
+        starts=starts, stops=np.r_[starts[1:], len(cells)].astype(np.int64),
+    )
+    return fitted
+
+def load_fit(export=None, cache=CACHE):
+    """The fit for the database (within an app context) or an export directory, from cache when current."""
+    key = fingerprint(export)
+    if cache and os.path.exists(cache):
+        with np.load(cache) as saved:
+            if str(saved["key"]) == key:
+                return {name: saved[name] for name in saved.files if name != "key"}
+    tables = analytics.load_export(export) if export else analytics.load_database()
+    fitted = fit(tables)
+    if cache:
+        # Written aside and renamed, so a concurrent run never reads half a file
+        tmp = cache + ".tmp.npz"
+        np.savez(tmp, key=key, **fitted)
+        os.replace(tmp, cache)
+    return fitted
+
+def cells(fitted, section, pool=False):
+    """
+    [(protocol code, [row indices per puzzle])] for the section; every protocol must cover the same puzzles.
+    With pool, each protocol draws from all protocols' rows, so only --shift separates them.
+    """
+    in_section = fitted["section"] == section
+    puzzles = np.unique(fitted["puzzle_id"][in_section])
+    rows = {}
+    for protocol in analytics.PROTOCOLS:
+        mine = np.flatnonzero(in_section & (fitted["protocol"] == protocol))
+        if set(fitted["puzzle_id"][mine]) != set(puzzles):
+            raise ValueError("No logged %s rows for some %s puzzles" % (protocol, section))
+        rows[protocol] = [np.arange(fitted["starts"][i], fitted["stops"][i]) for i in mine]
+    if pool:
+        pooled = [np.concatenate(parts) for parts in zip(*rows.values())]
+        rows = {protocol: pooled for protocol in rows}
+    return [(g, rows[protocol]) for g, protocol in enumerate(analytics.PROTOCOLS)]
+
+_state = {}
+
+def init_worker(fitted, section, pool, shifts):
+    _state.update(fitted=fitted, cells=cells(fitted, section, pool), shifts=shifts)
+
+def anova_p(sums, sumsq, counts):
+    """One-way ANOVA p-values for many studies at once; arguments are (studies, groups) arrays."""
+    n = counts.sum(axis=1)
+    k = (counts > 0).sum(axis=1)
+    between = (sums ** 2 / np.maximum(counts, 1)).sum(axis=1)
+    ss_between = between - sums.sum(axis=1) ** 2 / np.maximum(n, 1)
+    ss_within = sumsq.sum(axis=1) - between
+    df1, df2 = k - 1, n - k
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = (ss_between / df1) / (ss_within / df2)
+    p = stats.f.sf(f, np.maximum(df1, 1), np.maximum(df2, 1))
+    # Studies the filters left without two groups or without residual degrees of freedom cannot reject
+    return np.where((df1 > 0) & (df2 > 0) & np.isfinite(f), p, 1.0)
+
+def run_batch(task):
+    """ANOVA p-values for size simulated studies with participants per protocol."""
+    participants, batch, size, seed = task
+    fitted, shifts = _state["fitted"], _state["shifts"]
+    rng = np.random.default_rng([seed, participants, batch])
+    groups = len(analytics.PROTOCOLS)
+    sums, sumsq, counts = np.zeros((size, groups)), np.zeros((size, groups)), np.zeros((size, groups), dtype=np.int64)
+    for g, puzzles in _state["cells"]:
+        shift = shifts.get(analytics.PROTOCOLS[g], 1.0)
+        for logged in puzzles:
+            rows = logged[rng.integers(0, len(logged), (size, participants))]
+            moves, seconds, correct = fitted["num_moves"][rows], fitted["num_seconds"][rows] * shift, fitted["num_correct"][rows]
+            with np.errstate(divide="ignore"):
+                score = 1 / np.sqrt(moves * seconds)
+            keep = (moves <= analytics.MAX_MOVES) & (seconds <= analytics.MAX_SECONDS) & (correct == analytics.NUM_CORRECT) & np.isfinite(score)
+            score = np.where(keep, score, 0.0)
+            sums[:, g] += score.sum(axis=1)
+            sumsq[:, g] += (score ** 2).sum(axis=1)
+            counts[:, g] += keep.sum(axis=1)
+    return anova_p(sums, sumsq, counts)
+
+def power_curve(fitted, participants, section="testing", sims=2000, alpha=0.05, pool=False, shifts=None, batch_size=250, workers=None, seed=0):
+    """[(participants per protocol, power, Monte Carlo standard error)] for each count in participants."""
+    tasks = [
+        (n, batch, min(batch_size, sims - start), seed)
+        for n in participants for batch, start in enumerate(range(0, sims, batch_size))
+    ]
+    # Fail here rather than in every worker
+    cells(fitted, section, pool)
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(fitted, section, pool, shifts or {})) as executor:
+        results = list(executor.map(run_batch, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+    pvalues = {}
+    for (n, _, _, _), p in zip(tasks, results):
+        pvalues.setdefault(n, []).append(p)
+    curve = []
+    for n in participants:
+        power = float((np.concatenate(pvalues[n]) < alpha).mean())
+        curve.append((n, power, float(np.sqrt(power * (1 - power) / sims))))
+    return curve
+
+def parse_shift(value):
+    protocol, _, factor = value.partition("=")
+    if protocol not in analytics.PROTOCOLS or not factor:
+        raise argparse.ArgumentTypeError("expected PROTOCOL=FACTOR with PROTOCOL one of %s" % ", ".join(analytics.PROTOCOLS))
+    return protocol, float(factor)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--export", help="fit from a `flask export` directory instead of the database")
+    parser.add_argument("--cache", default=CACHE, help="file the fit is cached in; empty to disable")
+    parser.add_argument("--section", default="testing", choices=("practice", "testing"))
+    parser.add_argument("--participants", default="20,40,60,80,100,150,200", help="comma-separated participants per protocol")
+    parser.add_argument("--sims", type=int, default=2000, help="simulated studies per participant count")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--pool", action="store_true", help="draw every protocol from the pooled rows (no logged effect)")
+    parser.add_argument("--shift", type=parse_shift, action="append", default=[], metavar="PROTOCOL=FACTOR", help="scale a protocol's puzzle times")
+    parser.add_argument("--batch-size", type=int, default=250, help="studies per task sent to a worker")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--seed", type=int, default=2023)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with create_app().app_context():
+        fitted = load_fit(args.export, args.cache or None)
+    print("fit of %d puzzle rows in %d cells ready in %.2fs" % (len(fitted["num_moves"]), len(fitted["starts"]), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    participants = [int(n) for n in args.participants.split(",")]
+    curve = power_curve(fitted, participants, args.section, args.sims, args.alpha, args.pool, dict(args.shift), args.batch_size, args.workers, args.seed)
+    print("%d studies per point in %.1fs\n" % (args.sims, time.perf_counter() - start))
+
+    print("%12s %8s %8s" % ("participants", "power", "se"))
+    for n, power, se in curve:
+        print("%12d %8.3f %8.3f" % (n, power, se))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Bootstrap confidence intervals and permutation tests for differences between protocols.
+
+Participants, not puzzle rows, are the unit that is resampled. Each metric is reduced to a
+(sum, count) pair per eligible participant, and a protocol's value is the ratio of its summed sums
+to its summed counts, so a resample is a gather plus two row sums:
+
+    score           mean puzzle score over the participant's filtered puzzle_stats rows (--section)
+    bonus           bonus earned, compensation less the base pay, for completed participants
+    theme_accuracy  share of theme questions answered correctly
+
+Resamples are drawn as (batch, participants) index matrices. Batches are spread over a process
+pool, and each batch's generator is seeded from (--seed, metric, test, batch), so results do not
+depend on --workers.
+
+    python resample.py --resamples 100000
+    python resample.py --export export --workers 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import analytics
+from app import BASE_COMP, create_app
+
+PAIRS = [(i, j) for i in range(len(analytics.PROTOCOLS)) for j in range(i + 1, len(analytics.PROTOCOLS))]
+TESTS = ("bootstrap", "permutation")
+
+def participant_metrics(tables, section="testing"):
+    """{metric: (sums, counts, protocol codes)} with one entry per participant that has the metric."""
+    users = tables["user"]
+    ok = analytics.eligible_users(users)
+    order = np.argsort(users["mturk_id"], kind="stable")
+    sorted_ids = users["mturk_id"][order]
+
+    def per_user(mturk_ids, values):
+        pos, found = analytics.lookup(mturk_ids, sorted_ids, order)
+        found &= ok[pos]
+        sums = np.bincount(pos[found], weights=values[found], minlength=len(ok))
+        counts = np.bincount(pos[found], minlength=len(ok))
+        has = counts > 0
+        return sums[has], counts[has], analytics.group_codes(users["protocol"][has], analytics.PROTOCOLS)
+
+    frame = analytics.filter_stats(analytics.puzzle_stats(tables))
+    frame = analytics.select(frame, frame["section"] == section)
+    answers = tables["theme_answer"]
+    completed = users["experiment_completed"]
+    metrics = {
+        "score": per_user(frame["mturk_id"], frame["score"]),
+        "bonus": per_user(users["mturk_id"][completed], users["compensation"][completed] - BASE_COMP),
+        "theme_accuracy": per_user(answers["mturk_id"], answers["correct"].astype(np.float64)),
+    }
+    # Participants without a protocol in PROTOCOLS take no part
+    return {name: tuple(a[codes >= 0] for a in (sums, counts, codes)) for name, (sums, counts, codes) in metrics.items()}
+
+def protocol_means(sums, counts, codes):
+    means = np.full(len(analytics.PROTOCOLS), np.nan)
+    for g in range(len(analytics.PROTOCOLS)):
+        if (codes == g).any():
+            means[g] = sums[codes == g].sum() / counts[codes == g].sum()
+    return means
+
+def observed(sums, counts, codes):
+    means = protocol_means(sums, counts, codes)
+    return np.array([means[j] - means[i] for i, j in PAIRS])
+
+_metrics = {}
+
+def init_worker(metrics):
+    _metrics.update(metrics)
+
+def run_batch(task):
+    """One batch of resampled later-minus-earlier protocol differences, shape (size, len(PAIRS))."""
+    metric, test, batch, size, seed = task
+    sums, counts, codes = _metrics[metric]
+    rng = np.random.default_rng([seed, list(_metrics).index(metric), TESTS.index(test), batch])
+    members = [np.flatnonzero(codes == g) for g in range(len(analytics.PROTOCOLS))]
+    out = np.full((size, len(PAIRS)), np.nan)
+
+    if test == "bootstrap":
+        # Participants are redrawn within their own protocol, so group sizes stay fixed
+        means = np.full((size, len(members)), np.nan)
+        for g, m in enumerate(members):
+            if len(m):
+                idx = m[rng.integers(0, len(m), (size, len(m)))]
+                means[:, g] = sums[idx].sum(axis=1) / counts[idx].sum(axis=1)
+        for p, (i, j) in enumerate(PAIRS):
+            out[:, p] = means[:, j] - means[:, i]
+        return out
+
+    # Permutation: shuffle each pair's pooled participants and split them back at the first group's size
+    for p, (i, j) in enumerate(PAIRS):
+        pooled = np.concatenate([members[i], members[j]])
+        if not len(members[i]) or not len(members[j]):
+            continue
+        idx = pooled[rng.permuted(np.broadcast_to(np.arange(len(pooled)), (size, len(pooled))), axis=1)]
+        first, second = idx[:, :len(members[i])], idx[:, len(members[i]):]
+        out[:, p] = sums[second].sum(axis=1) / counts[second].sum(axis=1) - sums[first].sum(axis=1) / counts[first].sum(axis=1)
+    return out
+
+def resample(metrics, resamples=10000, batch_size=1000, workers=None, seed=0):
+    """{(metric, test): (resamples, len(PAIRS)) array}, computed on a pool of workers processes."""
+    tasks = []
+    for metric in metrics:
+        for test in TESTS:
+            for batch, start in enumerate(range(0, resamples, batch_size)):
+                tasks.append((metric, test, batch, min(batch_size, resamples - start), seed))
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(metrics,)) as pool:
+        results = list(pool.map(run_batch, tasks, chunksize=max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+    draws = {}
+    for (metric, test, _, _, _), result in zip(tasks, results):
+        draws.setdefault((metric, test), []).append(result)
+    return {key: np.concatenate(parts) for key, parts in draws.items()}
+
+def summarize(metrics, draws, conf_level=0.95):
+    """Rows of observed difference, percentile bootstrap interval and two-sided permutation p per metric and pair."""
+    alpha = (1 - conf_level) / 2
+    rows = []
+    for metric, arrays in metrics.items():
+        diffs = observed(*arrays)
+        boot, perm = draws[(metric, "bootstrap")], draws[(metric, "permutation")]
+        for p, (i, j) in enumerate(PAIRS):
+            lwr = upr = pvalue = np.nan
+            # A protocol with no participants leaves the comparison undefined
+            if not np.isnan(diffs[p]):
+                lwr, upr = np.quantile(boot[:, p], [alpha, 1 - alpha])
+                # Small tolerance so ties with the observed value count as extreme despite rounding
+                extreme = (np.abs(perm[:, p]) >= abs(diffs[p]) - 1e-12).sum()
+                pvalue = (extreme + 1) / (len(perm) + 1)
+            rows.append({
+                "metric": metric, "comparison": "%s-%s" % (analytics.PROTOCOLS[j], analytics.PROTOCOLS[i]),
+                "diff": diffs[p], "lwr": lwr, "upr": upr, "p": pvalue,
+            })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--export", help="read a `flask export` directory instead of the database")
+    parser.add_argument("--section", default="testing", choices=("practice", "testing"), help="section the score metric covers")
+    parser.add_argument("--resamples", type=int, default=10000, help="resamples per metric and test")
+    parser.add_argument("--batch-size", type=int, default=1000, help="resamples per task sent to a worker")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core by default")
+    parser.add_argument("--seed", type=int, default=2023)
+    parser.add_argument("--conf-level", type=float, default=0.95)
+    args = parser.parse_args()
+
+    if args.export:
+        tables = analytics.load_export(args.export)
+    else:
+        with create_app().app_context():
+            tables = analytics.load_database()
+
+    metrics = participant_metrics(tables, args.section)
+    for metric, (sums, counts, codes) in metrics.items():
+        print("%s: %s participants" % (metric, " / ".join("%d %s" % ((codes == g).sum(), name) for g, name in enumerate(analytics.PROTOCOLS))))
+
+    start = time.perf_counter()
+    draws = resample(metrics, args.resamples, args.batch_size, args.workers, args.seed)
+    print("%d resamples per metric and test in %.1fs\n" % (args.resamples, time.perf_counter() - start))
+
+    print("%-15s %-22s %10s %10s %10s %8s" % ("", "", "diff", "lwr", "upr", "perm p"))
+    for r in summarize(metrics, draws, args.conf_level):
+        print("%-15s %-22s %10.5f %10.5f %10.5f %8.4f" % (r["metric"], r["comparison"], r["diff"], r["lwr"], r["upr"], r["p"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Pre-fork production server.
+
+The master process builds the app, warms its read-only caches (the puzzle catalog and the compiled
+templates), freezes the garbage collector so those objects stay in pages shared copy-on-write, then
+forks --workers processes. Every worker serves the same listening socket with a threaded WSGI server.
+
+    APP_CONFIG=ProductionConfig python serve.py --workers 4 --port 5500
+
+Signals to the master:
+    SIGHUP           graceful reload: the master re-executes itself (picking up new code), forks a new
+                     set of workers on the inherited socket, then retires the old ones
+    SIGTERM, SIGINT  graceful stop: workers finish their in-flight requests and exit
+Workers that die are replaced.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+def preload(app):
+    from app import db, get_catalog, write_behind
+    with app.app_context():
+        # Commit what workers of a previous run left behind in their spill files
+        replayed, dead = write_behind.recover()
+        if replayed or dead:
+            print("replayed %d queued events; %d in the dead-letter file" % (replayed, dead), file=sys.stderr)
+        get_catalog()
+        # Close the master's connections; a worker must never reuse a socket or file handle it shares
+        db.engine.dispose()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+def listen(host, port):
+    # After a reload the socket is inherited from the previous master image
+    fd = os.environ.pop("SERVE_FD", None)
+    if fd is not None:
+        return socket.socket(fileno=int(fd))
+    return socket.create_server((host, port), backlog=2048)
+
+def serve(app, sock):
+    """Worker body: serve until SIGTERM/SIGINT, then finish in-flight requests."""
+    from app import db, write_behind
+    # Reloads are the master's business
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    with app.app_context():
+        # Drop any pool state copied from the master without closing its connections
+        db.engine.dispose(close=False)
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    stopping = []
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it cannot run in this (the serving) thread
+        if not stopping:
+            stopping.append(signum)
+            threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # serve_forever closes the server when it returns, which joins the request threads
+    server.serve_forever()
+    write_behind.stop()
+
+class Master(object):
+    def __init__(self, app, sock, workers):
+        self.app = app
+        self.sock = sock
+        self.size = workers
+        self.workers = set()
+        self.retiring = set(int(pid) for pid in os.environ.pop("SERVE_RETIRING", "").split(",") if pid)
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                serve(self.app, self.sock)
+            except BaseException:
+                self.app.logger.exception("Worker %d crashed", os.getpid())
+                status = 1
+            finally:
+                # Never return into the master's stack
+                os._exit(status)
+        self.workers.add(pid)
+
+    def kill(self, pids, sig):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.discard(pid)
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    print("worker %d exited with status %d, replacing it" % (pid, os.waitstatus_to_exitcode(status)), file=sys.stderr)
+
+    def reexec(self):
+        print("reloading", file=sys.stderr)
+        os.set_inheritable(self.sock.fileno(), True)
+        env = dict(os.environ, SERVE_FD=str(self.sock.fileno()), SERVE_RETIRING=",".join(map(str, self.workers | self.retiring)))
+        os.execve(sys.executable, [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:], env)
+
+    def run(self):
+        def on_stop(signum, frame):
+            self.stopping = True
+        def on_reload(signum, frame):
+            self.reloading = True
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+
+        last_spawn = 0.0
+        while not self.stopping:
+            self.reap()
+            if self.reloading:
+                return self.reexec()
+            if len(self.workers) < self.size:
+                # Back off if workers keep dying on start
+                time.sleep(max(0.0, last_spawn + 1 - time.monotonic()))
+                last_spawn = time.monotonic()
+                while len(self.workers) < self.size:
+                    self.spawn()
+                # The new generation is serving, so the previous one can finish up and go
+                self.kill(self.retiring, signal.SIGTERM)
+            time.sleep(0.5)
+
+        self.kill(self.workers | self.retiring, signal.SIGTERM)
+        while self.workers or self.retiring:
+            self.reap()
+            time.sleep(0.1)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5500)))
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes, one per core by default")
+    parser.add_argument("--config", help="config class name, APP_CONFIG by default")
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app(args.config)
+    sock = listen(args.host, args.port)
+    preload(app)
+    # Everything allocated so far lives as long as the process; moving it to the permanent
+    # generation keeps collections in the workers from writing to (and so copying) its pages
+    gc.collect()
+    gc.freeze()
+
+    print("serving on http://%s:%d with %d workers (master %d)" % (sock.getsockname()[:2] + (args.workers, os.getpid())), file=sys.stderr)
+    Master(app, sock, args.workers).run()
+
+if __name__ == "__main__":
+    main()
@@ -228,7 +228,7 @@ function onDrop(source, target) {
   }
   if (completed && num_mistakes == 0) successes++
   // log data
-  let move_data = JSON.stringify({
+  logMove({
     puzzle_id: puzzles[puzzle_num]["id"],
     move_num: move_num,
     move: move_string,
@@ -244,50 +244,85 @@ function onDrop(source, target) {
     successes: successes,
     puzzles: completed ? puzzle_num + 1 : puzzle_num
   })
+  let exp = findExplanation(puzzles[puzzle_num]["id"], move_num, mistake)
+  // undo wrong move
+  if (mistake) game.undo()
+  // pulse previous recommendation for repeated mistakes
+  if (explained_move && mistake && section == "practice") chat_display.find(".recommendation").last().fadeOut(100).fadeIn(100).fadeOut(100).fadeIn(100)
+  // explain move
+  if ((!explained_move || section == "testing") && exp !== null) explain(source, target, mistake, exp["reason"])
+  // continue the puzzle accordingly
+  if (mistake) {
+    // start new move timer on wrong move
+    move_start = Date.now()
+  } else {
+    // make next puzzle move after correct move
+    move_num++
+    explained_move = false
+    removeGreenSquares()
+    if (completed) {
+      let last_message = chat_display.find("p").last()
+      last_message.after("Puzzle " + (puzzle_num + 1) + " completed")
+      let t = chat_display.find(".time").last()
+      t.html("<hr>")
+      scrollChat()
+      
+      if (section == "practice") {
+        puzzle_num++
+        setTimeout(nextPuzzle, 500)
+      } else {
+        themeQuestion()
+      }
+    } else {
+      setTimeout(makePuzzleMove, 250)
+    }
+  }
+  if (mistake) return "snapback"
+}
+
+function findExplanation(p_id, m_num, mistake) {
+  let key = p_id + ":" + m_num + ":" + mistake
+  return key in explanations ? explanations[key] : null
+}
+
+// Moves are queued and sent in order, one batch in flight at a time, so the board never waits
+// on the server. Each carries a sequence number; the server ignores ones it already has,
+// which makes resending a failed batch safe.
+function logMove(move_data) {
+  move_data.seq = move_seq++
+  move_queue.push(move_data)
+  sendMoves()
+}
+
+function sendMoves() {
+  if (sending_moves) return
+  if (move_queue.length == 0) {
+    while (moves_sent_callbacks.length) moves_sent_callbacks.shift()()
+    return
+  }
+  sending_moves = true
+  let batch = move_queue.slice(0, 50)
   $.ajax({
-    url: "/log_move/",
+    url: "/log_moves/",
     type: "POST",
     contentType: "application/json",
-    data: move_data,
-    success: function(data) {
-      // undo wrong move
-      if (mistake) game.undo()
-      // pulse previous recommendation for repeated mistakes
-      if (explained_move && mistake && section == "practice") chat_display.find(".recommendation").last().fadeOut(100).fadeIn(100).fadeOut(100).fadeIn(100)
-      // explain move
-      if ((!explained_move || section == "testing") && data !== null) explain(source, target, mistake, data["reason"])
-      // continue the puzzle accordingly
-      if (mistake) {
-        // start new move timer on wrong move
-        move_start = Date.now()
-      } else {
-        // make next puzzle move after correct move
-        move_num++
-        explained_move = false
-        removeGreenSquares()
-        if (completed) {
-          let last_message = chat_display.find("p").last()
-          last_message.after("Puzzle " + (puzzle_num + 1) + " completed")
-          let t = chat_display.find(".time").last()
-          t.html("<hr>")
-          scrollChat()
-          
-          if (section == "practice") {
-            puzzle_num++
-            setTimeout(nextPuzzle, 500)
-          } else {
-            themeQuestion()
-          }
-        } else {
-          setTimeout(makePuzzleMove, 250)
-        }
-      }
+    data: JSON.stringify({moves: batch}),
+    success: function() {
+      move_queue.splice(0, batch.length)
+      sending_moves = false
+      sendMoves()
     },
     error: function(err) {
       console.log(err)
+      sending_moves = false
+      setTimeout(sendMoves, 1000)
     }
   })
-  if (mistake) return "snapback"
+}
+
+function whenMovesSent(callback) {
+  moves_sent_callbacks.push(callback)
+  sendMoves()
 }
 
 function onMouseoverSquare(square, piece) {
@@ -320,6 +355,13 @@ function onMouseoutSquare(square, piece) {
 }
 
 function nextSection() {
+  if (leaving_section) return
+  leaving_section = true
+  // the section's moves have to land before it is closed
+  whenMovesSent(logSection)
+}
+
+function logSection() {
   let section_end = Date.now()
   section_data = JSON.stringify({
     end_time: section_end,
@@ -392,14 +434,26 @@ let puzzle_num = 0, successes = 0, num_moves = 0
 // chat vars
 let chat_display = $("#chat")
 let explained_move = false
+// "puzzle_id:move_num:mistake" -> explanation row
+let explanations = {}
+// move log vars
+let move_queue = [], move_seq = 0, sending_moves = false, moves_sent_callbacks = [], leaving_section = false
 
-// get section's puzzles
-$.ajax({
-  method: "POST",
-  url: "/get_puzzles/",
-  contentType: "application/json",
-  success: function(data) {
-    puzzles = data
+// open the section and get its puzzles
+$.when(
+  $.ajax({
+    method: "POST",
+    url: "/start_section/"
+  }),
+  $.ajax({
+    method: "GET",
+    url: "/get_puzzles/" + section + "/?explanations=1",
+    dataType: "json"
+  })
+).then(
+  function(started, fetched) {
+    puzzles = fetched[0]["puzzles"]
+    for (let e of fetched[0]["explanations"]) explanations[e["puzzle_id"] + ":" + e["move_num"] + ":" + e["mistake"]] = e
     if (section == "testing") {
       timer_display.parent().prepend("Testing time remaining: ")
       chat_display.append(`
@@ -421,7 +475,7 @@ $.ajax({
     nextPuzzle()
     timer.start()
   },
-  error: function(err) {
+  function(err) {
     console.log(err)
   }
-})
+)
@@ -0,0 +1,351 @@
+"""
+Synthetic study databases for scale benchmarks.
+
+Fits a few distributions from a real study database (instance/application.db by default), then
+writes any number of participants drawn from them into a new database that has the app's schema
+and the source's puzzle catalog:
+
+    the share of consenting participants who finish, and how many puzzles each section gets through
+    per puzzle and move number: how many mistakes precede the right move, and which wrong moves are tried
+    per puzzle, move number and outcome: the log-normal spread of move durations
+    how often a section that stops short gave up part-way through a puzzle, and where
+    theme-question accuracy, and the demographics, final survey and feedback payloads themselves
+
+Protocols are assigned uniformly from PROTOCOLS, as at consent. Every table the app writes during a
+session is filled consistently: user (with compensation), section, move (with seq), puzzle_bonus,
+survey and theme_answer. Participants are generated --chunk at a time as NumPy arrays and written
+with executemany, one transaction per chunk. Journaling and syncing are off and secondary indexes
+are built after the load, so the output is only usable once the run completes.
+
+    python synth.py --participants 100000 --output instance/synthetic.db
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+import numpy as np
+
+SECTIONS = ("practice", "testing")
+MAX_MISTAKES = 40
+SURVEY_SAMPLE = 2000
+# Pauses between pages, in seconds: (median, log-normal sigma)
+PAUSES = {"demographics": (90, 0.5), "between_sections": (15, 0.5), "final_survey": (120, 0.5), "puzzle": (1.5, 0.3)}
+TABLES = ("user", "section", "move", "puzzle_bonus", "survey", "theme_answer")
+
+class StudyFit(object):
+    """What synthetic participants are drawn from; built by fit_source."""
+    __slots__ = (
+        "puzzles", "move_nums", "solutions", "mistake_cdf", "duration_params", "wrong_moves", "wrong_offsets",
+        "wrong_counts", "num_puzzles", "abandon_rate", "abandoned", "completion_rate", "theme_accuracy", "themes", "surveys",
+    )
+
+def fit_source(path):
+    con = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    fit = StudyFit()
+    fit.puzzles = {
+        section: con.execute('SELECT id, moves, theme FROM puzzle WHERE section = ? ORDER BY "order"', (section,)).fetchall()
+        for section in SECTIONS
+    }
+    fit.themes = sorted({theme for puzzles in fit.puzzles.values() for _, _, theme in puzzles})
+
+    rows = con.execute("""
+        SELECT m.section_id, m.puzzle_id, m.move_num, m.move, m.duration, m.mistake FROM move m
+        WHERE m.duration > 0 AND m.move_num IS NOT NULL ORDER BY m.section_id, m.id
+    """).fetchall()
+    fit.move_nums = sorted({row[2] for row in rows})
+    mistakes = defaultdict(int)
+    found = set()
+    durations = defaultdict(list)
+    wrong = defaultdict(list)
+    for section_id, puzzle_id, move_num, move, duration, mistake in rows:
+        if mistake:
+            mistakes[(section_id, puzzle_id, move_num)] += 1
+            wrong[(puzzle_id, move_num)].append(move)
+        else:
+            found.add((section_id, puzzle_id, move_num))
+        durations[(puzzle_id, move_num, bool(mistake))].append(np.log(duration))
+    counts = defaultdict(list)
+    for key in found:
+        counts[key[1:]].append(min(mistakes[key], MAX_MISTAKES))
+    everything = [m for moves in wrong.values() for m in moves]
+    all_durations = {flag: [d for (_, _, m), ds in durations.items() if m == flag for d in ds] for flag in (False, True)}
+
+    # Cells are (section, slot, move number), slots being the section's puzzles in order
+    fit.solutions, fit.mistake_cdf, fit.duration_params, pools = {}, {}, {}, []
+    for section in SECTIONS:
+        cells = len(fit.puzzles[section]), len(fit.move_nums)
+        fit.solutions[section] = np.empty(cells, dtype=object)
+        fit.mistake_cdf[section] = np.ones(cells + (MAX_MISTAKES + 1,))
+        fit.duration_params[section] = np.empty(cells + (2, 2))
+        for slot, (puzzle_id, moves, _) in enumerate(fit.puzzles[section]):
+            solution = moves.split(" ")
+            for j, move_num in enumerate(fit.move_nums):
+                fit.solutions[section][slot, j] = solution[move_num]
+                observed = counts.get((puzzle_id, move_num)) or [0]
+                pmf = np.bincount(observed, minlength=MAX_MISTAKES + 1) / len(observed)
+                fit.mistake_cdf[section][slot, j] = np.cumsum(pmf)
+                for flag in (False, True):
+                    logs = durations.get((puzzle_id, move_num, flag)) or all_durations[flag] or [np.log(5000)]
+                    fit.duration_params[section][slot, j, int(flag)] = np.mean(logs), np.std(logs) or 0.5
+                pools.append([m for m in wrong.get((puzzle_id, move_num), everything) if m != solution[move_num]] or ["a1a2"])
+    fit.wrong_moves = np.array([m for pool in pools for m in pool], dtype=object)
+    fit.wrong_counts = np.array([len(pool) for pool in pools])
+    fit.wrong_offsets = np.r_[0, np.cumsum(fit.wrong_counts)[:-1]]
+
+    fit.num_puzzles = {}
+    for section in SECTIONS:
+        played = [n for (n,) in con.execute(
+            "SELECT num_puzzles FROM section WHERE section = ? AND num_puzzles IS NOT NULL AND mturk_id LIKE 'A%'", (section,)
+        )] or [len(fit.puzzles[section])]
+        fit.num_puzzles[section] = np.bincount(np.minimum(played, len(fit.puzzles[section])), minlength=len(fit.puzzles[section]) + 1) / len(played)
+    # Where the sections that gave up on a puzzle stopped: (move number index, wrong moves there)
+    fit.abandon_rate, fit.abandoned = {}, {}
+    for section in SECTIONS:
+        short = con.execute(
+            "SELECT COUNT(*) FROM section WHERE section = ? AND num_puzzles < ? AND mturk_id LIKE 'A%'", (section, len(fit.puzzles[section]))
+        ).fetchone()[0]
+        stops = con.execute("""
+            SELECT m.move_num, SUM(m.mistake) FROM move m JOIN section s ON s.id = m.section_id
+            WHERE s.section = ? AND s.mturk_id LIKE 'A%' AND m.duration > 0
+            GROUP BY m.section_id, m.puzzle_id, m.move_num HAVING MIN(m.mistake) = 1
+        """, (section,)).fetchall()
+        fit.abandoned[section] = np.array(
+            [(fit.move_nums.index(move_num), min(wrong_tries, MAX_MISTAKES)) for move_num, wrong_tries in stops if move_num in fit.move_nums],
+            dtype=np.int64
+        ).reshape(-1, 2)
+        fit.abandon_rate[section] = min(len(fit.abandoned[section]) / short, 1.0) if short else 0.0
+    fit.completion_rate = con.execute("SELECT AVG(experiment_completed) FROM user WHERE consent AND mturk_id LIKE 'A%'").fetchone()[0] or 1.0
+    try:
+        fit.theme_accuracy = con.execute("SELECT AVG(correct) FROM theme_answer").fetchone()[0]
+    except sqlite3.OperationalError:
+        # Databases from before the theme_answer table keep the answers in survey payloads
+        fit.theme_accuracy = con.execute("""
+            SELECT AVG(json_extract(CASE json_type(data) WHEN 'array' THEN json_extract(data, '$[0]') ELSE data END, '$.correct'))
+            FROM survey WHERE type = 'theme_question'
+        """).fetchone()[0]
+    fit.theme_accuracy = 0.5 if fit.theme_accuracy is None else fit.theme_accuracy
+    fit.surveys = {
+        survey_type: [data for (data,) in con.execute(
+            "SELECT data FROM survey WHERE type = ? AND mturk_id LIKE 'A%' ORDER BY id DESC LIMIT ?", (survey_type, SURVEY_SAMPLE)
+        )] or [json.dumps(None)]
+        for survey_type in ("demographics", "final_survey", "feedback")
+    }
+    con.close()
+    return fit
+
+def pause(rng, name, size):
+    median, sigma = PAUSES[name]
+    return (rng.lognormal(np.log(median * 1e6), sigma, size)).astype("timedelta64[us]")
+
+def timestamps(values):
+    # The format SQLAlchemy's SQLite DateTime type writes and parses
+    return np.char.replace(np.datetime_as_string(values, unit="us"), "T", " ")
+
+def play_sections(fit, section, rng, starts):
+    """Moves, puzzle bonuses and per-section totals for sections beginning at starts."""
+    from app import bonus_after
+    n = len(starts)
+    cells = len(fit.move_nums)
+    num_puzzles = rng.choice(len(fit.num_puzzles[section]), n, p=fit.num_puzzles[section])
+    # A section that stops short may have given up part-way through its next puzzle
+    abandoned = (num_puzzles < len(fit.puzzles[section])) & (rng.random(n) < fit.abandon_rate[section])
+    played = num_puzzles + abandoned
+    sections = np.repeat(np.arange(n), played)
+    slots = np.arange(len(sections)) - np.repeat(np.cumsum(played) - played, played)
+    finished = slots < num_puzzles[sections]
+
+    # Mistakes before each right move, drawn through the cell's cumulative distribution
+    cdf = fit.mistake_cdf[section][slots]
+    k = (rng.random(cdf.shape[:2])[:, :, None] > cdf).sum(axis=2)
+    right = np.ones_like(k)
+    gave_up = np.flatnonzero(~finished)
+    if len(gave_up):
+        # Only wrong moves at the move number given up on, and nothing after it
+        stop, wrong_tries = fit.abandoned[section][rng.integers(0, len(fit.abandoned[section]), len(gave_up))].T
+        after = np.arange(cells) > stop[:, None]
+        k[gave_up] = np.where(after, 0, k[gave_up])
+        k[gave_up, stop] = wrong_tries
+        right[gave_up] = np.where(after | (np.arange(cells) == stop[:, None]), 0, 1)
+    mistakes, correct = k.sum(axis=1), right.sum(axis=1)
+
+    # One unit per (section, puzzle, move number), played in that order: k wrong moves, then the right one if found
+    units, found = k.ravel(), right.ravel()
+    size = units + found
+    unit_of = np.repeat(np.arange(len(units)), size)
+    mistake = (np.arange(len(unit_of)) - np.repeat(np.cumsum(size) - size, size)) < units[unit_of]
+    slot, j, section_of = np.repeat(slots, cells)[unit_of], np.tile(np.arange(cells), len(slots))[unit_of], np.repeat(sections, cells)[unit_of]
+
+    mu, sigma = fit.duration_params[section][slot, j, mistake.astype(int)].T
+    duration = np.maximum(rng.lognormal(mu, sigma), 100).astype(np.int64)
+    # Wrong-move pools are laid out section by section, then slot, then move number
+    pool = (sum(len(fit.puzzles[s]) for s in SECTIONS[:SECTIONS.index(section)]) + slot) * len(fit.move_nums) + j
+    wrong = fit.wrong_moves[fit.wrong_offsets[pool] + (rng.random(len(pool)) * fit.wrong_counts[pool]).astype(np.int64)]
+    move = np.where(mistake, wrong, fit.solutions[section][slot, j])
+
+    # Moves follow one another within a section, with a pause between puzzles
+    per_section = np.bincount(section_of, minlength=n)
+    first = np.cumsum(per_section) - per_section
+    seq = np.arange(len(section_of)) - first[section_of]
+    elapsed = np.cumsum(duration) - duration
+    if len(elapsed):
+        # Sections without moves have a first index past the end, but no move refers to them
+        elapsed -= elapsed[np.minimum(first, len(elapsed) - 1)][section_of]
+    move_start = starts[section_of] + elapsed.astype("timedelta64[ms]") + (slot * PAUSES["puzzle"][0] * 1e6).astype("timedelta64[us]")
+    move_end = move_start + duration.astype("timedelta64[ms]")
+
+    section_ms = np.bincount(section_of, weights=duration, minlength=n) + played * PAUSES["puzzle"][0] * 1000
+    bonus = np.array([bonus_after(m) for m in range(MAX_MISTAKES * cells + 1)])[mistakes]
+    return {
+        "num_puzzles": num_puzzles,
+        "successes": np.bincount(sections, weights=finished & (mistakes == 0), minlength=n).astype(np.int64),
+        "duration": section_ms.astype(np.int64),
+        "end": starts + section_ms.astype("timedelta64[ms]"),
+        # As PuzzleBonus.payout: nothing for a puzzle that was not solved
+        "bonus": np.bincount(sections, weights=np.where(correct >= 2, bonus, 0.0), minlength=n),
+        "moves": (section_of, slot, j, move, move_start, move_end, duration, mistake, seq),
+        "puzzles": (sections, slots, finished, correct, mistakes, bonus, move_end[np.cumsum(mistakes + correct) - 1]),
+    }
+
+def generate(fit, rng, first, count, first_section_id, study_start):
+    """Rows for participants first..first+count-1, as {table: [tuple, ...]}."""
+    from app import BASE_COMP, PROTOCOLS
+    index = np.arange(first, first + count)
+    mturk_id = np.array(["AS%011d" % i for i in index], dtype=object)
+    protocol = np.array(PROTOCOLS)[rng.integers(0, len(PROTOCOLS), count)]
+    # Arrivals spread out like a live HIT, a few seconds apart
+    start = study_start + (index * 4e6).astype("timedelta64[us]") + pause(rng, "puzzle", count)
+    completed = rng.random(count) < fit.completion_rate
+
+    rows = defaultdict(list)
+    demographics_at = start + pause(rng, "demographics", count)
+    practice = play_sections(fit, "practice", rng, demographics_at)
+    practice_id = first_section_id + np.arange(count)
+    t = np.flatnonzero(completed)
+    testing = play_sections(fit, "testing", rng, practice["end"][t] + pause(rng, "between_sections", len(t)))
+    testing_id = first_section_id + count + np.arange(len(t))
+    final_at = testing["end"] + pause(rng, "final_survey", len(t))
+
+    compensation = np.zeros(count)
+    compensation[t] = BASE_COMP + testing["bonus"]
+    end = np.full(count, np.datetime64("NaT"), dtype="datetime64[us]")
+    end[t] = final_at + pause(rng, "puzzle", len(t))
+    end_text = np.where(np.isnat(end), None, timestamps(np.where(np.isnat(end), start, end)))
+    rows["user"] = list(zip(
+        mturk_id.tolist(), completed.astype(int).tolist(), [0] * count, timestamps(start).tolist(), end_text.tolist(),
+        [1] * count, rng.integers(10**9, 2 * 10**9, count).tolist(), protocol.tolist(), np.round(compensation, 2).tolist(),
+    ))
+
+    for section, ids, owners, starts, played in (
+        ("practice", practice_id, np.arange(count), demographics_at, practice),
+        ("testing", testing_id, t, practice["end"][t], testing),
+    ):
+        rows["section"].extend(zip(
+            ids.tolist(), mturk_id[owners].tolist(), [section] * len(ids), protocol[owners].tolist(),
+            timestamps(starts).tolist(), timestamps(played["end"]).tolist(), played["duration"].tolist(),
+            played["successes"].tolist(), played["num_puzzles"].tolist(),
+        ))
+        section_of, slot, j, move, move_start, move_end, duration, mistake, seq = played["moves"]
+        puzzle_ids = np.array([p[0] for p in fit.puzzles[section]])
+        rows["move"].extend(zip(
+            mturk_id[owners][section_of].tolist(), ids[section_of].tolist(), puzzle_ids[slot].tolist(),
+            np.array(fit.move_nums)[j].tolist(), move.tolist(), timestamps(move_start).tolist(), timestamps(move_end).tolist(),
+            # Drawn moves are legal and judged the way the client judged them
+            duration.tolist(), mistake.astype(int).tolist(), mistake.astype(int).tolist(), [1] * len(seq), seq.tolist(),
+        ))
+        sections, slots, _, correct, mistakes, bonus, _ = played["puzzles"]
+        rows["puzzle_bonus"].extend(zip(
+            ids[sections].tolist(), puzzle_ids[slots].tolist(), correct.tolist(), mistakes.tolist(), bonus.tolist(),
+        ))
+
+    def surveys(survey_type, owners, at):
+        payloads = fit.surveys[survey_type]
+        picks = rng.integers(0, len(payloads), len(owners))
+        rows["survey"].extend(zip(mturk_id[owners].tolist(), [survey_type] * len(owners), [payloads[p] for p in picks], timestamps(at).tolist()))
+    surveys("demographics", np.arange(count), demographics_at)
+    surveys("final_survey", t, final_at)
+    surveys("feedback", t, final_at)
+
+    # A theme question follows each testing puzzle solved
+    sections, slots, finished, _, _, _, answered_at = testing["puzzles"]
+    sections, slots, answered_at = sections[finished], slots[finished], answered_at[finished]
+    names = np.array(fit.themes, dtype=object)
+    theme = np.array([fit.themes.index(p[2]) for p in fit.puzzles["testing"]])[slots]
+    # A wrong answer is one of the other themes
+    answer = theme.copy()
+    if len(names) > 1:
+        wrong = rng.random(len(slots)) >= fit.theme_accuracy
+        answer[wrong] = (theme[wrong] + rng.integers(1, len(names), wrong.sum())) % len(names)
+    puzzle_ids = np.array([p[0] for p in fit.puzzles["testing"]])
+    rows["theme_answer"] = list(zip(
+        mturk_id[t][sections].tolist(), puzzle_ids[slots].tolist(), names[answer].tolist(), names[theme].tolist(),
+        (answer == theme).astype(int).tolist(), timestamps(answered_at).tolist(),
+    ))
+    return rows, first_section_id + count + len(t)
+
+INSERTS = {
+    "user": "INSERT INTO user (mturk_id, experiment_completed, failed_attention_checks, start_time, end_time, consent, completion_code, protocol, compensation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    "section": "INSERT INTO section (id, mturk_id, section, protocol, start_time, end_time, duration, successes, num_puzzles) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    "move": "INSERT INTO move (mturk_id, section_id, puzzle_id, move_num, move, start_time, end_time, duration, mistake, client_mistake, legal, seq) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    "puzzle_bonus": "INSERT INTO puzzle_bonus (section_id, puzzle_id, correct, mistakes, bonus) VALUES (?, ?, ?, ?, ?)",
+    "survey": "INSERT INTO survey (mturk_id, type, data, timestamp) VALUES (?, ?, ?, ?)",
+    "theme_answer": "INSERT INTO theme_answer (mturk_id, puzzle_id, user_answer, correct_answer, correct, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--participants", type=int, default=10000)
+    parser.add_argument("--output", "-o", default=os.path.join("instance", "synthetic.db"), help="database to create; must not exist")
+    parser.add_argument("--source", default=os.path.join("instance", "application.db"), help="study database to fit and copy the catalog from")
+    parser.add_argument("--chunk", type=int, default=20000, help="participants generated and committed at a time")
+    parser.add_argument("--start", default="2024-01-01", help="arrival time of the first participant")
+    parser.add_argument("--seed", type=int, default=2023)
+    args = parser.parse_args()
+    if os.path.exists(args.output):
+        parser.error("%s already exists" % args.output)
+
+    began = time.perf_counter()
+    fit = fit_source(args.source)
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(args.output)
+    from app import create_app, db
+    from loadtest import seed_database
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        db.engine.dispose()
+    seed_database(args.source, args.output)
+
+    con = sqlite3.connect(args.output, isolation_level=None)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    con.execute("PRAGMA cache_size = -262144")
+    # Building indexes once over sorted data beats maintaining them row by row
+    indexes = con.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN (%s)" % ", ".join("'%s'" % t for t in TABLES)
+    ).fetchall()
+    for name, _ in indexes:
+        con.execute("DROP INDEX %s" % name)
+
+    rng = np.random.default_rng(args.seed)
+    written = defaultdict(int)
+    section_id = 1
+    for first in range(0, args.participants, args.chunk):
+        rows, section_id = generate(fit, rng, first, min(args.chunk, args.participants - first), section_id, np.datetime64(args.start, "us"))
+        con.execute("BEGIN")
+        for table in TABLES:
+            con.executemany(INSERTS[table], rows[table])
+            written[table] += len(rows[table])
+        con.execute("COMMIT")
+        print("%d participants, %d moves, %.0fs" % (first + min(args.chunk, args.participants - first), written["move"], time.perf_counter() - began))
+
+    for _, sql in indexes:
+        con.execute(sql)
+    con.execute("ANALYZE")
+    con.close()
+    print(", ".join("%s %d" % (table, written[table]) for table in TABLES))
+    print("done in %.0fs" % (time.perf_counter() - began))
+
+if __name__ == "__main__":
+    main()
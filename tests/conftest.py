@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import Puzzle, TestingConfig, catalog_cache, create_app, db, write_behind
+
+# The study's pin puzzle: Re4-a4, Qxa4+, Kxa4
+PIN = dict(id=1, fen="8/kp6/8/q1p5/4R3/pK6/4R3/8 w - - 0 1", order=1, moves="e4a4 a5a4 b3a4", theme="pin", section="testing")
+# A line that opens by promoting, which the client sends as from + to squares only
+PROMOTION = dict(id=2, fen="8/4P3/8/8/8/2k5/8/4K3 w - - 0 1", order=2, moves="e7e8q c3d3 e8e4", theme="fork", section="testing")
+
+@pytest.fixture
+def app(tmp_path):
+    class Config(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///%s" % (tmp_path / "test.db")
+        WTF_CSRF_ENABLED = False
+        # A throwaway database needs no fsyncs
+        SQLITE_PRAGMAS = {"synchronous": "OFF"}
+
+    app = create_app(Config)
+    # Spill and dead-letter files of the write-behind tests
+    app.instance_path = str(tmp_path)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([Puzzle(**PIN), Puzzle(**PROMOTION)])
+        db.session.commit()
+        catalog_cache.reload()
+    yield app
+    with app.app_context():
+        write_behind.stop()
+        write_behind.app = None
+        db.engine.dispose()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def start_testing(client, mturk_id="TESTER1"):
+    """Log in and consent, then start the testing section; returns its id."""
+    client.post("/login/", data={"mturk_id": mturk_id})
+    client.post("/consent/submit/", data={"consent": "True"})
+    client.post("/demographics_survey/submit/", data={"q1": "30", "q2": "f", "q3": "x", "q4": "y", "q5": "4", "q6": "Beginner"})
+    client.get("/testing/")
+    client.post("/start_section/")
+    with client.session_transaction() as s:
+        return s["section_id"]
+
+def finish(client):
+    """Submit the final survey and load the page that pays the participant."""
+    client.post("/final_survey/submit/", data={"q41": "7", "q42": "1"})
+    return client.get("/post_survey/")
+
+def move(puzzle_id, move_num, uci, mistake=False, seq=None):
+    """A move as the client logs it; mistake is the client's own verdict."""
+    return {
+        "puzzle_id": puzzle_id, "move_num": move_num, "move": uci, "move_start": 0, "move_end": 100,
+        "move_duration": 100, "mistake": mistake, "successes": 0, "puzzles": 0, "seq": seq,
+    }
@@ -0,0 +1,72 @@
+from app import Puzzle, catalog_cache, db, get_catalog, puzzles_at_position
+from bitboard import Position, line_hashes
+from conftest import PIN, start_testing
+
+def test_puzzle_payload_leaves_out_analysis_columns(client):
+    start_testing(client)
+    puzzles = client.get("/get_puzzles/testing/").get_json()
+    assert puzzles[0] == {k: PIN[k] for k in ("id", "fen", "order", "moves", "theme", "section")}
+    bundle = client.get("/get_puzzles/testing/?explanations=1").get_json()
+    assert bundle["puzzles"] == puzzles
+
+def test_route_statements_use_indexes(app):
+    catalog = catalog_cache.catalog
+    result = app.test_cli_runner().invoke(args=["check-query-plans"])
+    assert result.exit_code == 0, result.output
+    # The routes ran in another process, so this one's catalog is the one it had
+    assert catalog_cache.catalog is catalog
+    # The run covers the catalog load as well as the participant's own rows
+    assert "SEARCH puzzle USING INDEX ix_puzzle_section" in result.output
+    assert "main.post_survey" in result.output
+
+def test_ids_that_are_not_numbers_find_nothing(app):
+    with app.app_context():
+        catalog = get_catalog()
+        assert catalog.judge("1", "0", "e4a4") == (False, True)
+        assert catalog.explanation("1x", 0, "none", False) is None
+        assert catalog.explanation(None, 0, "none", False) is None
+        assert catalog.judge("pin", 0, "e4a4") is None
+
+def test_reloaded_catalog_serves_added_puzzles(app, client):
+    app.config["CATALOG_CHECK_INTERVAL"] = 0
+    start_testing(client)
+    with app.app_context():
+        db.session.add(Puzzle(**dict(PIN, id=3, order=3)))
+        db.session.commit()
+    # Served from the catalog, which has not been told about puzzle 3 yet
+    assert [p["id"] for p in client.get("/get_puzzles/testing/").get_json()] == [1, 2]
+    result = app.test_cli_runner().invoke(args=["reload-catalog"])
+    assert result.exit_code == 0, result.output
+    assert [p["id"] for p in client.get("/get_puzzles/testing/").get_json()] == [1, 2, 3]
+
+def test_puzzle_lists_revalidate_by_etag(app, client):
+    app.config["CATALOG_CHECK_INTERVAL"] = 0
+    start_testing(client)
+    response = client.get("/get_puzzles/testing/")
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "private, no-cache"
+    unchanged = client.get("/get_puzzles/testing/", headers={"If-None-Match": etag})
+    assert (unchanged.status_code, unchanged.data) == (304, b"")
+    # The bundle with explanations is a different body under its own tag
+    assert client.get("/get_puzzles/testing/?explanations=1").headers["ETag"] != etag
+    assert client.get("/get_puzzles/nosuchsection/").status_code == 404
+
+    with app.app_context():
+        db.session.get(Puzzle, 1).theme = "skewer"
+        db.session.commit()
+    app.test_cli_runner().invoke(args=["reload-catalog"])
+    changed = client.get("/get_puzzles/testing/", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.get_json()[0]["theme"] == "skewer"
+
+def test_positions_are_found_by_zobrist_hash(app):
+    runner = app.test_cli_runner()
+    assert "Hashed 2 of 2 puzzles" in runner.invoke(args=["index-positions"]).output
+    # Move counters are left out of the hash
+    start = PIN["fen"].rsplit(" ", 2)[0]
+    assert Position.from_fen(start + " 12 40").zobrist() == Position.from_fen(PIN["fen"]).zobrist()
+    after_the_trade = line_hashes(PIN["fen"], ["e4a4", "a5a4"])[-1]
+    with app.app_context():
+        assert db.session.get(Puzzle, 1).zobrist == Position.from_fen(PIN["fen"]).zobrist()
+        assert puzzles_at_position(after_the_trade) == [(1, "testing", 2)]
+        assert puzzles_at_position(after_the_trade, ["practice"]) == []
@@ -0,0 +1,102 @@
+import pytest
+
+from app import Move, PuzzleBonus, Section, db, record_moves
+from conftest import move, start_testing
+
+def logged(app, section_id):
+    with app.app_context():
+        return [(m.move, m.mistake, m.client_mistake, m.legal) for m in Move.query.filter_by(section_id=section_id).order_by(Move.id)]
+
+@pytest.mark.parametrize("move_num, uci, mistake, legal", [
+    (0, "e4a4", False, True),   # the solution
+    (0, "e4e5", True, True),    # legal, but not the solution
+    (0, "b3b4", True, False),   # walks into the queen's and the c5 pawn's attacks
+    (2, "b3a4", False, True),
+    (2, "b3c3", True, True),
+    (2, "e2e3", True, False),   # leaves the king in check from the queen
+])
+def test_moves_are_judged_on_the_server(app, client, move_num, uci, mistake, legal):
+    section_id = start_testing(client)
+    # The client claims the opposite verdict; the server's one is stored
+    client.post("/log_move/", json=move(1, move_num, uci, mistake=not mistake))
+    assert logged(app, section_id) == [(uci, mistake, not mistake, legal)]
+
+def test_promotion_sent_without_its_piece_is_right(app, client):
+    section_id = start_testing(client)
+    client.post("/log_move/", json=move(2, 0, "e7e8"))
+    client.post("/log_move/", json=move(2, 2, "e8e4"))
+    assert [(m, mistake, legal) for m, mistake, _, legal in logged(app, section_id)] == [("e7e8", False, True), ("e8e4", False, True)]
+
+@pytest.mark.parametrize("client_mistake", [False, True])
+def test_unknown_puzzle_keeps_the_client_verdict(app, client, client_mistake):
+    section_id = start_testing(client)
+    client.post("/log_move/", json=move(99, 0, "e2e4", mistake=client_mistake))
+    assert logged(app, section_id) == [("e2e4", client_mistake, client_mistake, None)]
+
+def test_replayed_seq_is_folded_once(app, client):
+    section_id = start_testing(client)
+    batch = [move(1, 0, "e4e5", seq=0), move(1, 0, "e4a4", seq=1)]
+    assert client.post("/log_moves/", json={"moves": batch}).get_json() == {"accepted": [0, 1], "duplicates": []}
+    retry = batch + [move(1, 2, "b3a4", seq=2)]
+    assert client.post("/log_moves/", json={"moves": retry}).get_json() == {"accepted": [2], "duplicates": [0, 1]}
+    with app.app_context():
+        bonus = db.session.execute(db.select(PuzzleBonus).filter_by(section_id=section_id, puzzle_id=1)).scalar_one()
+        assert (bonus.correct, bonus.mistakes) == (2, 1)
+        assert bonus.bonus == pytest.approx(0.16)
+        assert Move.query.filter_by(section_id=section_id).count() == 3
+
+def test_section_counters_come_from_the_latest_move(app, client):
+    section_id = start_testing(client)
+    later = dict(move(1, 2, "b3a4", seq=1), successes=1, puzzles=1)
+    # Out of order within the batch, then an older move retried on its own
+    client.post("/log_moves/", json={"moves": [later, move(1, 0, "e4a4", seq=0)]})
+    client.post("/log_moves/", json={"moves": [move(1, 0, "e4a4", seq=0)]})
+    with app.app_context():
+        section = db.session.get(Section, section_id)
+        assert (section.successes, section.num_puzzles) == (1, 1)
+    assert [m for m, _, _, _ in logged(app, section_id)] == ["e4a4", "b3a4"]
+
+@pytest.mark.parametrize("puzzle_id", ["pin", None, 99])
+def test_moves_without_a_catalog_entry_earn_no_bonus(app, client, puzzle_id):
+    section_id = start_testing(client)
+    with app.app_context():
+        record_moves({"mturk_id": "TESTER1", "section_id": section_id, "moves": [move(puzzle_id, 0, "e4a4"), move(1, 0, "e4a4")]})
+        db.session.commit()
+        assert [b.puzzle_id for b in PuzzleBonus.query.filter_by(section_id=section_id)] == [1]
+    assert len(logged(app, section_id)) == 2
+
+@pytest.mark.parametrize("body", [
+    None,
+    {},
+    {"moves": {"seq": 0}},
+    {"moves": [dict(move(1, 0, "e4a4"), seq=None)]},
+    {"moves": [{k: v for k, v in move(1, 0, "e4a4", seq=0).items() if k != "move_num"}]},
+    {"moves": [move("1", 0, "e4a4", seq=0)]},
+])
+def test_log_moves_refuses_malformed_bodies(app, client, body):
+    section_id = start_testing(client)
+    response = client.post("/log_moves/", data="not json" if body is None else None, json=body, content_type="application/json")
+    assert response.status_code == 400
+    assert logged(app, section_id) == []
+
+def test_log_moves_needs_a_started_section(client):
+    client.post("/login/", data={"mturk_id": "TESTER1"})
+    assert client.post("/log_moves/", json={"moves": []}).status_code == 400
+
+@pytest.mark.parametrize("body", [
+    None,
+    [move(1, 0, "e4a4")],
+    {k: v for k, v in move(1, 0, "e4a4").items() if k != "mistake"},
+    move("pin", 0, "e4a4"),
+    move(1, 0, None),
+    move(1, 0, "e4a4", seq="0"),
+])
+def test_log_move_refuses_malformed_bodies(app, client, body):
+    section_id = start_testing(client)
+    response = client.post("/log_move/", data="not json" if body is None else None, json=body, content_type="application/json")
+    assert response.status_code == 400
+    assert logged(app, section_id) == []
+
+def test_log_move_needs_a_started_section(client):
+    client.post("/login/", data={"mturk_id": "TESTER1"})
+    assert client.post("/log_move/", json=move(1, 0, "e4a4")).status_code == 400
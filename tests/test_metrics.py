@@ -0,0 +1,44 @@
+import re
+
+import pytest
+
+from conftest import start_testing
+
+def scrape(client, name):
+    body = client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).get_data(as_text=True)
+    match = re.search(r"^%s (\S+)$" % re.escape(name), body, re.M)
+    return float(match.group(1)) if match else 0.0
+
+def test_metrics_is_hidden_without_a_token(client):
+    assert client.get("/metrics").status_code == 404
+
+@pytest.mark.parametrize("header", ["Bearer wrong", "Bearer jeton-été", "Bearer é".encode().decode("latin-1")])
+def test_metrics_refuses_a_bad_token(app, client, header):
+    app.config["METRICS_TOKEN"] = "s3cret"
+    assert client.get("/metrics", headers={"Authorization": header}).status_code == 403
+    assert client.get("/metrics", query_string={"token": header[7:]}).status_code == 403
+
+def test_metrics_with_the_token(app, client):
+    app.config["METRICS_TOKEN"] = "s3cret"
+    response = client.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+
+def test_metrics_count_requests_and_their_sql(app, client):
+    app.config["METRICS_TOKEN"] = "s3cret"
+    start_testing(client)
+    series = (
+        'http_request_duration_seconds_count{endpoint="main.start_section"}',
+        'http_requests_total{endpoint="main.start_section",status="204"}',
+        'sql_statements_total{endpoint="main.start_section"}',
+    )
+    before = [scrape(client, s) for s in series]
+    response = client.post("/start_section/")
+    assert response.status_code == 204
+    # The request is booked once its body is closed, as a WSGI server does
+    response.close()
+    after = [scrape(client, s) for s in series]
+    assert after[0] == before[0] + 1
+    assert after[1] == before[1] + 1
+    # Starting a section inserts its row
+    assert after[2] > before[2]
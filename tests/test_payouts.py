@@ -0,0 +1,167 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app import BASE_COMP, PUZZLE_BONUS, PuzzleBonus, SpillTail, User, bonus_after, calculate_bonus_comp, db, payout_rows, read_spill, write_behind
+from conftest import finish, move, start_testing
+
+# Right at both of the player's moves, after one wrong try: 0.2 less one mistake's 0.04
+PIN_WITH_A_MISTAKE = [move(1, 0, "e4e5", seq=0), move(1, 0, "e4a4", seq=1), move(1, 2, "b3a4", seq=2)]
+
+def compensation(app, mturk_id):
+    with app.app_context():
+        return db.session.get(User, mturk_id).compensation
+
+def payouts(app):
+    with app.app_context():
+        return {mturk_id: bonus_comp for mturk_id, _, _, _, bonus_comp in payout_rows()}
+
+def spill(app, pid, events):
+    path = os.path.join(app.instance_path, "%s.%d" % (app.config["WRITE_BEHIND_SPILL"], pid))
+    with open(path, "a") as f:
+        f.writelines(json.dumps(e) + "\n" for e in events)
+    return path
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+def test_bonus_follows_the_server_verdict(app, client):
+    start_testing(client)
+    # The client calls every move right; e4e5 is not, and the promotion puzzle is only half played
+    client.post("/log_moves/", json={"moves": [dict(m, mistake=False) for m in PIN_WITH_A_MISTAKE] + [move(2, 0, "e7e8", seq=3)]})
+    assert finish(client).status_code == 200
+    assert compensation(app, "TESTER1") == pytest.approx(BASE_COMP + 0.16)
+    assert payouts(app)["TESTER1"] == pytest.approx(0.16)
+
+def test_bonus_after_folds_like_the_aggregate():
+    bonus = PuzzleBonus(correct=0, mistakes=0, bonus=PUZZLE_BONUS)
+    for mistakes in range(1, 10):
+        bonus.fold(True)
+        # Exactly, since the payout report has to match what was paid
+        assert bonus_after(mistakes) == bonus.bonus
+
+def test_reconcile_bonuses_repairs_drifted_aggregates(app, client):
+    section_id = start_testing(client)
+    client.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE})
+    runner = app.test_cli_runner()
+    assert "0 of 1 puzzle aggregates drifted" in runner.invoke(args=["reconcile-bonuses"]).output
+    with app.app_context():
+        bonus = PuzzleBonus.query.filter_by(section_id=section_id).one()
+        assert (bonus.puzzle_id, bonus.correct, bonus.mistakes) == (1, 2, 1)
+        bonus.bonus = PUZZLE_BONUS
+        db.session.commit()
+    assert "1 of 1 puzzle aggregates drifted" in runner.invoke(args=["reconcile-bonuses", "--fix"]).output
+    assert "0 of 1 puzzle aggregates drifted" in runner.invoke(args=["reconcile-bonuses"]).output
+    with app.app_context():
+        assert PuzzleBonus.query.filter_by(section_id=section_id).one().bonus == pytest.approx(0.16)
+
+def test_retried_batch_is_paid_once(app, client):
+    start_testing(client)
+    client.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE[:2]})
+    client.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE})
+    finish(client)
+    assert compensation(app, "TESTER1") == pytest.approx(BASE_COMP + 0.16)
+    assert payouts(app)["TESTER1"] == pytest.approx(0.16)
+
+def test_queued_moves_are_paid(app, client):
+    app.config["WRITE_BEHIND"] = True
+    start_testing(client)
+    assert client.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE}).status_code == 202
+    assert finish(client).status_code == 200
+    assert compensation(app, "TESTER1") == pytest.approx(BASE_COMP + 0.16)
+
+def test_payout_waits_for_moves_queued_in_another_worker(app, client):
+    app.config.update(WRITE_BEHIND=True, WRITE_BEHIND_PAYOUT_TIMEOUT=0.2)
+    section_id = start_testing(client)
+    worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        payload = {"mturk_id": "TESTER1", "section_id": section_id, "moves": PIN_WITH_A_MISTAKE}
+        path = spill(app, worker.pid, [[1, "moves", payload]])
+        response = finish(client)
+        assert response.status_code == 503 and response.headers["Retry-After"]
+
+        # The other worker commits the moves and marks them in its spill file
+        with app.app_context():
+            write_behind.apply([[1, "moves", payload]])
+        spill(app, worker.pid, [["commit", [1]]])
+        assert client.get("/post_survey/").status_code == 200
+        assert compensation(app, "TESTER1") == pytest.approx(BASE_COMP + 0.16)
+        os.remove(path)
+    finally:
+        worker.kill()
+        worker.wait()
+
+def test_spill_of_a_dead_worker_is_paid(app, client):
+    app.config["WRITE_BEHIND"] = True
+    section_id = start_testing(client)
+    spill(app, dead_pid(), [[1, "moves", {"mturk_id": "TESTER1", "section_id": section_id, "moves": PIN_WITH_A_MISTAKE}]])
+    assert finish(client).status_code == 200
+    assert compensation(app, "TESTER1") == pytest.approx(BASE_COMP + 0.16)
+
+def test_spill_tail_reads_appends_and_rotations(app):
+    payload = {"mturk_id": "TESTER1", "section_id": 1, "moves": []}
+    path = spill(app, 1, [["spill", 1], [1, "moves", payload], [2, "moves", payload]])
+    tail = SpillTail()
+    tail.refresh(path)
+    assert tail.counts["TESTER1"] == 2
+    # A torn line is left for the next refresh
+    with open(path, "a") as f:
+        f.write(json.dumps(["commit", [1]]))
+    tail.refresh(path)
+    assert tail.counts["TESTER1"] == 2
+    with open(path, "a") as f:
+        f.write("\n")
+    tail.refresh(path)
+    assert tail.counts["TESTER1"] == 1
+    # Rotated: a new file with event 2 only, which is then committed
+    os.remove(path)
+    spill(app, 1, [["spill", 2], [2, "moves", payload], ["commit", [2]]])
+    tail.refresh(path)
+    assert tail.counts["TESTER1"] == 0
+
+def test_committed_spill_is_rotated(app, client):
+    app.config.update(WRITE_BEHIND=True, WRITE_BEHIND_SPILL_BYTES=0)
+    start_testing(client)
+    client.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE})
+    with app.app_context():
+        assert write_behind.flush(5)
+        assert write_behind.uncommitted("TESTER1") == 0
+        assert read_spill(write_behind.spill_path(os.getpid())) == ({}, set())
+
+def test_failed_event_is_dead_lettered(app):
+    app.config["WRITE_BEHIND"] = True
+    with app.app_context():
+        write_behind.submit("section_end", {"mturk_id": "TESTER1", "section_id": 1})
+        assert write_behind.flush(5)
+        assert write_behind.uncommitted("TESTER1") == 0
+        with open(write_behind.dead_letter_path()) as f:
+            [(event_id, kind, payload, error, _)] = [json.loads(line) for line in f]
+    assert (kind, payload) == ("section_end", {"mturk_id": "TESTER1", "section_id": 1})
+    assert "end_time" in error
+
+def test_payout_report_matches_the_paid_bonus(app):
+    paid = app.test_client()
+    start_testing(paid, "PAID")
+    paid.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE})
+    # Only the first testing section is paid on
+    paid.post("/start_section/")
+    paid.post("/log_moves/", json={"moves": [move(2, 0, "e7e8", seq=0), move(2, 2, "e8e4", seq=1)]})
+    finish(paid)
+
+    no_moves = app.test_client()
+    start_testing(no_moves, "NOMOVES")
+    finish(no_moves)
+
+    unfinished = app.test_client()
+    start_testing(unfinished, "UNFINISHED")
+    unfinished.post("/log_moves/", json={"moves": PIN_WITH_A_MISTAKE})
+
+    report = payouts(app)
+    assert report == pytest.approx({"PAID": 0.16, "NOMOVES": 0.0})
+    with app.app_context():
+        assert {mturk_id: calculate_bonus_comp(mturk_id) for mturk_id in report} == pytest.approx(report)
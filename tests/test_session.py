@@ -0,0 +1,18 @@
+import pytest
+
+from conftest import start_testing
+
+@pytest.mark.parametrize("url", ["/final_survey/", "/get_puzzles/testing/?explanations=1"])
+def test_session_claims_avoid_the_user_load_once(client, url):
+    start_testing(client)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["X-User-Loads-Avoided"] == "1"
+
+def test_session_without_a_protocol_claim_loads_the_user(client):
+    start_testing(client)
+    with client.session_transaction() as s:
+        del s["user_protocol"]
+    response = client.get("/final_survey/")
+    assert response.status_code == 200
+    assert response.headers["X-User-Loads-Avoided"] == "0"
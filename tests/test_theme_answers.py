@@ -0,0 +1,31 @@
+import pytest
+
+from app import ThemeAnswer
+from conftest import start_testing
+
+def answers(app):
+    with app.app_context():
+        return [(a.mturk_id, a.puzzle_id, a.user_answer, a.correct) for a in ThemeAnswer.query.order_by(ThemeAnswer.id)]
+
+def answer(puzzle_id, user_answer, correct_answer="pin"):
+    return {"puzzle_id": puzzle_id, "user_answer": user_answer, "correct_answer": correct_answer, "correct": user_answer == correct_answer}
+
+def test_changed_answer_overwrites_the_first(app, client):
+    start_testing(client)
+    assert client.post("/log_theme_answer/", json=answer(1, "fork")).status_code == 200
+    assert client.post("/log_theme_answer/", json=answer(1, "pin")).status_code == 200
+    assert answers(app) == [("TESTER1", 1, "pin", True)]
+
+@pytest.mark.parametrize("body", [
+    None,
+    [answer(1, "pin")],
+    {k: v for k, v in answer(1, "pin").items() if k != "correct"},
+    answer("pin", "pin"),
+    answer(1, None),
+    dict(answer(1, "pin"), correct="yes"),
+])
+def test_log_theme_answer_refuses_malformed_bodies(app, client, body):
+    start_testing(client)
+    response = client.post("/log_theme_answer/", data="not json" if body is None else None, json=body, content_type="application/json")
+    assert response.status_code == 400
+    assert answers(app) == []